@@ -1,11 +1,9 @@
 from django.conf import settings
 from django.core.exceptions import ValidationError as DjangoValidationError, ObjectDoesNotExist
 from django.core.validators import URLValidator
-from requests import TooManyRedirects
 from rest_framework import serializers
 
 from perma.models import LinkUser, Folder, CaptureJob, Capture, Link, Organization, LinkBatch
-from perma.utils import ip_in_allowed_ip_range
 
 from .utils import get_mime_type, mime_type_lookup, url_is_invalid_unicode, reverse_api_view
 
@@ -121,11 +119,17 @@ class CaptureJobSerializer(BaseSerializer):
     guid = serializers.PrimaryKeyRelatedField(source='link', read_only=True)
     title = serializers.SerializerMethodField()
     user_deleted = serializers.SerializerMethodField()
+    queue_position = serializers.SerializerMethodField()
 
     class Meta:
         model = CaptureJob
         fields = ('guid', 'status', 'message', 'submitted_url', 'attempt', 'step_count', 'step_description', 'capture_start_time', 'capture_end_time', 'queue_position', 'title', 'user_deleted')
 
+    def to_representation(self, capture_job):
+        # report progress as of the latest update, rather than the latest step saved to the database
+        CaptureJob.load_cached_progress([capture_job])
+        return super(CaptureJobSerializer, self).to_representation(capture_job)
+
     def get_title(self, capture_job):
         if capture_job.link is None:
             return ""
@@ -135,6 +139,14 @@ class CaptureJobSerializer(BaseSerializer):
     def get_user_deleted(self, capture_job):
         return capture_job.link and capture_job.link.user_deleted
 
+    def get_queue_position(self, capture_job):
+        # look up every job in a list or batch against the same lane depths
+        if capture_job.status != 'pending':
+            return 0
+        if 'capture_job_queue' not in self.context:
+            self.context['capture_job_queue'] = CaptureJob.load_queue()
+        return capture_job.queue_position(self.context['capture_job_queue'])
+
 ### CAPTURE ###
 
 class CaptureSerializer(BaseSerializer):
@@ -239,26 +251,14 @@ class AuthenticatedLinkSerializer(LinkSerializer):
                     temp_link = Link(submitted_url=data['submitted_url'])
                     validate(temp_link.ascii_safe_url)
 
-                    # Don't force URL resolution validation if a file is provided
-                    if not uploaded_file:
-                        if not temp_link.ip:
-                            errors['url'] = "Couldn't resolve domain."
-                        elif not ip_in_allowed_ip_range(temp_link.ip):
-                            errors['url'] = "Not a valid IP."
-                        elif not temp_link.headers:
-                            errors['url'] = "Couldn't load URL."
-                        else:
-                            # preemptively reject URLs that report a size over settings.MAX_ARCHIVE_FILE_SIZE
-                            try:
-                                if int(temp_link.headers.get('content-length', 0)) > settings.MAX_ARCHIVE_FILE_SIZE:
-                                    errors['url'] = "Target page is too large (max size %sMB)." % (settings.MAX_ARCHIVE_FILE_SIZE / 1024 / 1024)
-                            except ValueError:
-                                # content-length header wasn't an integer. Carry on.
-                                pass
+                    # Don't force URL resolution validation if a file is provided,
+                    # or if the capture worker is going to check instead
+                    if not uploaded_file and not settings.DEFER_URL_VALIDATION:
+                        url_error = temp_link.get_url_error()
+                        if url_error:
+                            errors['url'] = url_error
                 except DjangoValidationError:
                     errors['url'] = "Not a valid URL."
-                except TooManyRedirects:
-                    errors['url'] = "URL caused a redirect loop."
 
         # check uploaded file
         if uploaded_file == '':
@@ -12,9 +12,12 @@ import json
 import urllib.parse
 import re
 from mock import patch
+from selenium.common.exceptions import WebDriverException
 
 from .utils import ApiResourceTestCase, ApiResourceTransactionTestCase, TEST_ASSETS_DIR, index_warc_file
 from perma.models import Link, LinkUser, Folder
+from perma import tasks
+from perma.tasks import capture_pool
 
 
 class LinkResourceTestMixin():
@@ -346,6 +349,60 @@ class LinkResourceTransactionTestCase(LinkResourceTestMixin, ApiResourceTransact
         # check folder
         self.assertTrue(link.folders.filter(pk=target_folder.pk).exists())
 
+    def test_should_create_archive_if_pre_onload_summary_fails(self):
+        real_get_page_summary = tasks.get_page_summary
+        def get_page_summary(browser, include_frames=True):
+            if not include_frames:
+                raise WebDriverException("Test failure.")
+            return real_get_page_summary(browser, include_frames)
+
+        with patch('perma.tasks.get_page_summary', get_page_summary):
+            obj = self.successful_post(self.list_url,
+                                       data={'url': self.server_url + "/test.html"},
+                                       user=self.org_user)
+        link = Link.objects.get(guid=obj['guid'])
+        self.assertEqual(link.primary_capture.status, 'success')
+        # metadata comes from the post-onload summary instead
+        self.assertEqual(link.submitted_title, "Test title.")
+
+    @override_settings(ENABLE_BATCH_LINKS=True)
+    @patch('perma.models.LinkUser.get_links_remaining', autospec=True)
+    @patch('api.views.run_task', autospec=True)
+    def test_should_create_batch_of_links(self, run_task, get_links_remaining):
+        get_links_remaining.return_value = (2, 'monthly')
+        target_folder = self.regular_user.root_folder
+        link_count = self.regular_user.link_count
+        urls = [
+            self.server_url + "/test.html",
+            "not a url",
+            self.server_url + "/test.pdf",
+            self.server_url + "/test.jpg",  # over the limit
+        ]
+        obj = self.successful_post(self.list_url + '/batches',
+                                   format='json',
+                                   data={'urls': urls, 'target_folder': target_folder.pk},
+                                   user=self.regular_user)
+
+        capture_jobs = {job['submitted_url']: job for job in obj['capture_jobs']}
+        self.assertEqual(len(capture_jobs), 4)
+        self.assertIn('url', json.loads(capture_jobs["not a url"]['message']))
+        self.assertEqual(capture_jobs[urls[3]]['status'], 'invalid')
+
+        links = Link.objects.filter(capture_job__link_batch_id=obj['id']).order_by('capture_job__order')
+        self.assertEqual([link.submitted_url for link in links], [urls[0], urls[2]])
+        for link in links:
+            self.assertEqual(link.capture_job.status, 'pending')
+            self.assertEqual(link.captures.filter(status='pending').count(), 2)
+            self.assertEqual(list(link.folders.all()), [target_folder])
+            self.assertEqual(link.history.count(), 1)
+
+        # jobs are queued one after another, and captures are started just once
+        self.assertLess(links[0].capture_job.order, links[1].capture_job.order)
+        run_task.assert_called_once()
+
+        self.regular_user.refresh_from_db()
+        self.assertEqual(self.regular_user.link_count, link_count + 2)
+
 
     @patch('perma.models.Registrar.link_creation_allowed', autospec=True)
     def test_should_create_archive_from_pdf_url(self, allowed):
@@ -530,6 +587,25 @@ class LinkResourceTransactionTestCase(LinkResourceTestMixin, ApiResourceTransact
         self.assertRecordsInWarc(link, expected_records=expected_records)
 
 
+    @override_settings(CAPTURE_WARM_POOL=True)
+    def test_warm_browser_captures_subresources_every_time(self):
+        # a reused browser mustn't serve anything from its cache, or it won't be recorded
+        try:
+            for i in range(2):
+                obj = self.successful_post(self.list_url,
+                                           data={
+                                               'url': self.server_url + "/test_media_outer.html",
+                                               'folder': self.org_user.root_folder.pk,
+                                           },
+                                           user=self.org_user)
+                link = Link.objects.get(guid=obj['guid'])
+                self.assertRecordsInWarc(link, expected_records=(("test1.jpg", "image/jpeg"), ("test2.png", "image/png")))
+                if i == 0:
+                    self.assertEqual(len(capture_pool.idle), 1)
+        finally:
+            capture_pool.shutdown()
+
+
     #########################
     # File Archive Creation #
     #########################
@@ -544,6 +620,8 @@ class LinkResourceTransactionTestCase(LinkResourceTestMixin, ApiResourceTransact
             link = Link.objects.get(guid=obj['guid'])
             self.assertRecordsInWarc(link, upload=True)
             self.assertEqual(link.primary_capture.user_upload, True)
+            self.assertTrue(default_storage.exists(link.cdxj_storage_file()))
+            self.assertTrue(default_storage.exists(link.pages_storage_file()))
 
     def test_should_create_archive_from_jpg_file(self):
         with open(os.path.join(TEST_ASSETS_DIR, 'target_capture_files', 'test.jpg'), 'rb') as test_file:
@@ -1,6 +1,8 @@
 import os
+from mock import patch
 from .utils import TEST_ASSETS_DIR, ApiResourceTestCase, ApiResourceTransactionTestCase
-from perma.models import Link, LinkUser
+from perma.models import CaptureJob, Link, LinkUser
+from perma.tasks import run_next_capture
 from django.test.utils import override_settings
 
 
@@ -74,6 +76,19 @@ class LinkValidationTestCase(LinkValidationMixin, ApiResourceTestCase):
                            # http://stackoverflow.com/a/10456069/313561
                            data={'url': 'http://0.42.42.42/'})
 
+    @override_settings(DEFER_URL_VALIDATION=True)
+    @patch('api.views.run_task', autospec=True)
+    def test_should_defer_url_validation_to_capture(self, run_task):
+        obj = self.successful_post(self.list_url,
+                                   user=self.org_user,
+                                   data={'url': 'http://0.42.42.42/'})
+
+        # the capture worker rejects it instead
+        run_next_capture()
+        capture_job = CaptureJob.objects.get(link_id=obj['guid'])
+        self.assertEqual(capture_job.status, 'failed')
+        self.assertIn("Couldn't load URL.", capture_job.message)
+
     def test_should_reject_invalid_folder_id(self):
         self.rejected_post(self.list_url,
                            user=self.org_user,
@@ -1,7 +1,10 @@
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import csv
+import json
 import django_filters
 from django.conf import settings
+from django.db import transaction
 from django.core.exceptions import ObjectDoesNotExist, ValidationError as DjangoValidationError
 from django.http import Http404, HttpResponse
 from mptt.exceptions import InvalidMove
@@ -13,11 +16,11 @@ from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from perma.utils import run_task, stream_warc, stream_warc_if_permissible, clear_wr_session
-from perma.tasks import run_next_capture
+from perma.tasks import run_next_capture, write_warc_index
 from perma.models import Folder, CaptureJob, Link, Capture, Organization, LinkBatch
 
 from .utils import TastypiePagination, load_parent, raise_general_validation_error, \
-    raise_invalid_capture_job, dispatch_multiple_requests, reverse_api_view_relative
+    raise_invalid_capture_job, capture_job_error_dict, dispatch_multiple_requests, reverse_api_view_relative
 from .serializers import FolderSerializer, CaptureJobSerializer, LinkSerializer, AuthenticatedLinkSerializer, \
     LinkUserSerializer, OrganizationSerializer, LinkBatchSerializer, DetailedLinkBatchSerializer
 
@@ -227,7 +230,7 @@ class CaptureJobListView(BaseView):
 
     def get(self, request, format=None):
         """ List capture_jobs for user. """
-        queryset = CaptureJob.objects.filter(link__created_by_id=request.user.pk, status__in=['pending', 'in_progress'])
+        queryset = CaptureJob.objects.filter(link__created_by_id=request.user.pk, status__in=['pending', 'in_progress']).select_related('link')
         return self.simple_list(request, queryset)
 
 
@@ -303,7 +306,7 @@ class PublicLinkDownloadView(BaseView):
             link = Link.objects.discoverable().get(pk=guid)
         except Link.DoesNotExist:
             raise Http404
-        return stream_warc(link)
+        return stream_warc(link, request)
 
 
 # /archives
@@ -326,6 +329,45 @@ class AuthenticatedLinkListView(BaseView):
                 raise ValidationError({'folder': ["Folder not found."]})
         return None
 
+    @staticmethod
+    def get_link_creation_error(folder, user):
+        """
+            Helper method to check whether the user can make a link in this folder.
+            Returns an error message, or None if they can.
+            Used by AuthenticatedLinkListView.post and LinkBatchesListView.post.
+        """
+        # Disallow creation of links in top-level sponsored folder
+        if folder.is_sponsored_root_folder:
+            return "You can't make links directly in your Sponsored Links folder. Select a folder belonging to a sponsor."
+
+        # Make sure a limited user has links left to create
+        if not folder.organization and not folder.sponsored_by:
+            if not user.link_creation_allowed():
+                return AuthenticatedLinkListView.get_link_limit_error(user)
+        else:
+            registrar = folder.sponsored_by if folder.sponsored_by else folder.organization.registrar
+
+            msg = None
+            if folder.read_only:
+                registrar_users = [registrar_user.email for registrar_user in registrar.active_registrar_users()]
+                msg = f"Your registrar has made this folder read-only. For assistance, contact: {', '.join(registrar_users)}."
+            if not registrar.link_creation_allowed():
+                error = 'Perma.cc cannot presently make links on behalf of {}. '.format(registrar.name)
+                if user.registrar:
+                    contact = 'Visit your settings for subscription information.'
+                else:
+                    registrar_users = [registrar_user.email for registrar_user in registrar.active_registrar_users()]
+                    contact = 'For assistance with your subscription, contact:  {}.'.format(", ".join(registrar_users))
+                msg = error + contact
+            return msg
+        return None
+
+    @staticmethod
+    def get_link_limit_error(user):
+        if user.nonpaying:
+            return "You've already reached your limit."
+        return "Perma.cc cannot presently make additional Perma Links on your behalf. Visit your subscription settings page for more information."
+
     @staticmethod
     def load_links(request):
         """
@@ -375,36 +417,10 @@ class AuthenticatedLinkListView(BaseView):
         except ValidationError as e:
             raise_invalid_capture_job(capture_job, e.detail)
 
-        # Disallow creation of links in top-level sponsored folder
-        if folder.is_sponsored_root_folder:
-            error = "You can't make links directly in your Sponsored Links folder. Select a folder belonging to a sponsor."
+        error = self.get_link_creation_error(folder, request.user)
+        if error:
             raise_invalid_capture_job(capture_job, error)
 
-        # Make sure a limited user has links left to create
-        if not folder.organization and not folder.sponsored_by:
-            if not request.user.link_creation_allowed():
-                if request.user.nonpaying:
-                    raise_invalid_capture_job(capture_job, "You've already reached your limit.")
-                error = "Perma.cc cannot presently make additional Perma Links on your behalf. Visit your subscription settings page for more information."
-                raise_invalid_capture_job(capture_job, error)
-        else:
-            registrar = folder.sponsored_by if folder.sponsored_by else folder.organization.registrar
-
-            msg = None
-            if folder.read_only:
-                registrar_users = [user.email for user in registrar.active_registrar_users()]
-                msg = f"Your registrar has made this folder read-only. For assistance, contact: {', '.join(registrar_users)}."
-            if not registrar.link_creation_allowed():
-                error = 'Perma.cc cannot presently make links on behalf of {}. '.format(registrar.name)
-                if request.user.registrar:
-                    contact = 'Visit your settings for subscription information.'
-                else:
-                    registrar_users = [user.email for user in registrar.active_registrar_users()]
-                    contact = 'For assistance with your subscription, contact:  {}.'.format(", ".join(registrar_users))
-                msg = error + contact
-            if msg:
-                raise_invalid_capture_job(capture_job, msg)
-
         serializer = self.serializer_class(data=data, context={'request': request})
         if serializer.is_valid():
 
@@ -420,6 +436,7 @@ class AuthenticatedLinkListView(BaseView):
             uploaded_file = request.data.get('file')
             if uploaded_file:
                 link.write_uploaded_file(uploaded_file)
+                run_task(write_warc_index.s(link.guid))
 
             # handle submitted url
             else:
@@ -446,7 +463,9 @@ class AuthenticatedLinkListView(BaseView):
                 # kick off capture tasks -- no need for guid since it'll work through the queue
                 capture_job.status = 'pending'
                 capture_job.link = link
-                capture_job.save(update_fields=['status', 'link'])
+                capture_job.host = capture_job.target_host()
+                capture_job.registrar_id = capture_job.target_registrar_id()
+                capture_job.save(update_fields=['status', 'link', 'host', 'registrar'])
                 run_task(run_next_capture.s())
 
             return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -527,6 +546,7 @@ class AuthenticatedLinkDetailView(BaseView):
 
                 # write new warc and capture
                 link.write_uploaded_file(uploaded_file, cache_break=True)
+                run_task(write_warc_index.s(link.guid))
 
                 # delete the link from Webrecorder and
                 # clear the user's Webrecorder session, if any,
@@ -579,7 +599,7 @@ class AuthenticatedLinkDownloadView(BaseView):
     def get(self, request, guid, format=None):
         """ Download warc. """
         link = self.get_object_for_user_by_pk(request.user, guid)
-        return stream_warc_if_permissible(link, request.user)
+        return stream_warc_if_permissible(link, request.user, request)
 
 
 # /folders/:parent_id/archives/:guid
@@ -627,32 +647,15 @@ class LinkBatchesListView(BaseView):
             request.data['created_by'] = request.user.pk
             serializer = self.serializer_class(data=request.data, context={'request': self.request})
             if serializer.is_valid():
-                serializer.save(created_by=request.user)
+                link_batch = serializer.save(created_by=request.user)
 
                 # Attempt creation of Perma Links
-                path = reverse_api_view_relative('archives')
-                batch_id = serializer.data['id']
-                call_list = [
-                    {
-                        'path': path,
-                        'verb': 'POST',
-                        'data': {
-                            'url': url,
-                            'folder': request.data['target_folder'],
-                            'human': request.data.get('human', False)
-                        }
-                    } for url in request.data.get('urls', [])
-                ]
-                dispatch_multiple_requests(request, call_list, {"batch": batch_id})
-                # TODO: how can we communicate these errors to the user?
-                # if dispatch_multiple_requests returns to "responses"
-                # internal_server_errors = [
-                #     response['data']['data']['url'] for response in responses if response['status_code'] == 500
-                # ]
+                self.create_links(request, link_batch, request.data.get('urls', []), request.data.get('human', False))
+
                 # Get an up-to-date version of this LinkBatch's data,
                 # formatted by the LinkBatch serializer
                 call_for_fresh_serializer_data = [{
-                    'path': reverse_api_view_relative('link_batch', kwargs={"pk": batch_id}),
+                    'path': reverse_api_view_relative('link_batch', kwargs={"pk": link_batch.pk}),
                     'verb': 'GET'
                 }]
                 response = dispatch_multiple_requests(request, call_for_fresh_serializer_data)
@@ -664,6 +667,91 @@ class LinkBatchesListView(BaseView):
             raise ValidationError(serializer.errors)
         raise PermissionDenied()
 
+    @staticmethod
+    def create_links(request, link_batch, urls, human):
+        """
+            Create a Perma Link for each url, as AuthenticatedLinkListView.post would, but all at once:
+            urls are validated concurrently, the user's link limit is checked once, everything is saved
+            with a handful of bulk queries, and the capture queue is kicked once.
+
+            Every url gets a CaptureJob in the batch; those that can't be captured are saved with
+            status 'invalid' and a message saying why.
+        """
+        user = request.user
+        capture_jobs = [
+            CaptureJob(human=human, submitted_url=url, created_by=user, link_batch=link_batch)
+            for url in urls
+        ]
+        if not capture_jobs:
+            return
+
+        # errors that apply to every url
+        links_remaining = None
+        try:
+            folder = Folder.objects.accessible_to(user).get(pk=link_batch.target_folder_id)
+            error = AuthenticatedLinkListView.get_link_creation_error(folder, user)
+            if not error and not folder.organization and not folder.sponsored_by:
+                links_remaining = user.get_links_remaining()[0]
+        except Folder.DoesNotExist:
+            error = {'folder': ["Folder not found."]}
+
+        # check urls concurrently, since that means resolving each domain and loading headers
+        validations = []
+        if not error:
+            def validate(url):
+                link_serializer = AuthenticatedLinkSerializer(data={'url': url}, context={'request': request})
+                link_serializer.is_valid()
+                return link_serializer
+            with ThreadPoolExecutor(max_workers=settings.LINK_BATCH_VALIDATION_CONCURRENCY) as executor:
+                validations = list(executor.map(validate, urls))
+
+        links = []
+        for i, capture_job in enumerate(capture_jobs):
+            job_error = error
+            if not job_error and links_remaining is not None and links_remaining <= 0:
+                job_error = AuthenticatedLinkListView.get_link_limit_error(user)
+            if not job_error and validations[i].errors:
+                job_error = validations[i].errors
+            if job_error:
+                capture_job.message = json.dumps(capture_job_error_dict(job_error))
+                continue
+
+            link = Link(created_by=user, **validations[i].validated_data)
+            if folder.organization and folder.organization.default_to_private:
+                link.is_private = True
+            links.append((capture_job, link))
+            if links_remaining is not None:
+                links_remaining -= 1
+
+        with transaction.atomic():
+            Link.bulk_create_in_folder([link for capture_job, link in links], folder)
+            captures = []
+            for capture_job, link in links:
+                capture_job.link = link
+                capture_job.status = 'pending'
+                # primary capture and screenshot placeholders
+                captures.append(Capture(
+                    link=link,
+                    role='primary',
+                    status='pending',
+                    record_type='response',
+                    url=link.submitted_url,
+                ))
+                captures.append(Capture(
+                    link=link,
+                    role='screenshot',
+                    status='pending',
+                    record_type='resource',
+                    url="file:///%s/cap.png" % link.guid,
+                    content_type='image/png',
+                ))
+            Capture.objects.bulk_create(captures)
+            CaptureJob.bulk_create_in_queue(capture_jobs)
+
+        # kick off capture tasks -- no need for guid since it'll work through the queue
+        if links:
+            run_task(run_next_capture.s())
+
 
 # /batches/:id
 class LinkBatchesDetailView(BaseView):
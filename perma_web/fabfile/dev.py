@@ -476,6 +476,55 @@ def read_playback_tests(*filepaths):
     print("Total:", err_count)
 
 
+@task
+def benchmark_capture(pages=None, repeat="1", browser=None, concurrency=None, warm_pool=None, host='perma.test', output=None, keep_links=False):
+    """
+        Capture synthetic pages from a local fixture server and report per-phase timings, bytes, threads and memory.
+
+        Pages are named in perma.benchmarks.FIXTURE_PAGES; separate several with semicolons. To compare engines or settings:
+
+            fab dev.benchmark_capture:browser=Chrome,concurrency=2,warm_pool=1,output=chrome.json
+
+        `host` must resolve to this machine. Captures run through the real queue, so run this against
+        a dev database with an idle queue; the benchmark's links are deleted afterward unless keep_links is set.
+    """
+    import json
+    from perma.benchmarks import FIXTURE_PAGES, format_report, run_capture_benchmark
+
+    capture_settings = {}
+    if browser:
+        capture_settings['CAPTURE_BROWSER'] = browser
+    if concurrency:
+        capture_settings['CAPTURE_CONCURRENCY'] = int(concurrency)
+    if warm_pool is not None:
+        capture_settings['CAPTURE_WARM_POOL'] = bool(int(warm_pool))
+
+    page_names = pages.split(';') if pages else None
+    for name in page_names or []:
+        if name not in FIXTURE_PAGES:
+            print("Unknown page %s. Choices:\n%s" % (name, "\n".join("  %s: %s" % (k, v[1]) for k, v in FIXTURE_PAGES.items())))
+            return
+
+    report = run_capture_benchmark(page_names, int(repeat), host=host, keep_links=bool(keep_links), **capture_settings)
+    print(format_report(report))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+@task
+def benchmark_enqueue(pending="0;1000;5000;10000", samples="100"):
+    """
+        Time placing new capture jobs in the queue at several queue lengths. Changes are rolled back afterward.
+
+            fab dev.benchmark_enqueue:pending="0;10000",samples=500
+    """
+    from perma.benchmarks import format_enqueue_report, run_enqueue_benchmark
+
+    results = run_enqueue_benchmark([int(count) for count in pending.split(';')], int(samples))
+    print(format_enqueue_report(results))
+
+
 @task
 def ping_all_users(limit_to="", exclude="", batch_size="500"):
     '''
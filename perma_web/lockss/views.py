@@ -1,17 +1,15 @@
 from urllib.parse import urljoin
-from wsgiref.util import FileWrapper
 from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
 import logging
 
 from django.utils import timezone
 from django.conf import settings
-from django.core.files.storage import default_storage
-from django.http import HttpResponse, HttpResponseBadRequest, Http404, StreamingHttpResponse, HttpResponseForbidden
+from django.http import HttpResponse, HttpResponseBadRequest, Http404, HttpResponseForbidden
 from django.shortcuts import get_object_or_404, render
 
 from perma.models import Link
-from perma.utils import get_client_ip
+from perma.utils import get_client_ip, serve_stored_file
 from .models import Mirror
 
 logger = logging.getLogger(__name__)
@@ -81,11 +79,7 @@ def fetch_warc(request, path, guid):
         raise Http404
 
     # deliver warc file
-    with default_storage.open(link.warc_storage_file()) as file:
-        response = StreamingHttpResponse(FileWrapper(file, 1024 * 8),
-                                         content_type="application/gzip")
-        response['Content-Disposition'] = "attachment; filename=%s.warc.gz" % link.guid
-        return response
+    return serve_stored_file(request, link.warc_storage_file(), "%s.warc.gz" % link.guid)
 
 
 @allow_by_ip
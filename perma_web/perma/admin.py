@@ -231,9 +231,9 @@ class FolderAdmin(MPTTModelAdmin):
 
 
 class CaptureJobAdmin(admin.ModelAdmin):
-    list_display = ['id', 'status', 'superseded', 'message', 'created_by', 'link_id', 'link_creation_timestamp', 'human', 'link_taglist', 'submitted_url']
-    list_filter = ['status', 'superseded']
-    raw_id_fields = ['link', 'created_by']
+    list_display = ['id', 'status', 'superseded', 'message', 'created_by', 'link_id', 'link_creation_timestamp', 'human', 'lane', 'link_taglist', 'submitted_url']
+    list_filter = ['status', 'superseded', 'lane']
+    raw_id_fields = ['link', 'created_by', 'registrar']
 
     def get_queryset(self, request):
         q = Q(link__isnull=True) | Q(link__user_deleted=False)
@@ -0,0 +1,456 @@
+"""
+    Benchmark harness for the capture pipeline.
+
+    Serves synthetic pages from a local fixture server, captures them end to end with
+    run_next_capture, and reports how long each phase of each capture took, along with
+    bytes recorded, thread counts and peak memory. Run it with `fab dev.benchmark_capture`.
+
+    Also benchmarks placing new jobs in the capture queue, with `fab dev.benchmark_enqueue`.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+import json
+import resource
+import threading
+import time
+import urllib.parse
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.test.utils import CaptureQueriesContext, override_settings
+
+import perma.tasks
+from perma.models import Capture, CaptureJob, Link, LinkUser
+
+
+### FIXTURE SERVER ###
+
+# smallest valid png and gif, padded out to the requested size where needed
+PNG_BYTES = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000001e221bc330000000049454e44ae426082')
+GIF_BYTES = bytes.fromhex('47494638396101000100800000000000ffffff21f90401000000002c00000000010001000002024401003b')
+
+ASSET_TYPES = {
+    'png': ('image/png', PNG_BYTES),
+    'gif': ('image/gif', GIF_BYTES),
+    'css': ('text/css', b'body { margin: 0; }\n'),
+    'js': ('application/javascript', b'var x = 1;\n'),
+    'mp4': ('video/mp4', b''),
+}
+
+# name: (path, description)
+FIXTURE_PAGES = OrderedDict([
+    ('simple', ('/html/simple', "a small html page with no subresources")),
+    ('subresources', ('/html/subresources?count=200', "200 images, stylesheets and scripts")),
+    ('srcset', ('/html/srcset?count=50&candidates=6', "50 images with 6-candidate srcsets, fetched outside the browser")),
+    ('slow', ('/html/slow?delay=3', "3 seconds to first byte")),
+    ('streaming', ('/html/stream?chunks=20&delay=0.25', "html trickled out over 5 seconds")),
+    ('slow-assets', ('/html/subresources?count=20&asset_delay=2', "20 subresources that each take 2 seconds")),
+    ('iframes', ('/html/iframes?count=5&depth=3', "5 iframes, nested 3 deep")),
+    ('pdf', ('/pdf?size=20000000', "a 20MB pdf")),
+])
+
+
+def query_param(query, key, default, cast=int):
+    return cast(query.get(key, [default])[0])
+
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    """
+        Generate each fixture from its url, so that pages can be sized with query parameters.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        time.sleep(query_param(query, 'delay', 0, float))
+        if url.path == '/html/stream':
+            return self.send_stream(query)
+        if url.path == '/pdf':
+            return self.send_pdf(query_param(query, 'size', 1000000))
+        if url.path.startswith('/asset/'):
+            return self.send_asset(url.path.rsplit('.', 1)[-1], query_param(query, 'size', 0))
+        if url.path.startswith('/html/'):
+            body = self.html_body(url.path[len('/html/'):], query)
+            if body is not None:
+                return self.send_body('text/html; charset=utf-8', body.encode('utf-8'))
+        self.send_error(404)
+
+    def html_body(self, page, query):
+        count = query_param(query, 'count', 0)
+        if page in ('simple', 'slow'):
+            body = '<p>Hello.</p>'
+        elif page == 'subresources':
+            # spread requests over the asset types, each with a distinct url
+            delay = query_param(query, 'asset_delay', 0, float)
+            body = ''.join(
+                ['<link rel="stylesheet" href="/asset/%s.css?delay=%s">' % (i, delay) for i in range(0, count, 4)] +
+                ['<script src="/asset/%s.js?delay=%s"></script>' % (i, delay) for i in range(1, count, 4)] +
+                ['<img src="/asset/%s.png?delay=%s&size=20000">' % (i, delay) for i in range(2, count, 4)] +
+                ['<img src="/asset/%s.gif?delay=%s&size=5000">' % (i, delay) for i in range(3, count, 4)])
+        elif page == 'srcset':
+            candidates = query_param(query, 'candidates', 4)
+            body = ''.join(
+                '<img src="/asset/%s.png" srcset="%s">' % (i, ', '.join(
+                    '/asset/%s-%s.png?size=%s %sw' % (i, c, 10000 * (c + 1), 320 * (c + 1)) for c in range(candidates)))
+                for i in range(count))
+            body += '<video src="/asset/video.mp4?size=2000000"></video>'
+        elif page == 'iframes':
+            depth = query_param(query, 'depth', 1)
+            body = '<p>Depth %s.</p><img src="/asset/depth%s.png">' % (depth, depth)
+            if depth > 1:
+                body += ''.join(
+                    '<iframe src="/html/iframes?count=%s&depth=%s&frame=%s"></iframe>' % (min(count, 2), depth - 1, i)
+                    for i in range(count))
+        else:
+            return None
+        return '<!doctype html><html><head><title>%s</title>' \
+               '<meta name="description" content="Benchmark fixture"></head>' \
+               '<body>%s</body></html>' % (page, body)
+
+    def send_body(self, content_type, body):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_asset(self, extension, size):
+        content_type, body = ASSET_TYPES.get(extension, ('application/octet-stream', b''))
+        self.send_body(content_type, body + b' ' * max(0, size - len(body)))
+
+    def send_pdf(self, size):
+        body = b'%PDF-1.4\n' + b'%' * max(0, size - 16) + b'\n%%EOF\n'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/pdf')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        for i in range(0, len(body), 1024 * 1024):
+            self.wfile.write(body[i:i + 1024 * 1024])
+
+    def send_stream(self, query):
+        """ Trickle out an html page with no Content-Length, closing the connection to end it. """
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        self.wfile.write(b'<!doctype html><html><head><title>stream</title></head><body>')
+        for i in range(query_param(query, 'chunks', 10)):
+            time.sleep(query_param(query, 'delay', 0.5, float))
+            self.wfile.write(b'<p>Chunk %d.</p><img src="/asset/chunk%d.png">' % (i, i))
+            self.wfile.flush()
+        self.wfile.write(b'</body></html>')
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def fixture_server(host):
+    """
+        Run the fixture server on an open port for the duration of the block.
+        Yields its base url, at `host`, which should resolve to this machine.
+    """
+    httpd = ThreadingHTTPServer(('', 0), FixtureRequestHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, name="benchmark_fixture_server", daemon=True)
+    thread.start()
+    try:
+        yield "http://%s:%s" % (host, httpd.server_address[1])
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+### MEASUREMENT ###
+
+class CaptureTimer:
+    """
+        Time the phases of each capture by wrapping the functions that run_capture calls
+        between them, and by noting when it reports progress.
+
+        Phases are recorded against the capture running in the current thread, so
+        proxy and browser start-up are only counted for captures that started their own;
+        captures that use warm resources from the pool report zero for those phases.
+    """
+    # phase: (starting progress description, ending progress description)
+    PROGRESS_PHASES = OrderedDict([
+        ('first_byte', ("Fetching target URL", "Checking x-robots-tag directives.")),
+        ('media_fetch', ("Fetching media", "Waiting for post-load requests")),
+    ])
+    PHASES = ['resources', 'proxy_start', 'browser_start', 'first_byte', 'onload', 'media_fetch',
+              'post_load_wait', 'screenshot', 'warc_save', 'total']
+
+    def __init__(self):
+        self.captures = OrderedDict()
+        self.local = threading.local()
+
+    def current(self):
+        guid = getattr(self.local, 'guid', None)
+        return self.captures.get(guid)
+
+    def mark(self, name):
+        capture = self.current()
+        if capture is not None:
+            capture['marks'].setdefault(name, time.time())
+
+    def add_phase(self, name, seconds):
+        capture = self.current()
+        if capture is not None:
+            capture['phases'][name] = capture['phases'].get(name, 0) + seconds
+
+    def timed(self, phase, func):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add_phase(phase, time.time() - start)
+        return wrapper
+
+    @contextmanager
+    def instrument(self):
+        """ Patch perma.tasks for the duration of the block. """
+        def run_capture(capture_job, halt):
+            self.local.guid = capture_job.link_id
+            self.captures[capture_job.link_id] = {'marks': {}, 'phases': {}, 'tracker': None}
+            try:
+                self.timed('total', original_run_capture)(capture_job, halt)
+            finally:
+                self.local.guid = None
+
+        def inc_progress(capture_job, inc, description):
+            self.mark(description)
+            original_inc_progress(capture_job, inc, description)
+
+        def get_post_load_function(current_url):
+            # run_capture asks for this as soon as it's done waiting for the onload event
+            self.mark('onload')
+            return original_get_post_load_function(current_url)
+
+        def start_capture(resources, link, tracker):
+            self.mark('resources_ready')
+            capture = self.current()
+            if capture is not None:
+                capture['tracker'] = tracker
+            return original_start_capture(resources, link, tracker)
+
+        original_run_capture = perma.tasks.run_capture
+        original_inc_progress = perma.tasks.inc_progress
+        original_get_post_load_function = perma.tasks.get_post_load_function
+        original_start_capture = perma.tasks.CaptureResources.start_capture
+        with patch.object(perma.tasks, 'run_capture', run_capture), \
+             patch.object(perma.tasks, 'inc_progress', inc_progress), \
+             patch.object(perma.tasks, 'get_post_load_function', get_post_load_function), \
+             patch.object(perma.tasks.CaptureResources, 'start_capture', start_capture), \
+             patch.object(perma.tasks, 'start_warcprox', self.timed('proxy_start', perma.tasks.start_warcprox)), \
+             patch.object(perma.tasks, 'get_browser', self.timed('browser_start', perma.tasks.get_browser)), \
+             patch.object(perma.tasks, 'get_screenshot', self.timed('screenshot', perma.tasks.get_screenshot)), \
+             patch.object(perma.tasks, 'save_warc', self.timed('warc_save', perma.tasks.save_warc)), \
+             patch.object(perma.tasks, 'run_task', lambda *args, **kwargs: None):  # we run the queue ourselves
+            yield
+
+    def phases(self, guid):
+        """ Seconds spent in each phase of a capture; None for phases the capture never reached. """
+        capture = self.captures[guid]
+        marks = capture['marks']
+        phases = dict.fromkeys(self.PHASES)
+        phases.update(capture['phases'])
+        for phase in ('proxy_start', 'browser_start'):
+            phases[phase] = phases[phase] or 0
+
+        def between(start, end):
+            if start in marks and end in marks:
+                return marks[end] - marks[start]
+
+        phases['resources'] = between("Starting capture", 'resources_ready')
+        for phase, (start, end) in self.PROGRESS_PHASES.items():
+            phases[phase] = between(start, end)
+        phases['onload'] = between("Fetching target URL", 'onload')
+        phases['post_load_wait'] = between("Waiting for post-load requests", "Taking screenshot") or \
+            between("Waiting for post-load requests", "Saving web archive file")
+        return phases
+
+    def recorded_bytes(self, guid):
+        tracker = self.captures[guid]['tracker']
+        return tracker.proxied_responses['size'] if tracker else 0
+
+
+class ResourceSampler:
+    """
+        Sample the number of running threads in the background, and report peak thread count and memory use.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_threads = threading.active_count()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="benchmark_sampler", daemon=True)
+
+    def run(self):
+        while not self.stop.wait(self.interval):
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop.set()
+        self.thread.join()
+
+    def report(self):
+        # ru_maxrss is in kilobytes on Linux; children only counts browsers that have exited
+        return {
+            'peak_threads': self.peak_threads,
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_child_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        }
+
+
+### BENCHMARK ###
+
+def create_capture(user, url):
+    """ Set up a link and capture job the way the API does, minus the url validation. """
+    link = Link(created_by=user, submitted_url=url)
+    link.save()
+    Capture(link=link, role='primary', status='pending', record_type='response', url=link.submitted_url).save()
+    Capture(link=link, role='screenshot', status='pending', record_type='resource',
+            url="file:///%s/cap.png" % link.guid, content_type='image/png').save()
+    capture_job = CaptureJob(created_by=user, link=link, human=True, status='pending', submitted_url=url)
+    capture_job.save()
+    return capture_job
+
+
+def run_capture_benchmark(page_names=None, repeat=1, user_email='test_user@example.com', host='perma.test',
+                          keep_links=False, **capture_settings):
+    """
+        Capture each of the named FIXTURE_PAGES `repeat` times, and return a report of the results.
+        Any capture_settings, like CAPTURE_BROWSER='Chrome' or CAPTURE_CONCURRENCY=4, override settings for the run.
+
+        Captures run through the real queue, so this refuses to start if other jobs are waiting.
+    """
+    if CaptureJob.objects.filter(status__in=['pending', 'in_progress']).exists():
+        raise Exception("There are capture jobs in the queue; wait for them to finish before benchmarking.")
+    page_names = page_names or list(FIXTURE_PAGES)
+    user = LinkUser.objects.get(email=user_email)
+    timer = CaptureTimer()
+
+    with override_settings(**capture_settings), fixture_server(host) as base_url, ResourceSampler() as sampler:
+        browser = settings.CAPTURE_BROWSER
+        capture_jobs = [create_capture(user, base_url + FIXTURE_PAGES[name][0]) for _ in range(repeat) for name in page_names]
+        start_time = time.time()
+        try:
+            with timer.instrument():
+                while CaptureJob.objects.filter(pk__in=[job.pk for job in capture_jobs], status='pending').exists():
+                    perma.tasks.run_next_capture()
+        finally:
+            perma.tasks.capture_pool.shutdown()
+        wall_time = time.time() - start_time
+
+    captures = []
+    for name, capture_job in zip(page_names * repeat, capture_jobs):
+        capture_job.refresh_from_db()
+        link = Link.objects.get(guid=capture_job.link_id)
+        captures.append(OrderedDict([
+            ('page', name),
+            ('guid', link.guid),
+            ('status', capture_job.status),
+            ('primary_capture', link.primary_capture.status),
+            ('screenshot_capture', link.screenshot_capture.status),
+            ('recorded_bytes', timer.recorded_bytes(link.guid) if link.guid in timer.captures else 0),
+            ('warc_size', link.warc_size),
+            ('phases', timer.phases(link.guid) if link.guid in timer.captures else {}),
+        ]))
+        if not keep_links:
+            link.delete_related_captures()
+            link.safe_delete()
+            link.save()
+
+    return OrderedDict([
+        ('browser', browser),
+        ('settings', capture_settings),
+        ('wall_time', wall_time),
+        ('process', sampler.report()),
+        ('captures', captures),
+    ])
+
+
+def format_report(report):
+    """ Render a report from run_capture_benchmark as a table, one capture per row. """
+    def seconds(value):
+        return '-' if value is None else '%.2f' % value
+
+    columns = ['page', 'status', 'bytes'] + CaptureTimer.PHASES
+    rows = [columns]
+    for capture in report['captures']:
+        phases = capture['phases']
+        rows.append([capture['page'], capture['status'], str(capture['warc_size'] or capture['recorded_bytes'])] +
+                    [seconds(phases.get(phase)) for phase in CaptureTimer.PHASES])
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    lines = ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows]
+    lines.append('')
+    lines.append('browser: %s  settings: %s' % (report['browser'], json.dumps(report['settings'])))
+    lines.append('wall time: %.2fs  peak threads: %s  peak rss: %.1fMB (exited children: %.1fMB)' % (
+        report['wall_time'],
+        report['process']['peak_threads'],
+        report['process']['peak_rss_mb'],
+        report['process']['peak_child_rss_mb']))
+    return '\n'.join(lines)
+
+
+def run_enqueue_benchmark(pending_counts=(0, 1000, 5000, 10000), samples=100, users=20):
+    """
+        Time CaptureJob.save for new jobs with `pending_counts` jobs already waiting, and return a report.
+        Half the sampled jobs belong to users with jobs in the queue, and half to users without.
+
+        The queue is filled round robin across up to `users` existing users, and everything is rolled back afterward.
+    """
+    users = list(LinkUser.objects.order_by('pk')[:users])
+    if len(users) < 2:
+        raise Exception("Need at least two users to benchmark the queue.")
+    queued_users, other_users = users[:len(users) // 2], users[len(users) // 2:]
+
+    results = []
+    with transaction.atomic():
+        for pending_count in sorted(pending_counts):
+            # top up the queue: one job per queued user per round, after anything already waiting
+            already_pending = CaptureJob.objects.filter(status='pending', lane='interactive').count()
+            first_round = int(CaptureJob.objects.filter(lane='interactive').aggregate(Max('order'))['order__max'] or 0) + 1
+            CaptureJob.objects.bulk_create(
+                CaptureJob(created_by=queued_users[i % len(queued_users)], human=True, lane='interactive', status='pending',
+                           order=first_round + i // len(queued_users))
+                for i in range(max(0, pending_count - already_pending)))
+
+            timings = []
+            queries = []
+            for i in range(samples):
+                group = queued_users if i % 2 else other_users
+                user = group[i // 2 % len(group)]
+                capture_job = CaptureJob(created_by=user, human=True, status='invalid')  # don't grow the queue
+                with CaptureQueriesContext(connection) as context:
+                    start = time.time()
+                    capture_job.save()
+                    timings.append(time.time() - start)
+                queries.append(len(context.captured_queries))
+            results.append(OrderedDict([
+                ('pending', CaptureJob.objects.filter(status='pending', lane='interactive').count()),
+                ('mean_ms', 1000 * sum(timings) / len(timings)),
+                ('max_ms', 1000 * max(timings)),
+                ('queries', max(queries)),
+            ]))
+        transaction.set_rollback(True)
+    return results
+
+
+def format_enqueue_report(results):
+    lines = ['pending  mean_ms  max_ms  queries']
+    for result in results:
+        lines.append('%7d  %7.2f  %6.2f  %7d' % (result['pending'], result['mean_ms'], result['max_ms'], result['queries']))
+    return '\n'.join(lines)
@@ -0,0 +1,227 @@
+import bisect
+from datetime import timedelta
+
+from django.core.cache import cache as django_cache
+from django.utils import timezone
+
+#
+# Histograms of how long each phase of a capture takes, and counts of how captures turn out,
+# kept as counters in the cache so that every worker adds to the same figures.
+#
+# Each capture is counted twice: in running totals, which never expire and are exported for Prometheus
+# by perma.views.service.capture_metrics, and in totals for the day, which are kept for DAY_RETENTION
+# and read by the admin stats page.
+#
+# Calls to the Webrecorder API are timed the same way, in running totals only.
+#
+
+CAPTURE_PHASES = (
+    'queue_wait',       # from link creation to the start of the capture
+    'proxy_start',      # starting warcprox (0 when a warm one is reused)
+    'browser_start',    # starting the browser (likewise)
+    'first_response',   # from asking the browser for the page to warcprox recording a response
+    'onload',           # from asking the browser for the page to its onload event
+    'post_load_wait',   # waiting for requests still in flight after onload
+    'screenshot',
+    'save',             # writing the warc to storage and recording the results
+    'total',            # the whole capture, not counting queue_wait
+)
+CAPTURE_STATUSES = ('completed', 'failed', 'deleted')
+HISTOGRAM_BUCKETS = (.1, .25, .5, 1, 2.5, 5, 10, 15, 30, 60, 120, 300, 600, 1800, 3600)  # seconds; upper bounds
+DAY_RETENTION = timedelta(days=31)
+
+WR_API_CALLS = ('POST /auth', 'PUT /upload', 'GET /upload', 'DELETE /collection', 'DELETE /user', 'other')
+WR_API_OUTCOMES = (
+    'ok',
+    'invalid',          # WR answered, but not as expected
+    'unreachable',      # no answer from WR, even after retrying
+)
+
+ALL_TIME = 'all'
+
+
+def metrics_key(slot, *parts):
+    return 'capture-metrics-{}-{}'.format(slot, '-'.join(str(part) for part in parts))
+
+def day_slot(date):
+    return date.isoformat()
+
+def incr(key, delta, timeout):
+    """ Add `delta` to the counter at `key`, creating it if need be. """
+    try:
+        django_cache.incr(key, delta)
+    except ValueError:
+        # the key doesn't exist yet -- unless another worker has just created it
+        if not django_cache.add(key, delta, timeout):
+            django_cache.incr(key, delta)
+
+
+def record_capture(timings, status):
+    """
+        Count a finished capture: `timings` maps phases (from CAPTURE_PHASES) to the seconds they took,
+        and `status` is the capture job's final status.
+    """
+    slots = [(ALL_TIME, None), (day_slot(timezone.now().date()), int(DAY_RETENTION.total_seconds()))]
+    for slot, timeout in slots:
+        incr(metrics_key(slot, 'status', status), 1, timeout)
+        for phase, seconds in timings.items():
+            if seconds is None:
+                continue
+            # observations go in the first bucket whose upper bound they don't exceed, or the overflow bucket
+            incr(metrics_key(slot, phase, bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)), 1, timeout)
+            incr(metrics_key(slot, phase, 'sum'), int(seconds * 1000), timeout)
+
+
+def load_capture_metrics(slots=(ALL_TIME,)):
+    """
+        Return the figures recorded in the given slots, added together, as
+            {
+                'statuses': {status: count},
+                'phases': {phase: {'buckets': [count per bucket, with the overflow bucket last], 'sum': seconds, 'count': n}},
+            }
+    """
+    keys = []
+    for slot in slots:
+        keys += [metrics_key(slot, 'status', status) for status in CAPTURE_STATUSES]
+        for phase in CAPTURE_PHASES:
+            keys += [metrics_key(slot, phase, bucket) for bucket in range(len(HISTOGRAM_BUCKETS) + 1)]
+            keys.append(metrics_key(slot, phase, 'sum'))
+    values = django_cache.get_many(keys)
+
+    out = {
+        'statuses': {status: sum(values.get(metrics_key(slot, 'status', status), 0) for slot in slots) for status in CAPTURE_STATUSES},
+        'phases': {},
+    }
+    for phase in CAPTURE_PHASES:
+        buckets = [sum(values.get(metrics_key(slot, phase, bucket), 0) for slot in slots) for bucket in range(len(HISTOGRAM_BUCKETS) + 1)]
+        out['phases'][phase] = {
+            'buckets': buckets,
+            'sum': sum(values.get(metrics_key(slot, phase, 'sum'), 0) for slot in slots) / 1000,
+            'count': sum(buckets),
+        }
+    return out
+
+def load_daily_capture_metrics(days_ago):
+    """ load_capture_metrics() for the day `days_ago` days back (0 for today). """
+    return load_capture_metrics([day_slot((timezone.now() - timedelta(days=days_ago)).date())])
+
+
+def histogram_percentile(buckets, percentile):
+    """
+        Return the upper bound of the bucket containing the given percentile (0 to 1) of a histogram from
+        load_capture_metrics(), float('inf') if that's the overflow bucket, or None if the histogram is empty.
+    """
+    count = sum(buckets)
+    if not count:
+        return None
+    seen = 0
+    for bucket, bucket_count in enumerate(buckets):
+        seen += bucket_count
+        if seen >= percentile * count:
+            break
+    return HISTOGRAM_BUCKETS[bucket] if bucket < len(HISTOGRAM_BUCKETS) else float('inf')
+
+def format_percentiles(buckets, percentiles=(.05, .5, .95)):
+    """ Format percentiles of a histogram for the stats page, like '0:00:05 / 0:00:15 / 0:01:00', or '-' if it's empty. """
+    bounds = [histogram_percentile(buckets, percentile) for percentile in percentiles]
+    if bounds[0] is None:
+        return '-'
+    return " / ".join('>{}'.format(timedelta(seconds=HISTOGRAM_BUCKETS[-1])) if bound == float('inf') else str(timedelta(seconds=bound)) for bound in bounds)
+
+
+def wr_api_call_name(method, path):
+    """ Name a WR API call for WR_API_CALLS by its method and the first part of its path: 'GET /upload/ABC?user=x' is 'GET /upload'. """
+    name = '{} /{}'.format(method.upper(), path.split('?')[0].strip('/').split('/')[0])
+    return name if name in WR_API_CALLS else 'other'
+
+def record_wr_api_call(call, seconds, outcome, retries):
+    """ Count a call to the WR API, named by wr_api_call_name(), that took `seconds` in all, including `retries`. """
+    incr(metrics_key(ALL_TIME, 'wr', call, bisect.bisect_left(HISTOGRAM_BUCKETS, seconds)), 1, None)
+    incr(metrics_key(ALL_TIME, 'wr', call, 'sum'), int(seconds * 1000), None)
+    incr(metrics_key(ALL_TIME, 'wr', call, outcome), 1, None)
+    if retries:
+        incr(metrics_key(ALL_TIME, 'wr', call, 'retries'), retries, None)
+
+def load_wr_api_metrics():
+    """
+        Return the running totals for WR API calls, as
+            {call: {'buckets': [...], 'sum': seconds, 'count': n, 'outcomes': {outcome: count}, 'retries': n}}
+    """
+    keys = []
+    for call in WR_API_CALLS:
+        keys += [metrics_key(ALL_TIME, 'wr', call, bucket) for bucket in range(len(HISTOGRAM_BUCKETS) + 1)]
+        keys += [metrics_key(ALL_TIME, 'wr', call, part) for part in ('sum', 'retries') + WR_API_OUTCOMES]
+    values = django_cache.get_many(keys)
+
+    out = {}
+    for call in WR_API_CALLS:
+        buckets = [values.get(metrics_key(ALL_TIME, 'wr', call, bucket), 0) for bucket in range(len(HISTOGRAM_BUCKETS) + 1)]
+        out[call] = {
+            'buckets': buckets,
+            'sum': values.get(metrics_key(ALL_TIME, 'wr', call, 'sum'), 0) / 1000,
+            'count': sum(buckets),
+            'outcomes': {outcome: values.get(metrics_key(ALL_TIME, 'wr', call, outcome), 0) for outcome in WR_API_OUTCOMES},
+            'retries': values.get(metrics_key(ALL_TIME, 'wr', call, 'retries'), 0),
+        }
+    return out
+
+
+def prometheus_text(metrics, queue_depths):
+    """
+        Render load_capture_metrics() running totals, and the number of jobs waiting in each lane,
+        in the Prometheus text exposition format.
+    """
+    lines = [
+        '# HELP perma_capture_phase_seconds Time taken by each phase of a capture.',
+        '# TYPE perma_capture_phase_seconds histogram',
+    ]
+    for phase in CAPTURE_PHASES:
+        histogram = metrics['phases'][phase]
+        cumulative = 0
+        for bound, bucket_count in zip(list(HISTOGRAM_BUCKETS) + ['+Inf'], histogram['buckets']):
+            cumulative += bucket_count
+            lines.append('perma_capture_phase_seconds_bucket{phase="%s",le="%s"} %d' % (phase, bound, cumulative))
+        lines.append('perma_capture_phase_seconds_sum{phase="%s"} %s' % (phase, histogram['sum']))
+        lines.append('perma_capture_phase_seconds_count{phase="%s"} %d' % (phase, histogram['count']))
+    lines += [
+        '# HELP perma_captures_total Captures finished, by the capture job\'s final status.',
+        '# TYPE perma_captures_total counter',
+    ]
+    for status in CAPTURE_STATUSES:
+        lines.append('perma_captures_total{status="%s"} %d' % (status, metrics['statuses'][status]))
+    lines += [
+        '# HELP perma_capture_queue_depth Capture jobs waiting, by lane.',
+        '# TYPE perma_capture_queue_depth gauge',
+    ]
+    for lane, depth in queue_depths.items():
+        lines.append('perma_capture_queue_depth{lane="%s"} %d' % (lane, depth))
+    return '\n'.join(lines) + '\n'
+
+def wr_api_prometheus_text(wr_api_metrics):
+    """ Render load_wr_api_metrics() in the Prometheus text exposition format. """
+    lines = [
+        '# HELP perma_wr_api_seconds Time taken by calls to the Webrecorder API, including retries.',
+        '# TYPE perma_wr_api_seconds histogram',
+    ]
+    for call in WR_API_CALLS:
+        histogram = wr_api_metrics[call]
+        cumulative = 0
+        for bound, bucket_count in zip(list(HISTOGRAM_BUCKETS) + ['+Inf'], histogram['buckets']):
+            cumulative += bucket_count
+            lines.append('perma_wr_api_seconds_bucket{call="%s",le="%s"} %d' % (call, bound, cumulative))
+        lines.append('perma_wr_api_seconds_sum{call="%s"} %s' % (call, histogram['sum']))
+        lines.append('perma_wr_api_seconds_count{call="%s"} %d' % (call, histogram['count']))
+    lines += [
+        '# HELP perma_wr_api_calls_total Calls to the Webrecorder API, by outcome.',
+        '# TYPE perma_wr_api_calls_total counter',
+    ]
+    for call in WR_API_CALLS:
+        for outcome in WR_API_OUTCOMES:
+            lines.append('perma_wr_api_calls_total{call="%s",outcome="%s"} %d' % (call, outcome, wr_api_metrics[call]['outcomes'][outcome]))
+    lines += [
+        '# HELP perma_wr_api_retries_total Retries of calls to the Webrecorder API.',
+        '# TYPE perma_wr_api_retries_total counter',
+    ]
+    for call in WR_API_CALLS:
+        lines.append('perma_wr_api_retries_total{call="%s"} %d' % (call, wr_api_metrics[call]['retries']))
+    return '\n'.join(lines) + '\n'
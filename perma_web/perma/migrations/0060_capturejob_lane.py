@@ -0,0 +1,39 @@
+# Generated by Django 2.2.12 on 2020-06-08 12:00
+
+from django.db import migrations, models
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def set_lanes(apps, schema_editor):
+    CaptureJob = apps.get_model('perma', 'CaptureJob')
+    batch = CaptureJob.objects.filter(link_batch__isnull=False).update(lane='batch')
+    interactive = CaptureJob.objects.filter(link_batch__isnull=True, human=True).update(lane='interactive')
+    api = CaptureJob.objects.filter(link_batch__isnull=True, human=False).update(lane='api')
+    logger.info(f"Updated {batch} batch, {interactive} interactive, and {api} api CaptureJobs")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('perma', '0059_auto_20200513_1925'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='capturejob',
+            name='lane',
+            field=models.CharField(choices=[('interactive', 'interactive'), ('api', 'api'), ('batch', 'batch')], default='', help_text='The queue this job waits in; see CAPTURE_QUEUE_LANE_WEIGHTS', max_length=15),
+            preserve_default=False,
+        ),
+        migrations.RunPython(set_lanes, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='capturejob',
+            index=models.Index(fields=['status', 'lane', 'order'], name='capturejob_lane_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='capturejob',
+            index=models.Index(fields=['created_by', 'status', 'lane', 'order'], name='capturejob_user_lane_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.12 on 2020-06-10 12:00
+
+from urllib.parse import urlparse
+
+from django.db import migrations, models
+import requests
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def set_hosts(apps, schema_editor):
+    # only jobs still waiting are scheduled by host
+    CaptureJob = apps.get_model('perma', 'CaptureJob')
+    updated = 0
+    for capture_job in CaptureJob.objects.filter(status__in=['pending', 'in_progress']).select_related('link'):
+        url = capture_job.link.submitted_url if capture_job.link else capture_job.submitted_url
+        capture_job.host = urlparse(requests.utils.requote_uri(url)).netloc.lower()[:255]
+        capture_job.save(update_fields=['host'])
+        updated += 1
+    logger.info(f"Updated {updated} CaptureJobs")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('perma', '0060_capturejob_lane'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='capturejob',
+            name='host',
+            field=models.CharField(blank=True, default='', help_text='The host the capture will fetch from, for spreading load across sites', max_length=255),
+        ),
+        migrations.RunPython(set_hosts, migrations.RunPython.noop),
+    ]
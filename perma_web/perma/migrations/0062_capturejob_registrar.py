@@ -0,0 +1,37 @@
+# Generated by Django 2.2.12 on 2020-06-24 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def set_registrars(apps, schema_editor):
+    # only jobs still waiting are held back by registrar
+    CaptureJob = apps.get_model('perma', 'CaptureJob')
+    updated = 0
+    for capture_job in CaptureJob.objects.filter(status__in=['pending', 'in_progress']).select_related('link__organization', 'created_by'):
+        if capture_job.link and capture_job.link.organization:
+            capture_job.registrar_id = capture_job.link.organization.registrar_id
+        else:
+            capture_job.registrar_id = capture_job.created_by.registrar_id
+        capture_job.save(update_fields=['registrar'])
+        updated += 1
+    logger.info(f"Updated {updated} CaptureJobs")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('perma', '0061_capturejob_host'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='capturejob',
+            name='registrar',
+            field=models.ForeignKey(blank=True, help_text='The registrar whose in-flight cap applies; see CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_REGISTRAR', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='capture_jobs', to='perma.Registrar'),
+        ),
+        migrations.RunPython(set_registrars, migrations.RunPython.noop),
+    ]
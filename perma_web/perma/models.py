@@ -1,8 +1,10 @@
 import calendar
+from collections import Counter, OrderedDict
 from decimal import Decimal
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import hashlib
+import itertools
 import json
 import os
 import logging
@@ -12,27 +14,32 @@ import socket
 from urllib.parse import urlparse
 import simple_history
 import requests
-import itertools
+from requests.structures import CaseInsensitiveDict
+import math
 import time
 import hmac
 import uuid
 
 from mptt.managers import TreeManager
+from redis.exceptions import RedisError
 from rest_framework.settings import api_settings
 from simple_history.models import HistoricalRecords
+from simple_history.utils import bulk_create_with_history
 
 import django.contrib.auth.models
 from django.contrib.auth.models import BaseUserManager, AbstractBaseUser
 from django.conf import settings
+from django.core.cache import cache as django_cache
 from django.core.files.storage import default_storage
-from django.db import models
-from django.db.models import Q, Max, Count
+from django.db import connection, models, transaction
+from django.db.models import Q, F, Max, Min, Count
 from django.db.models.functions import Now
 from django.db.models.query import QuerySet
 from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.utils.functional import cached_property
 from django.views.decorators.debug import sensitive_variables
+from django_redis import get_redis_connection
 from mptt.models import MPTTModel, TreeForeignKey
 from model_utils import FieldTracker
 import surt
@@ -43,9 +50,9 @@ from .exceptions import PermaPaymentsCommunicationException, InvalidTransmission
 from .utils import (tz_datetime,
     prep_for_perma_payments, process_perma_payments_transmission,
     pp_date_from_post,
-    first_day_of_next_month, today_next_year, preserve_perma_warc,
-    write_resource_record_from_asset, get_wr_session_cookie,
-    clear_wr_session, query_wr_api)
+    first_day_of_next_month, today_next_year, preserve_perma_warc, index_warc,
+    write_resource_record_from_asset, get_wr_session_cookie, WR_PUBLIC_SESSION_CACHE_KEY,
+    clear_wr_session, query_wr_api, cache_url_check, cache_is_shared, ip_in_allowed_ip_range)
 
 
 logger = logging.getLogger(__name__)
@@ -1239,30 +1246,68 @@ class Link(DeletableModel):
 
     @cached_property
     def ip(self):
-        try:
-            return socket.gethostbyname(self.url_details.netloc.split(':')[0])
-        except socket.gaierror:
-            return False
+        """ The IP the url's domain resolves to, or False. Cached across links; see cache_url_check. """
+        hostname = self.url_details.netloc.split(':')[0]
+        def resolve():
+            try:
+                return socket.gethostbyname(hostname)
+            except socket.gaierror:
+                return False
+        return cache_url_check('ip-' + hostname, resolve)
 
     @cached_property
     def headers(self):
+        """
+            The url's response headers, or False if it couldn't be loaded. Cached across links; see cache_url_check.
+            Raises TooManyRedirects if the url redirects in a loop.
+        """
+        def load_headers():
+            try:
+                with requests.Session() as s:
+                    request = requests.Request(
+                        'GET',
+                        self.ascii_safe_url,
+                        headers={'User-Agent': settings.CAPTURE_USER_AGENT, **settings.CAPTURE_HEADERS}
+                    )
+                    response = s.send(
+                        request.prepare(),
+                        verify=False,  # don't check SSL cert?
+                        timeout=settings.RESOURCE_LOAD_TIMEOUT,
+                        stream=True  # we're only looking at the headers
+                    )
+                    response.close()
+                    return dict(response.headers)
+            except requests.TooManyRedirects:
+                return 'redirect-loop'  # truthy, so it's cached like any other answer
+            except (requests.ConnectionError, requests.Timeout):
+                return False
+        headers = cache_url_check('headers-' + self.ascii_safe_url, load_headers)
+        if headers == 'redirect-loop':
+            raise requests.TooManyRedirects
+        return CaseInsensitiveDict(headers) if headers else False
+
+    def get_url_error(self):
+        """
+            Check that the url can be captured: that its domain resolves to an allowed IP, and that it loads,
+            and isn't obviously too large. Returns an error message, or None.
+        """
         try:
-            with requests.Session() as s:
-                request = requests.Request(
-                    'GET',
-                    self.ascii_safe_url,
-                    headers={'User-Agent': settings.CAPTURE_USER_AGENT, **settings.CAPTURE_HEADERS}
-                )
-                response = s.send(
-                    request.prepare(),
-                    verify=False,  # don't check SSL cert?
-                    timeout=settings.RESOURCE_LOAD_TIMEOUT,
-                    stream=True  # we're only looking at the headers
-                )
-                response.close()
-                return response.headers
-        except (requests.ConnectionError, requests.Timeout):
-            return False
+            if not self.ip:
+                return "Couldn't resolve domain."
+            if not ip_in_allowed_ip_range(self.ip):
+                return "Not a valid IP."
+            if not self.headers:
+                return "Couldn't load URL."
+            # preemptively reject URLs that report a size over settings.MAX_ARCHIVE_FILE_SIZE
+            try:
+                if int(self.headers.get('content-length', 0)) > settings.MAX_ARCHIVE_FILE_SIZE:
+                    return "Target page is too large (max size %sMB)." % (settings.MAX_ARCHIVE_FILE_SIZE / 1024 / 1024)
+            except ValueError:
+                # content-length header wasn't an integer. Carry on.
+                pass
+        except requests.TooManyRedirects:
+            return "URL caused a redirect loop."
+        return None
 
     def get_default_title(self):
         return self.url_details.netloc
@@ -1279,25 +1324,7 @@ class Link(DeletableModel):
                 self.archive_timestamp = self.creation_timestamp + settings.ARCHIVE_DELAY
             if not kwargs.pop("pregenerated_guid", False):
                 # not self.pk => not created yet
-                # only try 100 attempts at finding an unused GUID
-                # (100 attempts should never be necessary, since we'll expand the keyspace long before
-                # there are frequent collisions)
-                r = random.SystemRandom()
-                for i in range(100):
-                    # Generate an 8-character random string like "1A2B3C4D"
-                    guid = ''.join(r.choice(self.GUID_CHARACTER_SET) for _ in range(8))
-
-                    # apply standard formatting (hyphens)
-                    guid = Link.get_canonical_guid(guid)
-
-                    # Avoid GUIDs starting with four letters (in case we need those later)
-                    match = re.search(r'^[A-Z]{4}', guid)
-
-                    if not match and not Link.objects.filter(guid=guid).exists():
-                        break
-                else:
-                    raise Exception("No valid GUID found in 100 attempts.")
-                self.guid = guid
+                self.guid = Link.generate_guids(1)[0]
 
         if not self.submitted_url_surt:
             self.submitted_url_surt = surt.surt(self.submitted_url)
@@ -1317,6 +1344,69 @@ class Link(DeletableModel):
     def __str__(self):
         return self.guid
 
+    @classmethod
+    def generate_guids(cls, count):
+        """
+            Return `count` distinct GUIDs that aren't in use yet.
+        """
+        r = random.SystemRandom()
+        guids = set()
+        # only try 100 attempts at finding unused GUIDs
+        # (100 attempts should never be necessary, since we'll expand the keyspace long before
+        # there are frequent collisions)
+        for i in range(100):
+            candidates = set()
+            while len(guids) + len(candidates) < count:
+                # Generate an 8-character random string like "1A2B3C4D"
+                guid = ''.join(r.choice(cls.GUID_CHARACTER_SET) for _ in range(8))
+
+                # apply standard formatting (hyphens)
+                guid = cls.get_canonical_guid(guid)
+
+                # Avoid GUIDs starting with four letters (in case we need those later)
+                match = re.search(r'^[A-Z]{4}', guid)
+
+                if not match and guid not in guids:
+                    candidates.add(guid)
+
+            # check all candidates at once
+            guids |= candidates - set(Link.objects.all_with_deleted().filter(guid__in=candidates).values_list('guid', flat=True))
+            if len(guids) == count:
+                return list(guids)
+        raise Exception("No valid GUID found in 100 attempts.")
+
+    @classmethod
+    def bulk_create_in_folder(cls, links, folder):
+        """
+            Save many new links at once, in `folder`: the same as saving each one and then moving it to
+            the folder with move_to_folder_for_user, but in a handful of queries.
+            Links must all be created by the same user.
+        """
+        if not links:
+            return links
+        for link, guid in zip(links, cls.generate_guids(len(links))):
+            # as in save()
+            if not link.submitted_title:
+                link.submitted_title = link.get_default_title()
+            if not link.archive_timestamp:
+                link.archive_timestamp = link.creation_timestamp + settings.ARCHIVE_DELAY
+            link.guid = guid
+            link.submitted_url_surt = surt.surt(link.submitted_url)
+            if link.is_private and not link.private_reason:
+                link.private_reason = 'user'
+            # as in move_to_folder_for_user()
+            link.organization = folder.organization
+
+        bulk_create_with_history(links, cls)
+        cls.folders.through.objects.bulk_create(cls.folders.through(link_id=link.guid, folder_id=folder.pk) for link in links)
+
+        # bulk_create doesn't send the pre_save signal that keeps link counts up to date
+        LinkUser.objects.filter(pk=links[0].created_by_id).update(link_count=F('link_count') + len(links))
+        if folder.organization:
+            Organization.objects.filter(pk=folder.organization_id).update(link_count=F('link_count') + len(links))
+            Registrar.objects.filter(pk=folder.organization.registrar_id).update(link_count=F('link_count') + len(links))
+        return links
+
     @classmethod
     def get_canonical_guid(self, guid):
         """
@@ -1365,6 +1455,26 @@ class Link(DeletableModel):
     def warc_storage_file(self):
         return os.path.join(settings.WARC_STORAGE_DIR, self.guid_as_path(), '%s.warc.gz' % self.guid)
 
+    def cdxj_storage_file(self):
+        return os.path.join(settings.WARC_STORAGE_DIR, self.guid_as_path(), '%s.cdxj' % self.guid)
+
+    def pages_storage_file(self):
+        return os.path.join(settings.WARC_STORAGE_DIR, self.guid_as_path(), '%s.pages.json' % self.guid)
+
+    def write_warc_index(self):
+        """
+            Write a CDXJ index and page list for the link's warc alongside it in storage,
+            so that they can be loaded for playback instead of rescanning the warc.
+            Run in the background by tasks.write_warc_index, once the warc is finished.
+        """
+        warc_path = self.warc_storage_file()
+        with default_storage.open(warc_path) as warc_file:
+            index, pages = index_warc(warc_file, os.path.basename(warc_path))
+        with default_storage.stream_to_file(self.cdxj_storage_file()) as cdxj_file:
+            cdxj_file.write(''.join(line + '\n' for line in index).encode('utf-8'))
+        with default_storage.stream_to_file(self.pages_storage_file()) as pages_file:
+            pages_file.write(json.dumps(pages).encode('utf-8'))
+
     # def get_thumbnail(self, image_data=None):
     #     if self.thumbnail_status == 'failed' or self.thumbnail_status == 'generating':
     #         return None
@@ -1490,6 +1600,10 @@ class Link(DeletableModel):
             with default_storage.open(old_name) as old_file:
                 default_storage.store_file(old_file, new_name)
             default_storage.delete(old_name)
+        # the index describes the old warc
+        for index_file in (self.cdxj_storage_file(), self.pages_storage_file()):
+            if default_storage.exists(index_file):
+                default_storage.delete(index_file)
 
     def accessible_to(self, user):
         return user.can_edit(self)
@@ -1542,39 +1656,46 @@ class Link(DeletableModel):
     def wr_iframe_prefix(self, wr_username):
         return "{}/{}/{}/".format(settings.PLAYBACK_HOST, wr_username, self.wr_collection_slug)
 
-    def init_replay_for_user(self, request):
-        """
-        Set up a Webrecorder collection for playback.
+    @cached_property
+    def wr_replay_ready_cache_key(self):
+        return 'wr-replay-ready-{}'.format(self.guid)
 
-        Private Perma Links are uploaded to a private, temporary
-        collection (unique per visitor and per GUID) protected by
-        a session cookie (views.common.set_iframe_session_cookie).
+    @cached_property
+    def wr_pending_upload_cache_key(self):
+        return 'wr-pending-upload-{}'.format(self.guid)
 
-        Public Perma Links are uploaded to a public, longer-lived
-        collection belonging to a persistent, Perma-managed WR user
-        (shared by all visitors, to permit caching and reduce churn).
+    def public_replay_ready(self):
+        """
+        Whether the link's warc is known to be loaded into the shared Webrecorder collection,
+        so that playback can start without asking Webrecorder.
+        """
+        return not self.is_private and bool(django_cache.get(self.wr_replay_ready_cache_key))
 
-        If the collection already exists, this method is a no-op.
+    def ensure_wr_login(self, request=None):
+        """
+        Start or resume a Webrecorder session with access to the link's collection, creating it if need be.
+        Returns the WR username, the WR session cookie, and whether the collection is empty.
+
+        Private links use the visitor's own WR session, kept in their Perma session.
+        Public links all belong to WR_PERMA_USER, and share one WR session, kept in the cache.
         """
         json = {
             'title': self.wr_collection_slug,
             'external': True
         }
 
+        # If there's a usable WR session already, reuse it.
+        # If not, WR will start a fresh session and will return
+        # a new cookie.
+        logger.info(f"{self.guid}: Getting cookie")
         if self.is_private:
-            session_key = 'wr_private_session_cookie'
+            wr_session_cookie = get_wr_session_cookie(request, 'wr_private_session_cookie')
         else:
-            session_key = 'wr_public_session_cookie'
+            wr_session_cookie = django_cache.get(WR_PUBLIC_SESSION_CACHE_KEY)
             json['username'] = settings.WR_PERMA_USER
             json['password'] = settings.WR_PERMA_PASSWORD
             json['public'] = True
 
-        # If a visitor has a usable WR session already, reuse it.
-        # If they don't, WR will start a fresh session and will return
-        # a new cookie.
-        logger.info(f"{self.guid}: Getting cookie")
-        wr_session_cookie = get_wr_session_cookie(request, session_key)
-
         logger.info(f"{self.guid}: Getting session")
         response, data = query_wr_api(
             method='post',
@@ -1587,32 +1708,129 @@ class Link(DeletableModel):
         new_session_cookie = response.cookies.get('__wr_sesh')
         if new_session_cookie:
             wr_session_cookie = new_session_cookie
-            request.session[session_key + '_timestamp'] = datetime.utcnow().timestamp()
-            request.session[session_key] = wr_session_cookie
+            if self.is_private:
+                request.session['wr_private_session_cookie_timestamp'] = datetime.utcnow().timestamp()
+                request.session['wr_private_session_cookie'] = wr_session_cookie
+            else:
+                django_cache.set(WR_PUBLIC_SESSION_CACHE_KEY, wr_session_cookie, settings.WR_COOKIE_PERMITTED_AGE)
 
-        # Store the temp username in the session so that we can
-        # force the deletion of this WR user in the future
-        # (e.g. on logout, etc.).
+        return data['username'], wr_session_cookie, data['coll_empty']
+
+    def get_pending_wr_upload(self, request=None):
+        """
+        An upload of the link's warc that WR may not have finished importing, as [upload id, start time]:
+        kept in the visitor's session for private links, and in the cache for public ones.
+        (The upload id is None while warm_replay is getting ready to upload.)
+        """
         if self.is_private:
-            request.session['wr_temp_username'] = data['username']
+            return request.session.get('wr_pending_uploads', {}).get(self.guid)
+        return django_cache.get(self.wr_pending_upload_cache_key)
 
-        if data['coll_empty']:
-            logger.info(f"{self.guid}: Uploading to WR for {data['username']}")
-            try:
-                self.upload_to_wr(data['username'], wr_session_cookie)
-            except WebrecorderException:
-                clear_wr_session(request)
-                raise
+    def set_pending_wr_upload(self, pending_upload, request=None):
+        if self.is_private:
+            pending_uploads = request.session.get('wr_pending_uploads', {})
+            if pending_upload:
+                pending_uploads[self.guid] = pending_upload
+            else:
+                pending_uploads.pop(self.guid, None)
+            request.session['wr_pending_uploads'] = pending_uploads
+        elif pending_upload:
+            django_cache.set(self.wr_pending_upload_cache_key, pending_upload, settings.WR_REPLAY_UPLOAD_TIMEOUT * 2)
+        else:
+            django_cache.delete(self.wr_pending_upload_cache_key)
+
+    def claim_pending_wr_upload(self, request=None):
+        """
+        Mark the link's warc as about to be uploaded, unless someone else has already claimed the upload.
+        Returns whether the claim succeeded. For public links, the claim is made atomically in the cache,
+        so that concurrent playbacks and warm_replay don't upload the same warc twice.
+        If the cache can't be reached, the claim succeeds, so that playback doesn't depend on it.
+        """
+        pending_upload = [None, time.time()]
+        if self.is_private:
+            self.set_pending_wr_upload(pending_upload, request)
+            return True
+        # with IGNORE_EXCEPTIONS, django_redis returns None rather than False when redis is down
+        return django_cache.add(self.wr_pending_upload_cache_key, pending_upload, settings.WR_REPLAY_UPLOAD_TIMEOUT * 2) is not False
 
-        return data['username']
+    def init_replay_for_user(self, request):
+        """
+        Set up a Webrecorder collection for playback.
 
-    def upload_to_wr(self, wr_username, wr_session_cookie):
-        warc_path = self.warc_storage_file()
-        upload_data = None
-        start_time = time.time()
+        Private Perma Links are uploaded to a private, temporary
+        collection (unique per visitor and per GUID) protected by
+        a session cookie (views.common.set_iframe_session_cookie).
+
+        Public Perma Links are uploaded to a public, longer-lived
+        collection belonging to a persistent, Perma-managed WR user
+        (shared by all visitors, to permit caching and reduce churn).
+        Those known to be loaded already don't need to ask WR at all.
 
+        Returns the WR username once the collection is ready. If the warc
+        has to be uploaded, starts the upload and returns None: call again
+        to check whether WR has finished importing it.
+        """
+        if self.public_replay_ready():
+            return settings.WR_PERMA_USER
+
+        wr_username, wr_session_cookie, coll_empty = self.ensure_wr_login(request)
+
+        # Store the temp username in the session so that we can
+        # force the deletion of this WR user in the future
+        # (e.g. on logout, etc.).
+        if self.is_private:
+            request.session['wr_temp_username'] = wr_username
+
+        try:
+            pending_upload = self.get_pending_wr_upload(request)
+            if pending_upload:
+                upload_id, start_time = pending_upload
+                if upload_id is None or not self.wr_upload_done(wr_username, upload_id, wr_session_cookie):
+                    if time.time() - start_time > settings.WR_REPLAY_UPLOAD_TIMEOUT:
+                        raise WebrecorderException("Upload timed out; check Webrecorder logs.")
+                    return None
+                self.set_pending_wr_upload(None, request)
+            elif coll_empty:
+                if not self.claim_pending_wr_upload(request):
+                    # another request is starting the upload
+                    return None
+                logger.info(f"{self.guid}: Uploading to WR for {wr_username}")
+                self.set_pending_wr_upload([self.start_wr_upload(wr_session_cookie), time.time()], request)
+                return None
+        except WebrecorderException:
+            self.set_pending_wr_upload(None, request)
+            if not self.is_private:
+                django_cache.delete(WR_PUBLIC_SESSION_CACHE_KEY)
+            clear_wr_session(request)
+            raise
+
+        if not self.is_private:
+            django_cache.set(self.wr_replay_ready_cache_key, True, settings.WR_PUBLIC_REPLAY_READY_TIMEOUT)
+        return wr_username
+
+    def warm_replay(self):
+        """
+        Load a public link's warc into the shared Webrecorder collection ahead of its first playback.
+        """
+        if self.public_replay_ready() or not self.claim_pending_wr_upload():
+            return
+        try:
+            wr_username, wr_session_cookie, coll_empty = self.ensure_wr_login()
+            if coll_empty:
+                upload_id = self.start_wr_upload(wr_session_cookie)
+                self.set_pending_wr_upload([upload_id, time.time()])
+                self.wait_for_wr_upload(wr_username, upload_id, wr_session_cookie)
+        except WebrecorderException:
+            django_cache.delete(WR_PUBLIC_SESSION_CACHE_KEY)
+            raise
+        finally:
+            self.set_pending_wr_upload(None)
+        django_cache.set(self.wr_replay_ready_cache_key, True, settings.WR_PUBLIC_REPLAY_READY_TIMEOUT)
+
+    def start_wr_upload(self, wr_session_cookie):
+        """ Send the warc to Webrecorder. Returns the upload id, for checking when WR is done importing it. """
         logger.info(f"{self.guid}: opening warc")
-        with default_storage.open(warc_path, 'rb') as warc_file:
+        with default_storage.open(self.warc_storage_file(), 'rb') as warc_file:
             logger.info(f"{self.guid}: making PUT API call")
             _, upload_data = query_wr_api(
                 method='put',
@@ -1621,24 +1839,38 @@ class Link(DeletableModel):
                 cookie=wr_session_cookie,
                 valid_if=lambda code, data: code == 200 and data.get('upload_id')
             )
+        return upload_data['upload_id']
+
+    def wr_upload_done(self, wr_username, upload_id, wr_session_cookie):
+        _, upload_data = query_wr_api(
+            method='get',
+            path='/upload/{upload_id}?user={user}'.format(user=wr_username, upload_id=upload_id),
+            cookie=wr_session_cookie,
+            valid_if=lambda code, data: code == 200)
+        return bool(upload_data.get('done'))
 
-        # wait for WR to finish uploading the WARC
+    def wait_for_wr_upload(self, wr_username, upload_id, wr_session_cookie):
+        start_time = time.time()
         while True:
             logger.info(f"{self.guid}: Waiting for WR to be ready.")
             if time.time() - start_time > settings.WR_REPLAY_UPLOAD_TIMEOUT:
                 raise WebrecorderException("Upload timed out; check Webrecorder logs.")
-
-            _, upload_data = query_wr_api(
-                method='get',
-                path='/upload/{upload_id}?user={user}'.format(user=wr_username, upload_id=upload_data.get('upload_id')),
-                cookie=wr_session_cookie,
-                valid_if=lambda code, data: code == 200)
-
-            if upload_data.get('done'):
+            if self.wr_upload_done(wr_username, upload_id, wr_session_cookie):
                 break
-
             time.sleep(0.5)
 
+    def reset_public_replay(self):
+        """
+        Forget any upload of a public link's warc to the shared Webrecorder collection, and remove it
+        from the collection, so that the next playback loads the current warc. For warcs that change
+        after they may have been played back, as when a deferred screenshot is added to them.
+        (Private links are played back from short-lived, per-visitor collections, and aren't affected.)
+        """
+        if self.is_private:
+            return
+        django_cache.delete_many([self.wr_replay_ready_cache_key, self.wr_pending_upload_cache_key])
+        self.delete_from_wr(None)
+
     def delete_from_wr(self, request):
         """
         In general, it should not be necessary to manually delete
@@ -1648,6 +1880,7 @@ class Link(DeletableModel):
         playback of the up-to-date warc. This should only happen
         when a user is "replacing" a capture.
         """
+        django_cache.delete(self.wr_replay_ready_cache_key)
         if self.is_private:
             user = request.session.get('wr_temp_username')
             cookie = request.session.get('wr_private_session_cookie')
@@ -1732,8 +1965,13 @@ class CaptureJob(models.Model):
                               db_index=True)
     message = models.TextField(null=True, blank=True) #if we move to postgres, can be a json field
     human = models.BooleanField(default=False)
+    lane = models.CharField(max_length=15,
+                            choices=(('interactive','interactive'),('api','api'),('batch','batch')),
+                            help_text='The queue this job waits in; see CAPTURE_QUEUE_LANE_WEIGHTS')
     order = models.FloatField(db_index=True)
     submitted_url = models.CharField(max_length=2100, blank=True, null=False)
+    host = models.CharField(max_length=255, blank=True, default='', help_text='The host the capture will fetch from, for spreading load across sites')
+    registrar = models.ForeignKey(Registrar, blank=True, null=True, related_name='capture_jobs', on_delete=models.SET_NULL, help_text='The registrar whose in-flight cap applies; see CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_REGISTRAR')
     created_by = models.ForeignKey(LinkUser, blank=False, null=False, related_name='capture_jobs', on_delete=models.CASCADE)
     link_batch = models.ForeignKey('LinkBatch', blank=True, null=True, related_name='capture_jobs', on_delete=models.CASCADE)
 
@@ -1750,105 +1988,492 @@ class CaptureJob(models.Model):
     TEST_PAUSE_TIME = 0
     TEST_ALLOW_RACE = False
 
+    PROGRESS_CACHE_TIMEOUT = 60 * 60  # seconds; comfortably longer than any capture can run
+    QUEUE_INDEX_KEY = 'capture-job-queue-{}'  # a Redis sorted set per lane; see update_queue_index()
+    QUEUE_INDEX_BUILT_KEY = 'capture-job-queue-built'
+    LANE_CREDITS_CACHE_KEY = 'capture-job-lane-credits'
+    PRIORITY_LANES = ('interactive',)  # served before the others whenever they have jobs waiting
+    HOST_BACKOFF_CACHE_KEY = 'capture-host-backoff'
+
+    class Meta:
+        indexes = [
+            # for placing new jobs in the queue
+            models.Index(fields=['status', 'lane', 'order'], name='capturejob_lane_queue_idx'),
+            models.Index(fields=['created_by', 'status', 'lane', 'order'], name='capturejob_user_lane_idx'),
+        ]
+
     def __str__(self):
         return u"CaptureJob %s: %s" % (self.pk, self.link_id)
 
     def save(self, *args, **kwargs):
 
-        # If this job does not have an order yet (just created),
-        # examine all pending jobs to place this one in a fair position in the queue.
-        # "Fair" means round robin: this job will be processed after every other job submitted by this user,
-        # and then after every other user waiting in line has had at least one job done.
+        # If this job does not have an order yet (just created), place it in a fair position in the queue.
+        if not self.lane:
+            self.lane = self.default_lane()
+        if not self.host:
+            self.host = self.target_host()
+        if not self.registrar_id:
+            self.registrar_id = self.target_registrar_id()
         if not self.order:
+            self.order = CaptureJob.next_order(self.created_by_id, self.lane)
 
-            # get all pending jobs, in reverse priority order
-            pending_jobs = CaptureJob.objects.filter(status='pending', human=self.human).order_by('-order').select_related('link')
-            # narrow down to just the jobs that come *after* the most recent job submitted by this user
-            pending_jobs = list(itertools.takewhile(lambda x: x.created_by_id != self.created_by_id, pending_jobs))
-            # flip the list of jobs back around to the order they'll be processed in
-            pending_jobs = list(reversed(pending_jobs))
-
-            # Go through pending jobs until we find two jobs submitted by the same user.
-            # It's not fair for another user to run two jobs after all of ours are done,
-            # so this new job should come right before that user's second job.
-            next_jobs = {}
-            last_job = None
-            for pending_job in pending_jobs:
-                pending_job_created_by_id = pending_job.link.created_by_id
-                if pending_job_created_by_id in next_jobs:
-                    # pending_job is the other user's second job, so this one goes in between that and last_job
-                    self.order = last_job.order + (pending_job.order - last_job.order)/2
-                    break
-                next_jobs[pending_job_created_by_id] = pending_job
-                last_job = pending_job
+        super(CaptureJob, self).save(*args, **kwargs)
 
-            # If order isn't set yet, that means we should go last. Find the highest current order and add 1.
-            if not self.order:
-                if pending_jobs:
-                    self.order = pending_jobs[-1].order + 1
-                else:
-                    self.order = (CaptureJob.objects.filter(human=self.human).aggregate(Max('order'))['order__max'] or 0) + 1
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'status' in update_fields:
+            if self.status == 'pending':
+                CaptureJob.update_queue_index(add=[self])
+            else:
+                CaptureJob.update_queue_index(remove=[self])
 
-        super(CaptureJob, self).save(*args, **kwargs)
+    def default_lane(self):
+        """
+            Jobs from batches wait in the batch lane, other jobs requested by people in the interactive lane,
+            and everything else submitted through the API in the api lane.
+        """
+        if self.link_batch_id:
+            return 'batch'
+        if self.human:
+            return 'interactive'
+        return 'api'
+
+    def target_host(self):
+        url_details = self.link.url_details if self.link_id else urlparse(requests.utils.requote_uri(self.submitted_url))
+        return url_details.netloc.lower()[:255]
+
+    def target_registrar_id(self):
+        """
+            A job belongs to the registrar of the organization its link is filed under,
+            or else to the registrar of the user who created it.
+        """
+        if self.link_id and self.link.organization_id:
+            return self.link.organization.registrar_id
+        return self.created_by.registrar_id
+
+    @classmethod
+    def next_order(cls, created_by_id, lane):
+        """
+            Return the `order` for a new job from the given user that places it fairly in its lane's queue.
+            "Fair" means round robin: the job will be processed after every other job submitted by this user,
+            and then after every other user waiting in line has had at least one job done.
+
+            The queue is a series of rounds, numbered by the integer part of `order`, with one job per user in each round;
+            jobs in the same round are processed in the order they were submitted. A user's new job goes in the round
+            after their last pending job or, if they have no pending jobs, in the round currently being processed.
+            That takes a couple of indexed lookups, however many jobs are waiting.
+        """
+        pending_jobs = cls.objects.filter(status='pending', lane=lane)
+        last_order = pending_jobs.filter(created_by_id=created_by_id).aggregate(Max('order'))['order__max']
+        if last_order is not None:
+            return math.floor(last_order) + 1
+        current_order = pending_jobs.aggregate(Min('order'))['order__min']
+        if current_order is not None:
+            return max(math.floor(current_order), 1)
+        # nothing waiting: start a new round after every job so far
+        return math.floor(cls.objects.filter(lane=lane).aggregate(Max('order'))['order__max'] or 0) + 1
+
+    @classmethod
+    def bulk_create_in_queue(cls, capture_jobs):
+        """
+            Save many new jobs at once, placing each in the queue just as if they had been saved one after another --
+            except that each user's jobs are taken round robin by target host, so that a batch of urls from a few sites
+            doesn't send all the jobs for one site through the workers at once.
+        """
+        jobs_by_host = OrderedDict()
+        for capture_job in capture_jobs:
+            if not capture_job.lane:
+                capture_job.lane = capture_job.default_lane()
+            if not capture_job.host:
+                capture_job.host = capture_job.target_host()
+            if not capture_job.registrar_id:
+                capture_job.registrar_id = capture_job.target_registrar_id()
+            jobs_by_host.setdefault(capture_job.host, []).append(capture_job)
+
+        next_orders = {}
+        for capture_job in itertools.chain.from_iterable(itertools.zip_longest(*jobs_by_host.values())):
+            if capture_job is None:
+                continue
+            key = (capture_job.created_by_id, capture_job.lane)
+            if key not in next_orders:
+                next_orders[key] = cls.next_order(*key)
+            capture_job.order = next_orders[key]
+            if capture_job.status == 'pending':
+                next_orders[key] = math.floor(capture_job.order) + 1
+        capture_jobs = cls.objects.bulk_create(capture_jobs)
+
+        pending_jobs = [capture_job for capture_job in capture_jobs if capture_job.status == 'pending']
+        if all(capture_job.pk for capture_job in pending_jobs):
+            cls.update_queue_index(add=pending_jobs)
+        else:
+            # the database didn't tell us the new jobs' ids: have the index rebuilt instead
+            cls.invalidate_queue_index()
+        return capture_jobs
+
+    @classmethod
+    def lane_weights(cls):
+        """ The weights of the lanes that take turns by weight: all but the PRIORITY_LANES. """
+        return OrderedDict((lane, settings.CAPTURE_QUEUE_LANE_WEIGHTS[lane]) for lane in cls.lanes() if lane not in cls.PRIORITY_LANES)
+
+    @classmethod
+    def lanes(cls):
+        return [lane for lane, _ in cls._meta.get_field('lane').choices]
+
+    @classmethod
+    def lanes_by_turn(cls, lanes):
+        """
+            Order the given lanes, all with jobs waiting, by whose turn it is to have a job taken from them.
+            Returns the ordered lanes, and the scheduling credits to pass to charge_lane() once a job is claimed.
+
+            The PRIORITY_LANES go first whenever they have jobs waiting, so that people waiting on their links
+            are never slowed down by bulk loads. The other lanes share the remaining capture workers in proportion
+            to CAPTURE_QUEUE_LANE_WEIGHTS, by smooth weighted round robin: every lane with jobs waiting earns its
+            weight in credit, and the lane with the most credit is served and pays back the total. A lane's credit
+            builds up for as long as it's passed over, so every lane with jobs waiting ages into a turn, however
+            busy the others are.
+
+            Credits are kept in the cache and shared by all workers; if workers race to update them, one claim
+            is counted twice or not at all, which shifts the shares slightly until the next turns even it out.
+        """
+        weights = cls.lane_weights()
+        credits = django_cache.get(cls.LANE_CREDITS_CACHE_KEY) or {}
+        weighted_lanes = [lane for lane in weights if lane in lanes]
+        for lane in weighted_lanes:
+            credits[lane] = credits.get(lane, 0) + weights[lane]
+        # ties go to the lane listed first
+        ordered_lanes = [lane for lane in cls.PRIORITY_LANES if lane in lanes] + sorted(weighted_lanes, key=lambda lane: -credits[lane])
+        return ordered_lanes, credits
+
+    @classmethod
+    def charge_lane(cls, lane, lanes, credits):
+        """ Record that a job was taken from `lane`, one of `lanes`, given the credits from lanes_by_turn(). """
+        if lane in cls.PRIORITY_LANES:
+            return
+        weights = cls.lane_weights()
+        credits[lane] -= sum(weights[waiting_lane] for waiting_lane in lanes if waiting_lane in weights)
+        django_cache.set(cls.LANE_CREDITS_CACHE_KEY, credits, None)
+
+    @classmethod
+    def held_back_jobs(cls):
+        """
+            Return a Q matching jobs that should wait for now, or None if there are none:
+
+            - jobs whose user, registrar, or target host already has as many jobs in progress as
+              CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_USER, CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_REGISTRAR,
+              or CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_HOST allow, and
+            - jobs for hosts we're backing off from; see record_host_result().
+
+            Each job's registrar is stored on it when it's created; see target_registrar_id().
+        """
+        user_cap = settings.CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_USER
+        registrar_cap = settings.CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_REGISTRAR
+        host_cap = settings.CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_HOST
+        held_hosts = cls.hosts_backing_off()
+        if not user_cap and not registrar_cap and not host_cap and not held_hosts:
+            return None
+
+        user_counts = Counter()
+        registrar_counts = Counter()
+        host_counts = Counter()
+        if user_cap or registrar_cap or host_cap:
+            in_flight = cls.objects.filter(status='in_progress')
+            for user_id, registrar_id, host in in_flight.values_list('created_by_id', 'registrar_id', 'host'):
+                user_counts[user_id] += 1
+                if registrar_id:
+                    registrar_counts[registrar_id] += 1
+                host_counts[host] += 1
+
+        # only conditions on the job's own columns, so that locking the jobs doesn't lock rows in other tables
+        held = Q(pk__in=[])
+        if user_cap:
+            held |= Q(created_by_id__in=[user_id for user_id, count in user_counts.items() if count >= user_cap])
+        if registrar_cap:
+            held |= Q(registrar_id__in=[registrar_id for registrar_id, count in registrar_counts.items() if count >= registrar_cap])
+        if host_cap:
+            held_hosts += [host for host, count in host_counts.items() if count >= host_cap]
+        if held_hosts:
+            held |= Q(host__in=held_hosts)
+        return held
+
+    @classmethod
+    def hosts_backing_off(cls):
+        now = time.time()
+        return [host for host, (until, failures) in (django_cache.get(cls.HOST_BACKOFF_CACHE_KEY) or {}).items() if until > now]
+
+    @classmethod
+    def record_host_result(cls, host, succeeded):
+        """
+            Record whether a capture from `host` went through. After a capture fails, or the host answers that it's
+            too busy, hold back the host's other jobs for CAPTURE_HOST_BACKOFF seconds, doubling with each failure
+            in a row up to CAPTURE_HOST_MAX_BACKOFF, so we don't keep piling onto a site that's struggling.
+            A successful capture clears the backoff.
+
+            Backoffs are kept in the cache and shared by all workers; races between them only lose a failure
+            or a success here and there.
+        """
+        if not settings.CAPTURE_HOST_BACKOFF or not host:
+            return
+        backoffs = django_cache.get(cls.HOST_BACKOFF_CACHE_KEY) or {}
+        now = time.time()
+        # forget hosts whose last failure is long enough ago that they'd be starting from scratch
+        backoffs = {h: b for h, b in backoffs.items() if b[0] + settings.CAPTURE_HOST_MAX_BACKOFF > now}
+        if succeeded:
+            if host not in backoffs:
+                return
+            del backoffs[host]
+        else:
+            failures = backoffs[host][1] + 1 if host in backoffs else 1
+            delay = min(settings.CAPTURE_HOST_BACKOFF * 2 ** (failures - 1), settings.CAPTURE_HOST_MAX_BACKOFF)
+            backoffs[host] = (now + delay, failures)
+        django_cache.set(cls.HOST_BACKOFF_CACHE_KEY, backoffs, None)
 
     @classmethod
     def get_next_job(cls, reserve=False):
         """
-            Return the next job to work on, looking first at the human queue and then at the robot queue.
+            Return the next job to work on: the next in line in the lane whose turn it is (see lanes_by_turn()),
+            from among the jobs not held back by held_back_jobs().
 
             If `reserve=True`, mark the returned job with `status=in_progress` and remove from queue so the
             same job can't be returned twice. Caller must make sure the job is actually processed once returned.
-        """
-
-        # cleanup: mark any captures as deleted where link has been deleted before capture
-        CaptureJob.objects.filter(link__user_deleted=True, status='pending').update(status='deleted')
 
-        while True:
-            next_job = cls.objects.filter(status='pending').order_by('-human', 'order', 'pk').first()
+            Where the database supports SELECT ... FOR UPDATE SKIP LOCKED, workers reserving jobs at the same time
+            each lock and claim a different job; if all the jobs at the head of a lane are locked by other workers,
+            the next lane in turn is tried. Otherwise, each claims a job with a conditional UPDATE, and tries again
+            if another worker got there first. Either way, a lane is only charged for its turn if a job is claimed.
 
-            if reserve and next_job:
+            (Jobs whose links have been deleted are cleaned out of the queue by clean_up_capture_jobs, and
+            skipped by run_capture if they come up first.)
+        """
+        candidates = cls.objects.filter(status='pending')
+        held = cls.held_back_jobs()
+        if held is not None:
+            candidates = candidates.exclude(held)
+
+        def lanes_by_turn():
+            lanes = set(candidates.order_by().values_list('lane', flat=True).distinct())
+            ordered_lanes, credits = cls.lanes_by_turn(lanes)
+            return lanes, ordered_lanes, credits
+
+        def next_jobs(lane):
+            # fetch database time along with the job, so timeout comparisons will be consistent across worker servers
+            return candidates.filter(lane=lane).order_by('order', 'pk').annotate(db_now=Now())
+
+        if not reserve:
+            ordered_lanes = lanes_by_turn()[1]
+            return next_jobs(ordered_lanes[0]).first() if ordered_lanes else None
+
+        next_job = None
+        if connection.features.has_select_for_update_skip_locked and not cls.TEST_ALLOW_RACE:
+            with transaction.atomic():
+                lanes, ordered_lanes, credits = lanes_by_turn()
+                for lane in ordered_lanes:
+                    next_job = next_jobs(lane).select_for_update(skip_locked=True).first()
+                    if next_job:
+                        break
+                if next_job:
+                    if cls.TEST_PAUSE_TIME:
+                        time.sleep(cls.TEST_PAUSE_TIME)
+                    cls.objects.filter(pk=next_job.pk).update(status='in_progress', capture_start_time=next_job.db_now)
+        else:
+            while True:
+                lanes, ordered_lanes, credits = lanes_by_turn()
+                if not ordered_lanes:
+                    break
+                next_job = next_jobs(ordered_lanes[0]).first()
+                if not next_job:
+                    continue
                 if cls.TEST_PAUSE_TIME:
                     time.sleep(cls.TEST_PAUSE_TIME)
 
                 # update the returned job to be in_progress instead of pending, so it won't be returned again
-                # set time using database time, so timeout comparisons will be consistent across worker servers
-                update_count = CaptureJob.objects.filter(
+                update_count = cls.objects.filter(
                     status='pending',
                     pk=next_job.pk
                 ).update(
                     status='in_progress',
-                    capture_start_time=Now()
+                    capture_start_time=next_job.db_now
                 )
 
                 # if no rows were updated, another worker claimed this job already -- try again
-                if not update_count and not cls.TEST_ALLOW_RACE:
-                    continue
+                if update_count or cls.TEST_ALLOW_RACE:
+                    break
+                next_job = None
+
+        if next_job:
+            cls.charge_lane(next_job.lane, lanes, credits)
+            next_job.status = 'in_progress'
+            next_job.capture_start_time = next_job.db_now
+            cls.update_queue_index(remove=[next_job])
+        return next_job
+
+    @classmethod
+    def clean_up_deleted(cls):
+        """ Mark pending jobs as deleted where the link has been deleted before capture. """
+        deleted_jobs = list(cls.objects.filter(link__user_deleted=True, status='pending').only('pk', 'lane'))
+        count = cls.objects.filter(pk__in=[capture_job.pk for capture_job in deleted_jobs], status='pending').update(status='deleted')
+        cls.update_queue_index(remove=deleted_jobs)
+        return count
+
+    ### queue index ###
+    #
+    # To report queue positions without counting the queue for every client polling its jobs, the pending jobs are
+    # indexed in Redis, in a sorted set per lane scored by `order`: a job's place in its lane is a ZRANK, O(log n).
+    # Jobs are added when saved as pending and removed when claimed or finished. Anything that changes jobs
+    # behind the index's back (like a queryset update) is caught up when the index is rebuilt from the database,
+    # every CAPTURE_QUEUE_INDEX_REBUILD_INTERVAL seconds.
+    #
+    # Where the cache isn't Redis, or Redis can't be reached, positions are counted in the database instead.
 
-                # load up-to-date time from database
-                next_job.refresh_from_db()
+    @staticmethod
+    def queue_index():
+        """ The Redis connection holding the queue index, or None if the cache isn't Redis. """
+        if settings.CACHES['default']['BACKEND'] != 'django_redis.cache.RedisCache':
+            return None
+        return get_redis_connection('default')
 
-            return next_job
+    @staticmethod
+    def queue_index_member(pk):
+        # zero-padded, so that jobs with the same order sort by pk, as they are processed
+        return '{:012d}'.format(pk)
 
-    def queue_position(self):
+    @classmethod
+    def update_queue_index(cls, add=(), remove=()):
+        """ Add pending jobs to the queue index, and remove jobs that are no longer pending. """
+        redis = cls.queue_index()
+        if redis is None or not (add or remove):
+            return
+        try:
+            with redis.pipeline() as pipe:
+                for capture_job in add:
+                    pipe.zadd(cls.QUEUE_INDEX_KEY.format(capture_job.lane), {cls.queue_index_member(capture_job.pk): capture_job.order})
+                for capture_job in remove:
+                    pipe.zrem(cls.QUEUE_INDEX_KEY.format(capture_job.lane), cls.queue_index_member(capture_job.pk))
+                pipe.execute()
+        except RedisError:
+            logger.exception("Couldn't update the capture queue index")
+
+    @classmethod
+    def invalidate_queue_index(cls):
+        """ Have the queue index rebuilt before it's next used. """
+        redis = cls.queue_index()
+        if redis is None:
+            return
+        try:
+            redis.delete(cls.QUEUE_INDEX_BUILT_KEY)
+        except RedisError:
+            logger.exception("Couldn't invalidate the capture queue index")
+
+    @classmethod
+    def rebuild_queue_index(cls, redis):
+        lanes = {lane: {} for lane in cls.lanes()}
+        for lane, order, pk in cls.objects.filter(status='pending').values_list('lane', 'order', 'pk'):
+            lanes[lane][cls.queue_index_member(pk)] = order
+        with redis.pipeline() as pipe:
+            for lane, members in lanes.items():
+                pipe.delete(cls.QUEUE_INDEX_KEY.format(lane))
+                if members:
+                    pipe.zadd(cls.QUEUE_INDEX_KEY.format(lane), members)
+            if settings.CAPTURE_QUEUE_INDEX_REBUILD_INTERVAL:
+                pipe.set(cls.QUEUE_INDEX_BUILT_KEY, 1, ex=settings.CAPTURE_QUEUE_INDEX_REBUILD_INTERVAL)
+            pipe.execute()
+
+    @classmethod
+    def load_queue(cls):
+        """
+            The number of pending jobs in each lane, for queue_position(). Pass the result to queue_position()
+            to look up several jobs without counting the lanes again.
         """
-            Search job_queues to calculate the queue position for this job -- how many pending jobs have to be processed
-            before this one?
+        redis = cls.queue_index()
+        if redis is not None:
+            try:
+                if not redis.exists(cls.QUEUE_INDEX_BUILT_KEY):
+                    cls.rebuild_queue_index(redis)
+                with redis.pipeline(transaction=False) as pipe:
+                    for lane in cls.lanes():
+                        pipe.zcard(cls.QUEUE_INDEX_KEY.format(lane))
+                    return dict(zip(cls.lanes(), pipe.execute()))
+            except RedisError:
+                logger.exception("Couldn't read the capture queue index; counting the queue instead")
+        depths = dict(cls.objects.filter(status='pending').order_by().values_list('lane').annotate(Count('id')))
+        return {lane: depths.get(lane, 0) for lane in cls.lanes()}
+
+    def lane_position(self):
+        """ This job's place in its lane: 1 if it's the next job the lane will process. """
+        redis = CaptureJob.queue_index()
+        if redis is not None:
+            try:
+                key = CaptureJob.QUEUE_INDEX_KEY.format(self.lane)
+                member = CaptureJob.queue_index_member(self.pk)
+                rank = redis.zrank(key, member)
+                if rank is None and CaptureJob.objects.filter(pk=self.pk, status='pending').exists():
+                    # placed while the index was being rebuilt
+                    redis.zadd(key, {member: self.order})
+                    rank = redis.zrank(key, member)
+                if rank is not None:
+                    return rank + 1
+            except RedisError:
+                logger.exception("Couldn't read the capture queue index; counting the queue instead")
+        return CaptureJob.objects.filter(status='pending', lane=self.lane).filter(
+            Q(order__lt=self.order) | Q(order=self.order, pk__lt=self.pk)).count() + 1
+
+    def queue_position(self, queue=None):
+        """
+            Calculate the queue position for this job -- how many pending jobs have to be processed before this one?
+            Pass the result of load_queue() to look up several jobs against the same lane depths.
+
+            This job's place in its own lane is exact. Jobs in the PRIORITY_LANES go first; while a weighted lane
+            works through its jobs ahead of this one, each other weighted lane is estimated to be served in proportion
+            to the lane weights, as in lanes_by_turn(). Priority jobs still to come, and jobs held back by the
+            in-flight caps, aren't accounted for.
 
             Returns 0 if job is not pending.
         """
         if self.status != 'pending':
             return 0
 
-        queue_position = CaptureJob.objects.filter(status='pending', order__lte=self.order, human=self.human).count()
-        if not self.human:
-            queue_position += CaptureJob.objects.filter(status='pending', human=True).count()
+        if queue is None:
+            queue = CaptureJob.load_queue()
+        lane_position = self.lane_position()
+        if self.lane in CaptureJob.PRIORITY_LANES:
+            return lane_position
+        weights = CaptureJob.lane_weights()
+        queue_position = lane_position
+        for lane, depth in queue.items():
+            if lane in CaptureJob.PRIORITY_LANES:
+                queue_position += depth
+            elif lane != self.lane:
+                queue_position += min(depth, int((lane_position - 0.5) * weights[lane] / weights[self.lane] + 0.5))
 
         return queue_position
 
+    def progress_cache_key(self):
+        return 'capture-job-progress-{}'.format(self.pk)
+
     def inc_progress(self, inc, description):
+        """
+            Record progress through the capture. Every update is cached, for reporting via load_cached_progress(),
+            but the database is only updated when the capture moves on to a new step -- unless the cache
+            isn't shared with the processes that report progress, in which case every update is saved.
+        """
+        new_step = description != self.step_description
         self.step_count = int(self.step_count) + inc
         self.step_description = description
-        self.save(update_fields=['step_count', 'step_description'])
+        django_cache.set(self.progress_cache_key(), (self.step_count, self.step_description), self.PROGRESS_CACHE_TIMEOUT)
+        if new_step or not cache_is_shared():
+            self.save(update_fields=['step_count', 'step_description'])
+
+    @classmethod
+    def load_cached_progress(cls, capture_jobs):
+        """
+            Update in-progress jobs with their latest progress from the cache, which may be ahead of the database.
+        """
+        capture_jobs = [capture_job for capture_job in capture_jobs if capture_job.status == 'in_progress']
+        if not capture_jobs:
+            return
+        cached_progress = django_cache.get_many([capture_job.progress_cache_key() for capture_job in capture_jobs])
+        for capture_job in capture_jobs:
+            progress = cached_progress.get(capture_job.progress_cache_key())
+            if progress:
+                capture_job.step_count, capture_job.step_description = progress
 
     def mark_completed(self, status='completed'):
         """
@@ -1859,7 +2484,8 @@ class CaptureJob(models.Model):
             status = 'failed'
         self.status = status
         self.capture_end_time = timezone.now()
-        self.save(update_fields=['status', 'capture_end_time', 'message'])
+        self.save(update_fields=['status', 'capture_end_time', 'message', 'step_count', 'step_description'])
+        django_cache.delete(self.progress_cache_key())
 
     def mark_failed(self, message):
         """ Mark job as failed, and record message in format for front-end display. """
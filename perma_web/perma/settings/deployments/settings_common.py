@@ -264,6 +264,9 @@ LOGIN_DAY_LIMIT = '50000/d'
 #
 # Django cache
 #
+# Capture progress, capture metrics, the queue snapshot and Webrecorder state are shared between
+# processes through the cache, so deployments should use a shared backend like Redis (see settings_prod).
+# With this per-process default, capture progress is saved to the database at every update instead.
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
@@ -425,6 +428,9 @@ CELERY_TASK_ROUTES = {
     'perma.tasks.cache_playback_status': {'queue': 'background'},
     'perma.tasks.populate_warc_size_fields': {'queue': 'background'},
     'perma.tasks.populate_warc_size': {'queue': 'background'},
+    'perma.tasks.stitch_screenshot': {'queue': 'background'},
+    'perma.tasks.warm_replay': {'queue': 'background'},
+    'perma.tasks.write_warc_index': {'queue': 'background'},
 }
 
 # Control whether Celery tasks should be run in the background or during a request.
@@ -471,6 +477,17 @@ WR_API = 'http://nginx/api/v1'
 WR_PERMA_USER = 'public'
 WR_PERMA_PASSWORD = 'Test123Test123'
 
+# Calls to the WR API share a pool of keep-alive connections per process,
+# with at most this many open at once
+WR_API_POOL_SIZE = 10
+# Seconds to wait for WR to answer an API call
+WR_API_TIMEOUT = 10
+# How many times to retry a WR API call if WR can't be reached or its gateway errors,
+# waiting a random time of up to WR_API_RETRY_BACKOFF seconds, doubling each time, between tries.
+# (Uploads are never retried.)
+WR_API_RETRIES = 2
+WR_API_RETRY_BACKOFF = 0.5
+
 
 # Time (in seconds) to wait for upload to finalize
 # after data fully uploaded to Webreccorder
@@ -486,8 +503,18 @@ WR_REPLAY_UPLOAD_TIMEOUT = 25
 WR_COOKIE_PERMITTED_AGE = 60
 
 # Seconds to wait before retrying a failed WR playback.
+# (The permalink page also waits this long between checks on whether playback is ready.)
 WR_PLAYBACK_RETRY_AFTER = 1
 
+# Load new public links into the shared WR collection in the background when their capture completes,
+# so that their first playback doesn't wait for the upload
+WR_WARM_PUBLIC_REPLAY = True
+# How long WR keeps a public collection loaded: keep in step with coll_cdxj_ttl (wr-custom.yaml)
+WR_COLL_CDXJ_TTL = 60 * 15
+# How long to trust that a public link is still loaded in WR once it has been, and play it back
+# without asking WR first. A little less than WR_COLL_CDXJ_TTL, so that we don't outlast WR's copy.
+WR_PUBLIC_REPLAY_READY_TIMEOUT = WR_COLL_CDXJ_TTL - 60
+
 # We're finding that warcs aren't always available for download from S3
 # instantly, immediately after upload. How long do we want to wait for S3
 # to catch up, during first playback, before raising an error?
@@ -515,6 +542,15 @@ THUMBNAIL_STORAGE_PATH = 'thumbnails'
 SINGLE_LINK_HEADER_TEST = False
 ENABLE_BATCH_LINKS = False
 # N.B. If True, requires RUN_TASKS_ASYNC = True
+# How many of a batch's URLs to validate (resolve, and load headers for) at once
+LINK_BATCH_VALIDATION_CONCURRENCY = 10
+# How long to remember the results of checking submitted URLs -- what their domains resolve to, and their headers --
+# so that links to the same site don't each wait on it. Failures are remembered for less time, so they can be retried.
+URL_VALIDATION_CACHE_TIMEOUT = 60 * 10
+URL_VALIDATION_NEGATIVE_CACHE_TIMEOUT = 60
+# Accept new links as soon as their URLs are well formed, and leave checking that they resolve to an allowed IP
+# and load to the capture worker, so that slow target sites don't tie up web workers
+DEFER_URL_VALIDATION = False
 
 # security settings -- set these to true if SSL is available
 SECURE_SSL_REDIRECT = False
@@ -589,6 +625,17 @@ REMOTE_SELENIUM_HOST = None
 
 WARC_STORAGE_DIR = 'warcs'  # relative to MEDIA_ROOT
 
+# WARC downloads are sent by Django, with support for Range requests, unless offloaded:
+# with FileSystemMediaStorage, to the web server in front of Django, via WARC_DOWNLOAD_SENDFILE_HEADER;
+# with S3 or Azure storage, to the storage service, by redirecting to a URL signed for WARC_DOWNLOAD_URL_EXPIRE seconds.
+WARC_DOWNLOAD_OFFLOAD = False
+WARC_DOWNLOAD_SENDFILE_HEADER = 'X-Accel-Redirect'  # or 'X-Sendfile' for Apache and lighttpd
+WARC_DOWNLOAD_ACCEL_PREFIX = '/protected-media/'  # an nginx internal location serving MEDIA_ROOT
+WARC_DOWNLOAD_URL_EXPIRE = 60
+# Start user downloads (but not LOCKSS's) with warcinfo records describing the link.
+# Those are made on request, so downloads that include them can't be offloaded.
+WARC_DOWNLOAD_INCLUDE_WARCINFO = True
+
 
 ### LOCKSS ###
 
@@ -606,6 +653,59 @@ RESOURCE_LOAD_TIMEOUT = 45 # seconds to wait for at least one resource to load b
 SHUTDOWN_GRACE_PERIOD = 10 # seconds to allow slow threads to finish before we complete the capture job
 MAX_PROXY_THREADS = 100
 MAX_PROXY_QUEUE_SIZE = 500 # this is the default in https://github.com/internetarchive/warcprox/blob/ee6bc151e1758a50f8af2b8f2d9746aa56ec95fb/warcprox/main.py#L192
+# Keep warcprox (and the virtual display) running between captures in the same worker process,
+# instead of starting them from scratch for every capture. Chrome is kept running too, and its cookies,
+# cache and storage are wiped between captures; other browsers are restarted for every capture.
+# The whole set is recycled after CAPTURE_WARM_POOL_MAX_USES captures.
+CAPTURE_WARM_POOL = False
+CAPTURE_WARM_POOL_MAX_USES = 20
+# How many captures each Celery worker process runs at once, each with its own browser and warcprox.
+# Each process's run_next_capture keeps this many jobs in flight until the queue is empty.
+CAPTURE_CONCURRENCY = 1
+# How many requests each capture makes at once outside the browser (robots.txt, favicons, media),
+# through a pool of threads reusing keep-alive connections to warcprox
+CAPTURE_FETCH_CONCURRENCY = 8
+# Have warcprox write captured records straight into the Perma WARC in storage, instead of to a local
+# file that is copied into storage once the capture is done. (The screenshot then goes last in the WARC, not first.)
+CAPTURE_WARC_DIRECT_TO_STORAGE = False
+# Screenshot pages a window-height at a time instead of resizing the browser to fit the whole page, and stitch the
+# tiles together in a background task, which adds the screenshot to the WARC once the capture is already playable. (Chrome only.)
+CAPTURE_DEFERRED_SCREENSHOT = False
+# After onload, a capture is done once no request has started or finished for this many seconds,
+# and nothing is still loading except requests matching CAPTURE_ENDLESS_REQUEST_PATTERNS, which we don't expect to finish
+CAPTURE_NETWORK_IDLE_TIME = 0.5
+CAPTURE_ENDLESS_REQUEST_PATTERNS = [
+    r'^https?://[^/]*google-analytics\.com/',
+    r'^https?://[^/]*googletagmanager\.com/',
+    r'^https?://[^/]*doubleclick\.net/',
+    r'^https?://[^/]*facebook\.(com|net)/tr',
+    r'/socket\.io/',
+    r'/sockjs/',
+    r'/signalr/',
+    r'/cometd/',
+    r'[?&]transport=(polling|longpoll)',
+]
+# Queue positions are looked up in an index of pending jobs kept in Redis (see CaptureJob.update_queue_index),
+# which is rebuilt from the database this often (in seconds) to catch up with any changes it missed
+CAPTURE_QUEUE_INDEX_REBUILD_INTERVAL = 60 * 10
+# Capture jobs wait in lanes: 'interactive' for links made by people, 'api' for other single links, and 'batch'
+# for link batches. Interactive jobs always go first; while there are none, the other lanes with jobs waiting
+# share the capture workers in proportion to these (positive) weights.
+CAPTURE_QUEUE_LANE_WEIGHTS = {
+    'api': 4,
+    'batch': 2,
+}
+# If set, hold back a user's or registrar's waiting jobs while they already have this many captures in progress
+CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_USER = None
+CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_REGISTRAR = None
+# ... and a target host's, so that a batch of urls from one site doesn't have every worker hitting it at once
+CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_HOST = None
+# After a capture fails, or the target site answers 429 or 503, hold back other jobs for that host for this many seconds,
+# doubling with each failure in a row up to CAPTURE_HOST_MAX_BACKOFF. Set to 0 to turn off backoff.
+CAPTURE_HOST_BACKOFF = 30
+CAPTURE_HOST_MAX_BACKOFF = 60 * 10
+# If set, Prometheus can scrape capture metrics from /service/metrics with this as a bearer token
+CAPTURE_METRICS_TOKEN = None
 
 WEBPACK_LOADER = {
     'DEFAULT': {
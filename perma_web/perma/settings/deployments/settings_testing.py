@@ -17,6 +17,17 @@ FIXTURE_DIRS = (
 
 RUN_TASKS_ASYNC = False  # avoid sending celery tasks to queue -- just run inline
 
+# tests serve different content from the same urls, so don't remember what urls returned
+URL_VALIDATION_CACHE_TIMEOUT = 0
+URL_VALIDATION_NEGATIVE_CACHE_TIMEOUT = 0
+# likewise, report queue positions as of the current queue
+CAPTURE_QUEUE_INDEX_REBUILD_INTERVAL = 0
+# and don't hold back one test's captures because of another's failures
+CAPTURE_HOST_BACKOFF = 0
+# and ask WR whether each playback is ready, rather than trusting another test's upload
+WR_PUBLIC_REPLAY_READY_TIMEOUT = 0
+WR_WARM_PUBLIC_REPLAY = False
+
 SUBDOMAIN_URLCONFS = {}
 
 DEBUG = False
@@ -49,6 +49,10 @@ def post_process_settings(settings):
             'task': 'perma.tasks.run_next_capture',
             'schedule': crontab(minute='*'),
         },
+        'clean-up-capture-jobs': {
+            'task': 'perma.tasks.clean_up_capture_jobs',
+            'schedule': crontab(minute='*'),
+        },
         'sync_subscriptions_from_perma_payments': {
             'task': 'perma.tasks.sync_subscriptions_from_perma_payments',
             'schedule': crontab(hour='23', minute='0')
@@ -1,14 +1,21 @@
 # alternate storage backends
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import io as StringIO
+import mimetypes
 import os
+import tempfile
+import uuid
 
 from django.core.files.storage import FileSystemStorage as DjangoFileSystemStorage
 from django.core.files import File
 from django.conf import settings
+from django.http import HttpResponse, HttpResponseRedirect
 import django.dispatch
 
 from storages.backends.s3boto3 import S3Boto3Storage
 from storages.backends.azure_storage import AzureStorage
+from azure.storage.blob.models import BlobBlock, BlobPermissions, ContentSettings
 from whitenoise.storage import CompressedStaticFilesStorage
 
 # used only for suppressing INFO logging in S3Boto3Storage
@@ -55,6 +62,29 @@ class BaseMediaStorage:
         file_object.seek(0)
         return self.store_file(file_object, file_path, overwrite=overwrite, send_signal=send_signal)
 
+    @contextmanager
+    def stream_to_file(self, file_path, send_signal=True):
+        """
+            Context manager yielding a file object ready for writing. When the context exits,
+            everything written is saved to file_path, overwriting any existing file.
+            If the context exits with an exception, nothing is saved.
+
+            This version stages the data in a local temp file; backends that can write
+            straight to storage as data arrives override it.
+        """
+        # mode set to 'ab+' as a workaround for https://bugs.python.org/issue25341
+        with tempfile.TemporaryFile('ab+') as file_object:
+            yield file_object
+            file_object.seek(0)
+            self.store_file(file_object, file_path, overwrite=True, send_signal=send_signal)
+
+    def offloaded_download_response(self, file_path, filename):
+        """
+            Return a response that gets the file at file_path downloaded, as an attachment named filename,
+            without Django sending its bytes; or None if this backend can't.
+        """
+        return None
+
     def walk(self, top='/', topdown=False, onerror=None):
         """
             An implementation of os.walk() which uses the Django storage for
@@ -80,7 +110,40 @@ class BaseMediaStorage:
 
 
 class FileSystemMediaStorage(BaseMediaStorage, DjangoFileSystemStorage):
-    pass
+
+    @contextmanager
+    def stream_to_file(self, file_path, send_signal=True):
+        """
+            Write to a partial file alongside file_path, and move it into place when done.
+        """
+        full_path = self.path(file_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        partial_path = '{}.{}.partial'.format(full_path, uuid.uuid4().hex)
+        try:
+            with open(partial_path, 'xb') as file_object:
+                yield file_object
+            if self.file_permissions_mode is not None:
+                os.chmod(partial_path, self.file_permissions_mode)
+            os.replace(partial_path, full_path)
+        except BaseException:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        if send_signal:
+            file_saved.send(sender=self.__class__, instance=self, path=file_path, overwrite=True)
+
+    def offloaded_download_response(self, file_path, filename):
+        """
+            Let the web server in front of Django send the file (and handle Range requests),
+            via X-Accel-Redirect (nginx) or X-Sendfile (Apache, lighttpd).
+        """
+        response = HttpResponse(content_type="application/gzip")
+        if settings.WARC_DOWNLOAD_SENDFILE_HEADER == 'X-Accel-Redirect':
+            response['X-Accel-Redirect'] = settings.WARC_DOWNLOAD_ACCEL_PREFIX + file_path
+        else:
+            response[settings.WARC_DOWNLOAD_SENDFILE_HEADER] = self.path(file_path)
+        response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+        return response
 
 
 class S3MediaStorage(BaseMediaStorage, S3Boto3Storage):
@@ -89,5 +152,105 @@ class S3MediaStorage(BaseMediaStorage, S3Boto3Storage):
     logging.getLogger('boto3').setLevel(logging.WARNING)
     logging.getLogger('botocore').setLevel(logging.WARNING)
 
+    @contextmanager
+    def stream_to_file(self, file_path, send_signal=True):
+        """
+            Upload with a multipart upload as data is written, via django-storages' S3Boto3StorageFile,
+            which sends a part every AWS_S3_FILE_BUFFER_SIZE bytes.
+        """
+        file_object = self.open(file_path, 'wb')
+        try:
+            yield file_object
+        except BaseException:
+            # don't leave an incomplete upload behind
+            if file_object._multipart is not None:
+                file_object._multipart.abort()
+            file_object.file.close()
+            raise
+        file_object.close()
+        if send_signal:
+            file_saved.send(sender=self.__class__, instance=self, path=file_path, overwrite=True)
+
+    def offloaded_download_response(self, file_path, filename):
+        """ Redirect to a short-lived presigned URL, so that S3 sends the file. """
+        return HttpResponseRedirect(self.url(
+            file_path,
+            parameters={'ResponseContentDisposition': 'attachment; filename="%s"' % filename},
+            expire=settings.WARC_DOWNLOAD_URL_EXPIRE))
+
+
 class AzureMediaStorage(BaseMediaStorage, AzureStorage):
     location = settings.MEDIA_ROOT
+
+    @contextmanager
+    def stream_to_file(self, file_path, send_signal=True):
+        """
+            Upload blocks of the blob as data is written, and commit them when done.
+            (Azure discards uncommitted blocks by itself.)
+        """
+        file_object = AzureBlockBlobWriter(self, file_path)
+        yield file_object
+        file_object.commit()
+        if send_signal:
+            file_saved.send(sender=self.__class__, instance=self, path=file_path, overwrite=True)
+
+    def offloaded_download_response(self, file_path, filename):
+        """ Redirect to a blob URL with a short-lived, read-only SAS token, so that Azure sends the file. """
+        blob_name = self._get_valid_path(file_path)
+        sas_token = self.service.generate_blob_shared_access_signature(
+            self.azure_container,
+            blob_name,
+            permission=BlobPermissions.READ,
+            expiry=datetime.utcnow() + timedelta(seconds=settings.WARC_DOWNLOAD_URL_EXPIRE),
+            content_disposition='attachment; filename="%s"' % filename)
+        return HttpResponseRedirect(self.service.make_blob_url(self.azure_container, blob_name, sas_token=sas_token))
+
+
+class AzureBlockBlobWriter:
+    """
+        Write-only file object that uploads to an Azure block blob, one block_size block at a time.
+    """
+    block_size = 4 * 1024 * 1024
+
+    def __init__(self, storage, file_path):
+        self.storage = storage
+        self.blob_name = storage._get_valid_path(file_path)
+        self.buffer = StringIO.BytesIO()
+        self.block_ids = []
+
+    def write(self, data):
+        self.buffer.write(data)
+        if self.buffer.tell() >= self.block_size:
+            self.put_block()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def put_block(self):
+        data = self.buffer.getvalue()
+        if not data:
+            return
+        block_id = '{:08d}'.format(len(self.block_ids))
+        self.storage.service.put_block(
+            container_name=self.storage.azure_container,
+            blob_name=self.blob_name,
+            block=data,
+            block_id=block_id,
+            timeout=self.storage.timeout)
+        self.block_ids.append(block_id)
+        self.buffer = StringIO.BytesIO()
+
+    def commit(self):
+        self.put_block()
+        # same content settings as AzureStorage._save
+        guessed_type, content_encoding = mimetypes.guess_type(self.blob_name)
+        self.storage.service.put_block_list(
+            container_name=self.storage.azure_container,
+            blob_name=self.blob_name,
+            block_list=[BlobBlock(id=block_id) for block_id in self.block_ids],
+            content_settings=ContentSettings(
+                content_type=guessed_type or self.storage.default_content_type,
+                content_encoding=content_encoding,
+                cache_control=self.storage.cache_control),
+            timeout=self.storage.timeout)
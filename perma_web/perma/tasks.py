@@ -1,12 +1,14 @@
+import shutil
 import tempfile
-import traceback
 from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
 from contextlib import contextmanager
-from pyquery import PyQuery
 
 from http.client import CannotSendRequest
 from urllib.error import URLError
 
+import hashlib
+import io
 import os
 import os.path
 import threading
@@ -16,20 +18,20 @@ import urllib.parse
 import re
 import urllib.robotparser
 from urllib3.util import is_connection_dropped
-import errno
 import tempdir
 import socket
-from socket import error as socket_error
 from celery import shared_task
 from celery.exceptions import SoftTimeLimitExceeded
-from celery.signals import task_failure
+from celery.signals import task_failure, worker_process_shutdown
 from selenium import webdriver
 from selenium.common.exceptions import WebDriverException, NoSuchElementException, NoSuchFrameException
 from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
 from selenium.webdriver.common.proxy import ProxyType, Proxy
 from pyvirtualdisplay import Display
+from PIL import Image
 import warcprox
 from warcprox.controller import WarcproxController
+from warcprox.writer import WarcWriter
 from warcprox.warcproxy import WarcProxyHandler
 from warcprox.mitmproxy import ProxyingRecordingHTTPResponse
 from warcprox.mitmproxy import http_client
@@ -40,19 +42,22 @@ from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 import internetarchive
 
+from django.core.cache import cache as django_cache
 from django.core.files.storage import default_storage
 from django.core.mail import mail_admins
 from django.template.defaultfilters import truncatechars
 from django.conf import settings
+from django.db import connection
 from django.utils import timezone
 from django.urls import reverse
 from django.http import HttpRequest
 
 from perma.models import WeekStats, MinuteStats, Registrar, LinkUser, Link, Organization, Capture, CaptureJob, UncaughtError
 from perma.email import send_self_email
-from perma.exceptions import PermaPaymentsCommunicationException
+from perma.metrics import record_capture
+from perma.exceptions import PermaPaymentsCommunicationException, WebrecorderException
 from perma.utils import (run_task, url_in_allowed_ip_range,
-    copy_file_data, preserve_perma_warc, write_warc_records_recorded_from_web,
+    copy_file_data, preserve_perma_warc, append_to_perma_warc, write_warc_records_recorded_from_web,
     write_resource_record_from_asset, protocol, remove_control_characters)
 from perma import site_scripts
 
@@ -63,12 +68,20 @@ logger = logging.getLogger('celery.django')
 
 RESOURCE_LOAD_TIMEOUT = settings.RESOURCE_LOAD_TIMEOUT # seconds to wait for at least one resource to load before giving up on capture
 ROBOTS_TXT_TIMEOUT = 30 # seconds to wait before giving up on robots.txt
+ROBOTS_TXT_MAX_SIZE = 500 * 1024 # bytes of robots.txt to read; like Google, ignore anything after that
 ONLOAD_EVENT_TIMEOUT = 30 # seconds to wait before giving up on the onLoad event and proceeding as though it fired
 ELEMENT_DISCOVERY_TIMEOUT = 2 # seconds before PhantomJS gives up running a DOM request (should be instant, assuming page is loaded)
 AFTER_LOAD_TIMEOUT = 25 # seconds to allow page to keep loading additional resources after onLoad event fires
+MIN_AFTER_LOAD_TIMEOUT = 5 # seconds to allow, at least, however quickly a site's pages have settled before
+AFTER_LOAD_STALL_TIME = 2 # seconds without a request starting or finishing, after which a site's learned timeout applies
+LEARNED_AFTER_LOAD_MEMORY = 60 * 60 * 24 * 7 # seconds to remember how long a site's pages take to settle
 SHUTDOWN_GRACE_PERIOD = settings.SHUTDOWN_GRACE_PERIOD # seconds to allow slow threads to finish before we complete the capture job
+CAPTURE_RUNWAY = RESOURCE_LOAD_TIMEOUT + ONLOAD_EVENT_TIMEOUT + AFTER_LOAD_TIMEOUT + 2 * SHUTDOWN_GRACE_PERIOD # seconds a capture needs, at most, before it's saved
 VALID_FAVICON_MIME_TYPES = {'image/png', 'image/gif', 'image/jpg', 'image/jpeg', 'image/x-icon', 'image/vnd.microsoft.icon', 'image/ico'}
 BROWSER_SIZE = [1024, 800]
+ENDLESS_REQUEST_RE = re.compile('|'.join(settings.CAPTURE_ENDLESS_REQUEST_PATTERNS)) if settings.CAPTURE_ENDLESS_REQUEST_PATTERNS else None
+HOST_BUSY_STATUSES = {429, 503}  # responses meaning the target site wants us to back off
+SCREENSHOT_TILE_DIR = 'screenshot_tiles'  # relative to MEDIA_ROOT; where deferred screenshots wait to be stitched
 
 
 ### ERROR REPORTING ###
@@ -121,64 +134,111 @@ def safe_save_fields(instance, **kwargs):
         setattr(instance, key, val)
     instance.save(update_fields=list(kwargs.keys()))
 
-def get_url(url, thread_list, proxy_address, requested_urls, proxied_responses, user_agent):
+def sleep_unless_halted(seconds, halt):
     """
-        Get a url, via proxied python requests.get(), in a way that is interruptable from other threads.
-        Blocks calling thread. (Recommended: only call in sub-threads.)
+        Sleep, but raise SoftTimeLimitExceeded if the `halt` event is set. Celery only raises
+        SoftTimeLimitExceeded in a task's main thread, so captures run in other threads use this instead.
     """
-    request_thread = add_thread(thread_list, ProxiedRequestThread(proxy_address, url, requested_urls, proxied_responses, user_agent))
-    request_thread.join()
-    return request_thread.response, request_thread.response_exception
+    if halt.wait(seconds):
+        raise SoftTimeLimitExceeded()
 
-class ProxiedRequestThread(threading.Thread):
+class ProxiedFetcher:
     """
-        Run python request.get() in a thread, loading data in chunks.
-        Listen for self.stop to be set, allowing requests to be halted by other threads.
-        While the thread is running, see `self.pending_data` for how much has been downloaded so far.
-        Once the thread is done, see `self.response` and `self.response_exception` for the results.
+        Fetch URLs through a capture's warcprox with python requests, loading data in chunks.
+
+        Fetches run on a bounded pool of threads, each reusing a keep-alive session, so a page
+        with hundreds of media URLs doesn't start hundreds of threads and connections.
+        Like the threads on a capture's thread_list, set `self.stop` to halt fetches, and `join()` to
+        wait for them to finish. (Downloaded bytes count towards the capture's size as warcprox records them.)
     """
-    def __init__(self, proxy_address, url, requested_urls, proxied_responses, user_agent, *args, **kwargs):
-        self.url = url
-        self.user_agent = user_agent
+    def __init__(self, proxy_address, requested_urls, proxied_responses, user_agent, max_workers=None):
         self.proxy_address = proxy_address
-        self.pending_data = 0
-        self.stop = threading.Event()
-        self.response = None
-        self.response_exception = None
         self.requested_urls = requested_urls
         self.proxied_responses = proxied_responses
-        super(ProxiedRequestThread, self).__init__(*args, **kwargs)
+        self.user_agent = user_agent
+        self.stop = threading.Event()
+        self.futures = []
+        self.sessions = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or settings.CAPTURE_FETCH_CONCURRENCY,
+            thread_name_prefix='proxied_fetch'
+        )
 
-    def run(self):
-        self.requested_urls.add(self.url)
-        if self.proxied_responses["limit_reached"]:
-            return
+    def fetch(self, url, max_content_size=0):
+        """
+            Queue a request for url. Returns a Future, whose result is a (response, exception) tuple.
+
+            The response body is recorded by warcprox, so by default we just count it and throw it away;
+            `response.content` holds at most the first `max_content_size` bytes.
+        """
+        self.requested_urls.add(url)
+        with self.lock:
+            if not self.stop.is_set():
+                future = self.executor.submit(self._fetch, url, max_content_size)
+                self.futures.append(future)
+                return future
+        future = Future()
+        future.set_result((None, None))
+        return future
+
+    def get(self, url, max_content_size=0):
+        """
+            Get a url, in a way that is interruptable from other threads.
+            Blocks calling thread. (Recommended: only call in sub-threads.)
+        """
         try:
-            with requests.Session() as s:
-                request = requests.Request(
-                    'GET',
-                    self.url,
-                    headers={'User-Agent': self.user_agent, **settings.CAPTURE_HEADERS}
-                )
-                self.response = s.send(
-                    request.prepare(),
-                    proxies={'http': 'http://' + self.proxy_address, 'https': 'http://' + self.proxy_address},
-                    verify=False,
-                    stream=True,
-                    timeout=1
-                )
-                self.response._content = bytes()
-                for chunk in self.response.iter_content(chunk_size=8192):
-                    self.pending_data += len(chunk)
-                    self.response._content += chunk
+            return self.fetch(url, max_content_size).result()
+        except CancelledError:
+            return None, None
+
+    def join(self):
+        """
+            Drop fetches that haven't started yet, wait for the rest, and close their connections.
+        """
+        with self.lock:
+            self.stop.set()
+        for future in self.futures:
+            future.cancel()  # no-op for fetches already running
+        self.executor.shutdown(wait=True)
+        for session in self.sessions:
+            session.close()
+
+    def get_session(self):
+        session = getattr(self.local, 'session', None)
+        if not session:
+            session = self.local.session = requests.Session()
+            session.headers.update({'User-Agent': self.user_agent, **settings.CAPTURE_HEADERS})
+            session.proxies = {'http': 'http://' + self.proxy_address, 'https': 'http://' + self.proxy_address}
+            session.verify = False
+            with self.lock:
+                self.sessions.append(session)
+        return session
+
+    def _fetch(self, url, max_content_size):
+        response = None
+        if self.stop.is_set() or self.proxied_responses["limit_reached"]:
+            return None, None
+        try:
+            response = self.get_session().get(url, stream=True, timeout=1)
+            content = []
+            content_size = 0
+            try:
+                for chunk in response.iter_content(chunk_size=8192):
+                    if content_size < max_content_size:
+                        content.append(chunk[:max_content_size - content_size])
+                        content_size += len(content[-1])
                     if self.stop.is_set() or self.proxied_responses["limit_reached"]:
-                        return
+                        break
+            finally:
+                response._content = b''.join(content)
+            return response, None
         except requests.RequestException as e:
-            self.response_exception = e
+            return response, e
         finally:
-            if self.response:
-                self.response.close()
-            self.pending_data = 0
+            if response is not None:
+                response.close()
 
 class HaltCaptureException(Exception):
     """
@@ -197,11 +257,351 @@ def begin(self, extra_response_headers={}):
     self.recorder.headers = self.msg
 ProxyingRecordingHTTPResponse.begin = begin
 
-# get a copy of warcprox's proxy function, which we can use to
-# monkey-patch the function freshly on each call of run_next_capture
+# get a copy of warcprox's proxy function, which our patched version below wraps
 _real_proxy_request = WarcProxyHandler._proxy_request
 
 
+class CaptureTracker:
+    """
+        Shared, mutable record of what warcprox proxies during a single capture.
+
+        A tracker is attached to a warcprox server as `perma_capture` for the duration
+        of a capture, and our patched request handlers look it up there. That way a
+        single warcprox instance can be reused for many captures.
+    """
+    def __init__(self):
+        self.proxied_responses = {
+            "any": False,
+            "size": 0,
+            "limit_reached": False
+        }
+        self.proxied_pairs = []
+        self.requested_urls = set()  # all URLs we have requested -- used to avoid duplicate requests
+        self.last_activity = time.time()  # when a request last started or finished
+        self.lock = threading.Lock()
+        self.stop = False
+
+    def add_bytes(self, count):
+        """
+            Count bytes towards the size of the capture as warcprox records them. As soon as the
+            capture is larger than settings.MAX_ARCHIVE_FILE_SIZE, flag it, and stop recording.
+        """
+        with self.lock:
+            self.proxied_responses["size"] += count
+            if self.proxied_responses["size"] > settings.MAX_ARCHIVE_FILE_SIZE and not self.proxied_responses["limit_reached"]:
+                self.proxied_responses["limit_reached"] = True
+                self.stop = True
+                print("Size limit reached.")
+
+    def network_idle(self, since=0):
+        """
+            Whether the capture's traffic has settled: no request has started or finished for
+            settings.CAPTURE_NETWORK_IDLE_TIME seconds (or since `since`), and nothing is still in flight
+            but requests that we don't expect ever to finish, like analytics beacons and long polls.
+        """
+        if time.time() - max(self.last_activity, since) < settings.CAPTURE_NETWORK_IDLE_TIME:
+            return False
+        with self.lock:
+            unfinished_urls = [url for url, response in self.proxied_pairs if not response]
+        return all(ENDLESS_REQUEST_RE and ENDLESS_REQUEST_RE.search(url) for url in unfinished_urls)
+
+def get_capture_tracker(handler):
+    return getattr(handler.server, 'perma_capture', None)
+
+# Patch Warcprox's inner proxy function to be interruptible,
+# to prevent thread leak and permit the partial capture of streamed content.
+# See https://github.com/harvard-lil/perma/issues/2019
+def stoppable_proxy_request(self, extra_response_headers={}):
+    '''
+    Sends the request to the remote server, then uses a ProxyingRecorder to
+    read the response and send it to the proxy client, while recording the
+    bytes in transit. Returns a tuple (request, response) where request is
+    the raw request bytes, and response is a ProxyingRecorder.
+    :param extra_response_headers: generated on warcprox._proxy_request.
+    It may contain extra HTTP headers such as ``Warcprox-Meta`` which
+    are written in the WARC record for this request.
+    '''
+    # Build request
+    req_str = '{} {} {}\r\n'.format(
+            self.command, self.path, self.request_version)
+
+    # Swallow headers that don't make sense to forward on, i.e. most
+    # hop-by-hop headers. http://tools.ietf.org/html/rfc2616#section-13.5.
+    # self.headers is an email.message.Message, which is case-insensitive
+    # and doesn't throw KeyError in __delitem__
+    for key in (
+            'Connection', 'Proxy-Connection', 'Keep-Alive',
+            'Proxy-Authenticate', 'Proxy-Authorization', 'Upgrade'):
+        del self.headers[key]
+
+    self.headers['Via'] = warcprox.mitmproxy.via_header_value(
+            self.headers.get('Via'),
+            self.request_version.replace('HTTP/', ''))
+
+    # Add headers to the request
+    # XXX in at least python3.3 str(self.headers) uses \n not \r\n :(
+    req_str += '\r\n'.join(
+            '{}: {}'.format(k,v) for (k,v) in self.headers.items())
+
+    req = req_str.encode('latin1') + b'\r\n\r\n'
+
+    # Append message body if present to the request
+    if 'Content-Length' in self.headers:
+        req += self.rfile.read(int(self.headers['Content-Length']))
+
+    prox_rec_res = None
+    start = time.time()
+    recorded = 0  # Perma change: bytes of this response counted towards the capture's size so far
+    try:
+        self.logger.debug('sending to remote server req=%r' % req)
+
+        # Send it down the pipe!
+        self._remote_server_conn.sock.sendall(req)
+
+        prox_rec_res = ProxyingRecordingHTTPResponse(
+                self._remote_server_conn.sock, proxy_client=self.connection,
+                digest_algorithm=self.server.digest_algorithm,
+                url=self.url, method=self.command,
+                tmp_file_max_memory_size=self._tmp_file_max_memory_size)
+        prox_rec_res.begin(extra_response_headers=extra_response_headers)
+
+        buf = None
+        while buf != b'':
+            try:
+                buf = prox_rec_res.read(65536)
+            except http_client.IncompleteRead as e:
+                self.logger.warn('%s from %s' %(e, self.url))
+                buf = e.partial
+
+            if (self._max_resource_size and
+                    prox_rec_res.recorder.len > self._max_resource_size):
+                prox_rec_res.truncated = b'length'
+                self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
+                self._remote_server_conn.sock.close()
+                self.logger.info(
+                        'truncating response because max resource size %d '
+                        'bytes exceeded for URL %s' %
+                        (self._max_resource_size, self.url))
+                break
+            elif ('content-length' not in self.headers and
+                   time.time() - start > 3 * 60 * 60):
+                prox_rec_res.truncated = b'time'
+                self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
+                self._remote_server_conn.sock.close()
+                self.logger.info(
+                        'reached hard timeout of 3 hours fetching url '
+                        'without content-length: %s' % self.url)
+                break
+
+            # begin Perma changes #
+            tracker = get_capture_tracker(self)
+            if tracker is not None:
+                tracker.add_bytes(prox_rec_res.recorder.len - recorded)
+                recorded = prox_rec_res.recorder.len
+            if tracker is None or tracker.stop:
+                prox_rec_res.truncated = b'length'
+                self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
+                self._remote_server_conn.sock.close()
+                self.logger.info(
+                        'truncating response because stop signal received '
+                        'while recording %s' %
+                        self.url)
+                break
+            # end Perma changes #
+
+        self.log_request(prox_rec_res.status, prox_rec_res.recorder.len)
+        # Let's close off the remote end. If remote connection is fine,
+        # put it back in the pool to reuse it later.
+        if not is_connection_dropped(self._remote_server_conn):
+            self._conn_pool._put_conn(self._remote_server_conn)
+
+    except Exception as e:
+        # A common error is to connect to the remote server successfully
+        # but raise a `RemoteDisconnected` exception when trying to begin
+        # downloading. Its caused by prox_rec_res.begin(...) which calls
+        # http_client._read_status(). The connection fails there.
+        # https://github.com/python/cpython/blob/3.7/Lib/http/client.py#L275
+        # Another case is when the connection is fine but the response
+        # status is problematic, raising `BadStatusLine`.
+        # https://github.com/python/cpython/blob/3.7/Lib/http/client.py#L296
+        # In both cases, the host is bad and we must add it to
+        # `bad_hostnames_ports` cache.
+        if isinstance(e, (http_client.RemoteDisconnected,
+                          http_client.BadStatusLine)):
+            host_port = self._hostname_port_cache_key()
+            with self.server.bad_hostnames_ports_lock:
+                self.server.bad_hostnames_ports[host_port] = 502
+            self.logger.info('bad_hostnames_ports cache size: %d' %
+                             len(self.server.bad_hostnames_ports))
+
+        # Close the connection only if its still open. If its already
+        # closed, an `OSError` "([Errno 107] Transport endpoint is not
+        # connected)" would be raised.
+        if not is_connection_dropped(self._remote_server_conn):
+            self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
+            self._remote_server_conn.sock.close()
+        raise
+    finally:
+        if prox_rec_res:
+            prox_rec_res.close()
+
+    return req, prox_rec_res
+warcprox.mitmproxy.MitmProxyHandler._inner_proxy_request = stoppable_proxy_request
+
+
+# Patch Warcprox's proxy function to track requests and responses
+# on the CaptureTracker of the capture in progress.
+def _proxy_request(self):
+    tracker = get_capture_tracker(self)
+
+    # don't record anything between captures
+    if tracker is None:
+        return
+
+    # make sure we don't capture anything in a banned IP range
+    if not url_in_allowed_ip_range(self.url):
+        return
+
+    # skip request if downloaded size exceeds MAX_ARCHIVE_FILE_SIZE.
+    if tracker.proxied_responses["limit_reached"]:
+        return
+
+    with tracker.lock:
+        proxied_pair = [self.url, None]
+        tracker.requested_urls.add(proxied_pair[0])
+        tracker.proxied_pairs.append(proxied_pair)
+        tracker.last_activity = time.time()
+    try:
+        response = _real_proxy_request(self)
+    except Exception as e:
+        # If warcprox can't handle a request/response for some reason,
+        # remove the proxied pair so that it doesn't keep trying and
+        # the capture process can proceed
+        tracker.proxied_pairs.remove(proxied_pair)
+        tracker.last_activity = time.time()
+        print("WarcProx exception: %s proxying %s" % (e.__class__.__name__, proxied_pair[0]))
+        return  # swallow exception
+    with tracker.lock:
+        tracker.last_activity = time.time()
+        if response:
+            tracker.proxied_responses["any"] = True
+            proxied_pair[1] = response
+        else:
+            # in some cases (502? others?) warcprox is not returning a response
+            tracker.proxied_pairs.remove(proxied_pair)
+
+WarcProxyHandler._proxy_request = _proxy_request
+
+
+def start_warcprox(working_dir):
+    """
+        Start warcprox on an open local port, in a background thread.
+        Warcprox is a MITM proxy server and needs to be running before, during and after the headless browser.
+
+        Returns the controller, its thread, and the address of the proxy.
+    """
+    options = warcprox.Options(
+        address="127.0.0.1",
+        port=0,  # let the OS pick an open port, rather than probing for one
+        max_threads=settings.MAX_PROXY_THREADS,
+        queue_size=settings.MAX_PROXY_QUEUE_SIZE,
+        gzip=True,
+        stats_db_file="",
+        dedup_db_file="",
+        directory=os.path.join(working_dir, "warcs"),  # replaced for each capture by record_capture_to()
+        cacert=os.path.join(working_dir, "warcprox-ca.pem"),
+        certs_dir=os.path.join(working_dir, "warcprox-ca"),
+    )
+    warcprox_controller = WarcproxController(options)
+    proxy_address = "127.0.0.1:%s" % warcprox_controller.proxy.server_address[1]
+    warcprox_thread = threading.Thread(target=warcprox_controller.run_until_shutdown, name="warcprox", args=())
+    warcprox_thread.start()
+    print("WarcProx opened.")
+    return warcprox_controller, warcprox_thread, proxy_address
+
+def record_capture_to(warcprox_controller, warc_filename, directory):
+    """
+        Point an idle warcprox instance at a new warc file, `<directory>/<warc_filename>.warc.gz`.
+        The warc is opened when the first record is written.
+    """
+    warcprox_controller.options.directory = directory
+    warcprox_controller.options.warc_filename = warc_filename
+    writer = warcprox_controller.warc_writer_processor.writer_pool.default_warc_writer
+    writer.directory = directory
+    writer.filename_template = warc_filename
+
+def record_capture_to_storage(warcprox_controller, link):
+    """
+        Point an idle warcprox instance straight at the Perma warc for `link`, in storage.
+        Returns the StorageWarcWriter, which must be finished or discarded once recording is done.
+    """
+    writer = StorageWarcWriter(warcprox_controller.options, link)
+    warcprox_controller.warc_writer_processor.writer_pool.default_warc_writer = writer
+    return writer
+
+class StorageWarcWriter(WarcWriter):
+    """
+        A warcprox WarcWriter that writes recorded records straight into a link's Perma warc in storage,
+        after the Perma warcinfo record, rather than to a local file that is copied over once the capture is done.
+        (See settings.CAPTURE_WARC_DIRECT_TO_STORAGE.)
+
+        warcprox closes the writer when the capture is done; the Perma warc stays open, so that more records
+        (the screenshot) can be appended, until finish() saves it or discard() throws it away.
+    """
+    def __init__(self, options, link):
+        super(StorageWarcWriter, self).__init__(options)
+        self.rollover_size = float('inf')  # the whole capture goes in one warc
+        self.warc_size = []
+        self.done = False
+        self.perma_warc_context = preserve_perma_warc(link.guid, link.creation_timestamp, link.warc_storage_file(), self.warc_size)
+        self.perma_warc = self.perma_warc_context.__enter__()
+
+    def open(self, serial):
+        self.finalname = self.filename(serial)
+        self.path = self.finalname
+        self.f = self.perma_warc
+        return self.f
+
+    def close(self):
+        self.path = None
+        self.f = None
+
+    def finish(self):
+        """ Save the Perma warc. Returns its size. """
+        self.done = True
+        self.perma_warc_context.__exit__(None, None, None)
+        return self.warc_size[0]
+
+    def discard(self):
+        """ Throw away the Perma warc, unless it has already been saved (or failed to save). """
+        if not self.done:
+            self.done = True
+            self.perma_warc_context.__exit__(HaltCaptureException, HaltCaptureException(), None)
+
+def finish_recording(warcprox_controller, tracker, timeout):
+    """
+        Wait for a running warcprox instance to write everything it has recorded, then close the
+        current warc, leaving warcprox running. Returns False if warcprox doesn't settle in time.
+    """
+    end_time = time.time() + timeout
+    while warcprox_controller.earliest_still_active_fetch_start():
+        if time.time() > end_time:
+            if tracker.stop:
+                return False
+            # give stragglers a last moment to wrap up, then cut them off
+            print("Stopping unfinished proxied requests")
+            tracker.stop = True
+            end_time = time.time() + 1
+        time.sleep(.1)
+    writer = warcprox_controller.warc_writer_processor.writer_pool.default_warc_writer
+    if writer.f:
+        # the writer belongs to warcprox's writer thread: ask it to close the warc
+        warcprox_controller.warc_writer_processor.close_for_prefix()
+        return bool(repeat_until_truthy(lambda: writer.f is None, timeout=timeout))
+    return True
+
+
+
 # BROWSER HELPERS
 
 def start_virtual_display():
@@ -209,11 +609,15 @@ def start_virtual_display():
     display.start()
     return display
 
-def get_browser(user_agent, proxy_address, cert_path):
-    """ Set up a Selenium browser with given user agent, proxy and SSL cert. """
+def get_browser(user_agent, proxy_address, cert_path, working_dir, display=None):
+    """
+        Set up a Selenium browser with given user agent, proxy and SSL cert, keeping its files in a new
+        directory in working_dir. Browsers that need a virtual display use `display`, or start one.
+    """
 
-    display = None
     print("Using browser: %s" % settings.CAPTURE_BROWSER)
+    # a fresh profile for every browser, so nothing carries over from one browser to the next
+    browser_dir = tempfile.mkdtemp(prefix='browser-', dir=working_dir)
 
     # PhantomJS
     if settings.CAPTURE_BROWSER == 'PhantomJS':
@@ -227,13 +631,14 @@ def get_browser(user_agent, proxy_address, cert_path):
                 "--ssl-certificates-path=%s" % cert_path,
                 "--ignore-ssl-errors=true",
                 "--local-url-access=false",
-                "--local-storage-path=."
+                "--disk-cache=false",
+                "--local-storage-path=%s" % browser_dir
             ],
             service_log_path=settings.PHANTOMJS_LOG)
 
     # Firefox
     elif settings.CAPTURE_BROWSER == 'Firefox':
-        display = start_virtual_display()
+        display = display or start_virtual_display()
 
         desired_capabilities = dict(DesiredCapabilities.FIREFOX)
         proxy = Proxy({
@@ -252,12 +657,13 @@ def get_browser(user_agent, proxy_address, cert_path):
 
     # Chrome
     elif settings.CAPTURE_BROWSER == 'Chrome':
-        display = start_virtual_display()
+        display = display or start_virtual_display()
 
         # http://blog.likewise.org/2015/01/setting-up-chromedriver-and-the-selenium-webdriver-python-bindings-on-ubuntu-14-dot-04/
-        download_dir = os.path.abspath('./downloads')
+        download_dir = os.path.join(browser_dir, 'downloads')
         os.mkdir(download_dir)
         chrome_options = webdriver.ChromeOptions()
+        chrome_options.add_argument('--user-data-dir=%s' % os.path.join(browser_dir, 'profile'))
 
         # To use Chrome beta channel, if installed:
         # chrome_options.binary_location = '/usr/bin/google-chrome-beta'
@@ -292,7 +698,10 @@ def browser_still_running(browser):
     return browser.service.process.poll() is None
 
 def scroll_browser(browser):
-    """scroll to bottom of page"""
+    """
+        Scroll to bottom of page, in the background. Returns how many seconds the scrolling will take;
+        wait for the network to settle after that, so that anything loaded on scroll is captured.
+    """
     # TODO: This doesn't scroll horizontally or scroll frames
     try:
         scroll_delay = browser.execute_script("""
@@ -314,112 +723,371 @@ def scroll_browser(browser):
             // Return how long all this scrolling will take.
             return (i*delay)/1000;
         """)
-        # In python, wait for javascript background scrolling to finish.
-        time.sleep(min(scroll_delay,1))
+        return scroll_delay
     except (WebDriverException, URLError):
         # Don't panic if we can't scroll -- we've already captured something useful anyway.
         # WebDriverException: the page can't execute JS for some reason.
         # URLError: the headless browser has gone away for some reason.
-        pass
+        return 0
 
-def get_page_source(browser):
+def summarize_frame(browser, depth_limit, frame_limit):
     """
-        Get page source.
-        Use JS rather than browser.page_source so we get the parsed, properly formatted DOM instead of raw user HTML.
+        Summarize the current frame, and any same-origin frames inside it, in a single round trip:
+        the title, meta tags and favicon links of the frame itself, and, for each frame, its url and
+        the media urls found in it.
+
+        Cross-origin frames can't be read from here; their paths, as lists of frame indexes from
+        the current frame, are listed under 'cross_origin_frames'. (See get_page_summary.)
     """
-    try:
-        return browser.execute_script("return document.documentElement.outerHTML")
-    except (WebDriverException, CannotSendRequest):
-        return browser.page_source
+    return browser.execute_script("""
+        var includeAV = arguments[0], depthLimit = arguments[1], frameLimit = arguments[2];
+        var summary = {title: '', meta_tags: {}, favicon_hrefs: [], frames: [], cross_origin_frames: []};
+
+        function each(root, selector, func) {
+            Array.prototype.forEach.call(root.querySelectorAll(selector), func);
+        }
+
+        each(document, 'meta', function (el) {
+            var name = el.getAttribute('name');
+            if (name) summary.meta_tags[name.toLowerCase()] = el.getAttribute('content') || '';
+        });
+        var title = document.querySelector('head > title');
+        if (title) summary.title = title.textContent.replace(/\s+/g, ' ').trim();
+        each(document, 'link', function (el) {
+            var rel = (el.getAttribute('rel') || '').toLowerCase(), href = el.getAttribute('href');
+            if ((rel === 'shortcut icon' || rel === 'icon') && href) summary.favicon_hrefs.push(href);
+        });
+
+        function summarizeFrame(win, path) {
+            // skip about:blank, about:srcdoc, and any other non-http frames
+            if (!/^https?:/.test(win.location.href)) return;
+
+            var doc = win.document, frame = {url: win.location.href, srcset_urls: [], av_urls: [], object_urls: []};
+            each(doc, 'img[srcset], source[srcset]', function (el) {
+                el.getAttribute('srcset').split(',').forEach(function (src) {
+                    src = src.trim().split(/\s+/)[0];
+                    if (src) frame.srcset_urls.push(src);
+                });
+            });
+            if (includeAV) {
+                each(doc, 'video, audio, embed, source', function (el) {
+                    var src = (el.getAttribute('src') || '').trim();
+                    if (src) frame.av_urls.push(src);
+                });
+                each(doc, 'object', function (el) {
+                    var urls = [el.getAttribute('data') || ''].concat((el.getAttribute('archive') || '').split(/\s+/));
+                    each(el, 'param[name="movie"]', function (param) { urls.push(param.getAttribute('value') || ''); });
+                    urls.forEach(function (url) {
+                        url = url.trim();
+                        if (url) frame.object_urls.push([el.getAttribute('codebase'), url]);
+                    });
+                });
+            }
+            summary.frames.push(frame);
+
+            // stop looking for subframes if we hit depth limit
+            if (path.length > depthLimit) return;
+            for (var i = 0; i < win.frames.length; i++) {
+                // stop looking for subframes if we hit total frames limit
+                if (summary.frames.length + summary.cross_origin_frames.length > frameLimit) return;
+                var child = win.frames[i];
+                try {
+                    child.document.documentElement;
+                } catch (e) {
+                    summary.cross_origin_frames.push(path.concat([i]));
+                    continue;
+                }
+                summarizeFrame(child, path.concat([i]));
+            }
+        }
+        summarizeFrame(window, []);
+
+        return summary;
+    """, settings.ENABLE_AV_CAPTURE, depth_limit, frame_limit)
+
+def empty_page_summary():
+    """ A page summary with nothing in it, for when the page can't be summarized. """
+    return {'title': '', 'meta_tags': {}, 'favicon_hrefs': [], 'frames': [], 'cross_origin_frames': []}
 
-def parse_page_source(source):
+def get_page_summary(browser, include_frames=True):
     """
-        Return page source as a parsed PyQuery object for querying.
+        Summarize the page for capture, via summarize_frame -- rather than serializing the
+        DOM of the page, and of each of its frames, and parsing it here.
 
-        PyQuery here works the same as `$(source)` in jQuery. So for example you can do `parsed_source(selector)`
-        with the returned value to get a list of LXML elements matching the selector.
+        If include_frames is set, cross-origin frames are summarized by switching into each in turn.
     """
-    return PyQuery(source, parser='html')
+    DEPTH_LIMIT = 3  # deepest frame level we'll visit
+    FRAME_LIMIT = 20  # max total frames we'll visit
 
-def get_dom_tree(browser):
     with browser_running(browser):
-        return parse_page_source(get_page_source(browser))
+        summary = summarize_frame(browser, DEPTH_LIMIT if include_frames else -1, FRAME_LIMIT)
+        pending_frame_paths = summary['cross_origin_frames']
+        if not pending_frame_paths:
+            return summary
 
-def get_all_dom_trees(browser):
-    with browser_running(browser):
-        return run_in_frames(browser, lambda browser: [[browser.current_url, get_dom_tree(browser)]])
+        browser.implicitly_wait(0)
+        try:
+            while pending_frame_paths and len(summary['frames']) <= FRAME_LIMIT:
+                frame_path = pending_frame_paths.pop(0)
+                browser.switch_to.default_content()
+                try:
+                    for i in frame_path:
+                        browser.switch_to.frame(i)
+                    frame_summary = summarize_frame(browser, DEPTH_LIMIT - len(frame_path), FRAME_LIMIT - len(summary['frames']))
+                except NoSuchFrameException:
+                    # frame hierarchy changed; frame_path is invalid
+                    print("frame hierarchy changed while summarizing frames")
+                    continue
+                except WebDriverException:
+                    # usually due to content security policy
+                    continue
+                summary['frames'] += frame_summary['frames']
+                pending_frame_paths += [frame_path + path for path in frame_summary['cross_origin_frames']]
+        finally:
+            browser.implicitly_wait(ELEMENT_DISCOVERY_TIMEOUT)
+            browser.switch_to.default_content()
 
-def run_in_frames(browser, func, output_collector=None):
-    # setup
-    browser.implicitly_wait(0)
+        return summary
 
-    if output_collector is None:
-        output_collector = []
-    run_in_frames_recursive(browser, func, output_collector)
 
-    # reset
-    browser.implicitly_wait(ELEMENT_DISCOVERY_TIMEOUT)
-    browser.switch_to.default_content()
+### WARM POOL ###
 
-    return output_collector
+# pyvirtualdisplay points the DISPLAY environment variable, process-wide, at the display it starts or
+# restores; hold this while starting a browser or stopping a display, so concurrent captures don't
+# launch browsers on each other's displays
+browser_startup_lock = threading.Lock()
 
-def run_in_frames_recursive(browser, func, output_collector, frame_path=None):
-    DEPTH_LIMIT = 3  # deepest frame level we'll visit
-    FRAME_LIMIT = 20  # max total frames we'll visit
-    if frame_path is None:
-        frame_path = []
+class CaptureResources:
+    """
+        A running warcprox instance, and a browser configured to use it as its proxy.
 
-    with browser_running(browser):
-        # slow to run, so only uncomment logging if needed for debugging:
-        # import hashlib
-        # print frame_path, browser.find_elements_by_tag_name('html')[0]._id, hashlib.sha256(browser.page_source.encode('utf8')).hexdigest(), browser.execute_script("return window.location.href")
+        If settings.CAPTURE_WARM_POOL is set, these are kept running between captures by
+        CaptureResourcePool, so that each capture doesn't pay for starting them from scratch.
+        Chrome is wiped clean between captures; other browsers keep state we can't clear,
+        so they are replaced between captures, and only warcprox and the virtual display stay warm.
+    """
+    def __init__(self, user_agent):
+        self.user_agent = user_agent
+        self.uses = 0
+        self.tracker = None
+        # how long startup took, for the first capture to report; later captures didn't wait for it
+        self.startup_timings = {'proxy_start': 0, 'browser_start': 0}
+        self.browser = self.display = self.warcprox_controller = self.warcprox_thread = None
+        # a directory that outlives any one capture's temp dir, for warcprox's CA and the browser's files
+        self.working_dir = tempfile.mkdtemp(prefix='perma-capture-')
+        try:
+            start_time = time.time()
+            self.warcprox_controller, self.warcprox_thread, self.proxy_address = start_warcprox(self.working_dir)
+            self.startup_timings['proxy_start'] = time.time() - start_time
+            start_time = time.time()
+            with browser_startup_lock:
+                self.browser, self.display = get_browser(user_agent, self.proxy_address, self.warcprox_controller.proxy.ca.ca_file, self.working_dir)
+            self.startup_timings['browser_start'] = time.time() - start_time
+        except:  # noqa
+            self.shutdown()
+            raise
 
-        # attempt to get iframe url, skipping the iframe if attempt fails
-        # (usually due to content security policy)
+    def healthy(self):
+        return bool(
+            self.browser and browser_still_running(self.browser) and
+            self.warcprox_thread and self.warcprox_thread.is_alive() and
+            not self.warcprox_controller.stop.is_set()
+        )
+
+    def start_capture(self, link, tracker):
+        """
+            Record everything proxied from now on for `link`, tracking requests and responses with the given
+            CaptureTracker. Returns where the recording goes, for save_warc: the path of a local warc,
+            `./warcs/<guid>.warc.gz`, or, if settings.CAPTURE_WARC_DIRECT_TO_STORAGE is set, a StorageWarcWriter.
+        """
+        if settings.CAPTURE_WARC_DIRECT_TO_STORAGE:
+            recorded_warc = record_capture_to_storage(self.warcprox_controller, link)
+        else:
+            recorded_warc = os.path.abspath(os.path.join("./warcs", "{}.warc.gz".format(link.guid)))
+            record_capture_to(self.warcprox_controller, link.guid, os.path.dirname(recorded_warc))
+        self.tracker = tracker
+        self.warcprox_controller.proxy.perma_capture = tracker
+        return recorded_warc
+
+    def finish_capture(self):
+        """
+            Wrap up the current capture, leaving warcprox and the browser running, and clear the
+            browser's state so that nothing leaks into the next capture.
+            Returns False if these resources shouldn't be reused.
+        """
         try:
-            current_url = browser.current_url
-        except WebDriverException:
-            return
+            self.browser.get('about:blank')
+        except (WebDriverException, URLError, CannotSendRequest):
+            return False
+        tracker = self.tracker
+        finished = finish_recording(self.warcprox_controller, tracker, SHUTDOWN_GRACE_PERIOD)
+        self.warcprox_controller.proxy.perma_capture = self.tracker = None
+        if not finished:
+            return False
+        if settings.CAPTURE_BROWSER == 'Chrome':
+            try:
+                clear_browser_state(self.browser, tracker.requested_urls)
+            except (WebDriverException, URLError, CannotSendRequest):
+                return False
+        else:
+            try:
+                self.restart_browser()
+            except Exception:
+                logger.exception("Couldn't restart the capture browser:")
+                return False
+        return True
 
-        # skip about:blank, about:srcdoc, and any other non-http frames
-        if not (current_url.startswith('http:') or current_url.startswith('https:')):
-            return
+    def restart_browser(self):
+        """ Replace the browser with a fresh one, leaving warcprox and the virtual display running. """
+        try:
+            self.browser.quit()
+        except (WebDriverException, URLError, OSError):
+            pass
+        self.browser = None
+        with browser_startup_lock:
+            self.browser, self.display = get_browser(self.user_agent, self.proxy_address, self.warcprox_controller.proxy.ca.ca_file, self.working_dir, self.display)
+
+    def shutdown(self):
+        """
+            Shut everything down. The current capture's warc, if any, is closed and complete once this returns.
+        """
+        if self.browser:
+            try:
+                self.browser.quit()  # shut down phantomjs
+            except (WebDriverException, URLError, OSError):
+                pass
+        if self.display:
+            with browser_startup_lock:
+                self.display.stop()  # shut down virtual display
+        if self.warcprox_controller:
+            self.warcprox_controller.stop.set() # send signals to shut down warc threads
+            self.warcprox_controller.proxy.pool.shutdown(wait=False) # non-blocking
+        if self.warcprox_thread:
+            self.warcprox_thread.join()  # wait until warcprox thread is done
+
+        # wait for stray MitmProxyHandler threads -- just this proxy's, since other captures may be running
+        shutdown_time = time.time()
+        while self.warcprox_controller:
+            if time.time() - shutdown_time > SHUTDOWN_GRACE_PERIOD:
+                break
+            active_requests = len(self.warcprox_controller.proxy.active_requests)
+            if not active_requests:
+                break
+            print("Waiting for {} MitmProxyHandler threads".format(active_requests))
+            time.sleep(1)
 
-        # run func in current frame
-        output_collector += func(browser)
+        if self.warcprox_controller:
+            self.warcprox_controller.proxy.perma_capture = self.tracker = None
+            self.warcprox_controller.warc_writer_processor.writer_pool.close_writers()  # blocking
+        shutil.rmtree(self.working_dir, ignore_errors=True)
 
-        # stop looking for subframes if we hit depth limit
-        if len(frame_path) > DEPTH_LIMIT:
-            return
 
-        # run in subframes of current frame
-        for i in range(FRAME_LIMIT):
+class CaptureResourcePool:
+    """
+        Per-worker-process pool of idle CaptureResources, keyed by user agent.
 
-            # stop looking for subframes if we hit total frames limit
-            if len(output_collector) > FRAME_LIMIT:
+        Resources are reused until they have served settings.CAPTURE_WARM_POOL_MAX_USES captures,
+        or until they fail a health check or can't be reset cleanly; replacements are then
+        started in the background, so that they are warm by the time the next capture needs them.
+    """
+    def __init__(self):
+        self.idle = []
+        self.warming = {}
+        self.lock = threading.Lock()
+
+    def checkout(self, user_agent):
+        """ Return ready-to-use resources for a capture, starting new ones if none are idle. """
+        warming = self.warming.get(user_agent)
+        if warming:
+            # started already, so probably quicker than starting from scratch
+            warming.join()
+        with self.lock:
+            resources = next((r for r in self.idle if r.user_agent == user_agent), None)
+            if resources:
+                self.idle.remove(resources)
+        if resources:
+            if resources.healthy():
+                print("Using warm browser and proxy.")
+                return resources
+            resources.shutdown()
+        return CaptureResources(user_agent)
+
+    def checkin(self, resources, reusable=True):
+        """ Take back resources after a capture, shutting them down if they shouldn't be reused. """
+        resources.uses += 1
+        if settings.CAPTURE_WARM_POOL:
+            if reusable and resources.uses < settings.CAPTURE_WARM_POOL_MAX_USES and resources.healthy() and resources.finish_capture():
+                with self.lock:
+                    self.idle.append(resources)
                 return
+            resources.shutdown()
+            self.warm(resources.user_agent)
+        else:
+            resources.shutdown()
 
-            # call self recursively in child frame i
+    def warm(self, user_agent):
+        """ Start new resources in a background thread. """
+        def start():
             try:
-                browser.switch_to.frame(i)
-                run_in_frames_recursive(browser, func, output_collector, frame_path + [i])
-            except NoSuchFrameException:
-                # we've run out of subframes
-                break
-            except ValueError:
-                # switching to frame failed for some reason (does this still apply?)
-                print("run_in_frames_recursive caught exception switching to iframe:")
-                traceback.print_exc()
+                resources = CaptureResources(user_agent)
+                with self.lock:
+                    self.idle.append(resources)
+            except Exception:
+                logger.exception("Couldn't warm up capture resources:")
+            finally:
+                with self.lock:
+                    self.warming.pop(user_agent, None)
+        with self.lock:
+            if user_agent in self.warming:
+                return
+            self.warming[user_agent] = threading.Thread(target=start, name="warm_capture_pool")
+            self.warming[user_agent].start()
 
-            # return to current frame
-            browser.switch_to.default_content()
-            try:
-                for frame in frame_path:
-                    browser.switch_to.frame(frame)
-            except NoSuchFrameException:
-                # frame hierarchy changed; frame_path is invalid
-                print("frame hierarchy changed while running run_in_frames_recursive")
-                break
+    def shutdown(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for resources in idle:
+            resources.shutdown()
+
+capture_pool = CaptureResourcePool()
+
+@worker_process_shutdown.connect()
+def shut_down_capture_pool(**kwargs):
+    capture_pool.shutdown()
+
+def chrome_devtools(browser, command, params=None):
+    """ Run a Chrome DevTools Protocol command, via chromedriver. """
+    browser.command_executor._commands['executeCdpCommand'] = ('POST', '/session/$sessionId/goog/cdp/execute')
+    return browser.execute('executeCdpCommand', {'cmd': command, 'params': params or {}})['value']
+
+def clear_browser_state(browser, requested_urls):
+    """
+        Wipe what a capture left behind in Chrome, so a reused browser starts the next capture afresh:
+        all cookies and the HTTP cache, and storage and service workers for every origin in requested_urls.
+        Then swap the tab for a new one, which drops its sessionStorage.
+
+        Anything left in the cache would be served without going through warcprox, and so be missing
+        from the next capture's warc.
+    """
+    browser.get('about:blank')
+    chrome_devtools(browser, 'Network.clearBrowserCache')
+    chrome_devtools(browser, 'Network.clearBrowserCookies')
+    origins = set()
+    for url in requested_urls:
+        url = urllib.parse.urlsplit(url)
+        if url.scheme in ('http', 'https') and url.hostname:
+            default_port = 443 if url.scheme == 'https' else 80
+            origins.add('{}://{}{}'.format(url.scheme, url.hostname, '' if url.port in (None, default_port) else ':%s' % url.port))
+    for origin in origins:
+        chrome_devtools(browser, 'Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+    old_tabs = set(browser.window_handles)
+    chrome_devtools(browser, 'Target.createTarget', {'url': 'about:blank'})
+    new_tab = (set(browser.window_handles) - old_tabs).pop()
+    browser.close()
+    browser.switch_to.window(new_tab)
+    browser.set_window_size(*BROWSER_SIZE)
+    browser.implicitly_wait(ELEMENT_DISCOVERY_TIMEOUT)
+    browser.set_page_load_timeout(ROBOTS_TXT_TIMEOUT)
 
 
 ### UTILS ###
@@ -470,39 +1138,29 @@ def sleep_unless_seconds_passed(seconds, start_time):
 
 # CAPTURE HELPERS
 
-def inc_progress(capture_job, inc, description):
-    capture_job.inc_progress(inc, description)
-    print("%s step %s: %s" % (capture_job.link.guid, capture_job.step_count, capture_job.step_description))
+def learned_after_load_cache_key(host):
+    return 'capture-after-load-' + hashlib.sha256(host.encode('utf-8')).hexdigest()
 
-def capture_current_size(thread_list, recorded):
+def get_after_load_timeout(host):
     """
-        Amount captured so far is the sum of the bytes recorded by warcprox,
-        and the bytes pending in our background threads.
+        How long to wait for a page from `host` to settle after onload, before giving up on requests that have stalled:
+        twice as long as its pages have been taking, within MIN_AFTER_LOAD_TIMEOUT and AFTER_LOAD_TIMEOUT.
     """
-    return recorded + sum(getattr(thread, 'pending_data', 0) for thread in thread_list)
-
-class CaptureCurrentSizeThread(threading.Thread):
-    """
-        Listen for self.stop to be set, allowing the thread to be halted by other threads.
-    """
-    def __init__(self, thread_list, proxied_responses, *args, **kwargs):
-        self.stop = threading.Event()
-        self.thread_list = thread_list
-        self.proxied_responses = proxied_responses
-        # include 'pending data' for a consistent API with other threads on the thread_list
-        self.pending_data = 0
-        super(CaptureCurrentSizeThread, self).__init__(*args, **kwargs)
-
-    def run(self):
-        while True:
-            if self.stop.is_set():
-                return
-            if capture_current_size(self.thread_list, self.proxied_responses["size"]) > settings.MAX_ARCHIVE_FILE_SIZE:
-                self.proxied_responses["limit_reached"] = True
-                print("Size limit reached.")
-                return
-            time.sleep(.2)
+    learned = django_cache.get(learned_after_load_cache_key(host))
+    if learned is None:
+        return AFTER_LOAD_TIMEOUT
+    return min(AFTER_LOAD_TIMEOUT, max(MIN_AFTER_LOAD_TIMEOUT, 2 * learned))
+
+def learn_after_load_time(host, wait_time):
+    """ Fold how long a page from `host` took to settle into a moving average for the host. """
+    key = learned_after_load_cache_key(host)
+    learned = django_cache.get(key)
+    learned = wait_time if learned is None else learned + .3 * (wait_time - learned)
+    django_cache.set(key, learned, LEARNED_AFTER_LOAD_MEMORY)
 
+def inc_progress(capture_job, inc, description):
+    capture_job.inc_progress(inc, description)
+    print("%s step %s: %s" % (capture_job.link.guid, capture_job.step_count, capture_job.step_description))
 
 def make_absolute_urls(base_url, urls):
     """collect resource urls, converted to absolute urls relative to current browser frame"""
@@ -576,36 +1234,23 @@ def xrobots_blacklists_perma(robots_directives):
 
 # page metadata
 
-def get_metadata(page_metadata, dom_tree):
+def get_metadata(page_metadata, page_summary):
     """
         Retrieve html page metadata.
+
+        Meta tags are a dict (e.g. {"robots": "noarchive"}): the keys are the lowercased "name"
+        attributes of the meta tags, and the values are the corresponding "content" attributes.
+        Later-encountered tags overwrite earlier-encountered tags, if a "name" attribute is
+        duplicated in the html. Tags without name attributes are thrown away.
     """
     if page_metadata.get('title'):
-        page_metadata['meta_tags'] = get_meta_tags(dom_tree)
+        page_metadata['meta_tags'] = page_summary['meta_tags']
     else:
         page_metadata.update({
-            'meta_tags': get_meta_tags(dom_tree),
-            'title': get_title(dom_tree)
+            'meta_tags': page_summary['meta_tags'],
+            'title': page_summary['title']
         })
 
-def get_meta_tags(dom_tree):
-    """
-        Retrieves meta tags as a dict (e.g. {"robots": "noarchive"}).
-
-        The keys of the dict are the "name" attributes of the meta tags (if
-        any) and the values are the corresponding "content" attributes.
-        Later-encountered tags overwrite earlier-encountered tags, if a
-        "name" attribute is duplicated in the html. Tags without name
-        attributes are thrown away (their "content" attribute is mapped
-        to the key "", the empty string).
-    """
-    return {tag.attrib['name'].lower(): tag.attrib.get('content', '')
-            for tag in dom_tree('meta')
-            if tag.attrib.get('name')}
-
-def get_title(dom_tree):
-    return dom_tree('head > title').text()
-
 def meta_tag_analysis_failed(link):
     """What to do if analysis of a link's meta tags fails"""
     if settings.PRIVATE_LINKS_ON_FAILURE:
@@ -615,16 +1260,16 @@ def meta_tag_analysis_failed(link):
 
 # robots.txt
 
-def robots_txt_thread(link, target_url, content_url, thread_list, proxy_address, requested_urls, proxied_responses, user_agent):
+def robots_txt_thread(link, target_url, content_url, fetcher):
     robots_txt_location = urllib.parse.urljoin(content_url, '/robots.txt')
-    robots_txt_response, e = get_url(robots_txt_location, thread_list, proxy_address, requested_urls, proxied_responses, user_agent)
+    robots_txt_response, e = fetcher.get(robots_txt_location, max_content_size=ROBOTS_TXT_MAX_SIZE)
     if e or not robots_txt_response or not robots_txt_response.ok:
         print("Couldn't reach robots.txt")
         return
     print("Robots.txt fetched.")
 
     # We only want to respect robots.txt if Perma is specifically asked not to archive (we're not a crawler)
-    content = str(robots_txt_response.content, 'utf-8')
+    content = str(robots_txt_response.content, 'utf-8', 'replace')  # may be truncated mid-character
     if 'Perma' in content:
         # We found Perma specifically mentioned
         rp = urllib.robotparser.RobotFileParser()
@@ -635,33 +1280,28 @@ def robots_txt_thread(link, target_url, content_url, thread_list, proxy_address,
 
 # favicons
 
-def favicon_thread(successful_favicon_urls, dom_tree, content_url, thread_list, proxy_address, requested_urls, proxied_responses, user_agent):
-    favicon_urls = favicon_get_urls(dom_tree, content_url)
+def favicon_thread(successful_favicon_urls, favicon_hrefs, content_url, fetcher):
+    favicon_urls = favicon_get_urls(favicon_hrefs, content_url)
     for favicon_url in favicon_urls:
-        favicon = favicon_fetch(favicon_url, thread_list, proxy_address, requested_urls, proxied_responses, user_agent)
+        favicon = favicon_fetch(favicon_url, fetcher)
         if favicon:
             successful_favicon_urls.append(favicon)
     if not successful_favicon_urls:
         print("Couldn't get any favicons")
 
-def favicon_get_urls(dom_tree, content_url):
+def favicon_get_urls(favicon_hrefs, content_url):
     """
-        Retrieve favicon URLs from DOM.
+        Get absolute favicon URLs from the hrefs of the page's icon link tags (see summarize_frame).
     """
-    urls = []  # order here matters so that we prefer meta tag favicon over /favicon.ico
-    for el in dom_tree('link'):
-        if el.attrib.get('rel', '').lower() in ("shortcut icon", "icon"):
-            href = el.attrib.get('href')
-            if href:
-                urls.append(href)
+    urls = list(favicon_hrefs)  # order here matters so that we prefer meta tag favicon over /favicon.ico
     urls.append('/favicon.ico')
     urls = make_absolute_urls(content_url, urls)
     urls = list(OrderedDict((url, True) for url in urls).keys())  # remove duplicates without changing list order
     return urls
 
-def favicon_fetch(url, thread_list, proxy_address, requested_urls, proxied_responses, user_agent):
+def favicon_fetch(url, fetcher):
     print("Fetching favicon from %s ..." % url)
-    response, e = get_url(url, thread_list, proxy_address, requested_urls, proxied_responses, user_agent)
+    response, e = fetcher.get(url)
     if e or not response or not response.ok:
         print("Favicon failed:", e, response)
         return
@@ -672,75 +1312,37 @@ def favicon_fetch(url, thread_list, proxy_address, requested_urls, proxied_respo
 
 # media
 
-def get_media_tags(dom_trees):
-    urls = set()
-    for base_url, dom_tree in dom_trees:
-        print("Fetching images in srcsets")
-        new_urls = get_srcset_image_urls(dom_tree)
-        if settings.ENABLE_AV_CAPTURE:
-            print("Fetching audio/video objects")
-            new_urls += get_audio_video_urls(dom_tree)
-            new_urls += get_object_urls(dom_tree)
-        urls |= set(make_absolute_urls(base_url, new_urls))
-    return urls
-
-def get_srcset_image_urls(dom_tree):
+def get_media_urls(frames):
     """
-       Return all urls listed in img/src srcset attributes.
+        Return absolute urls of all images in srcsets, and, if settings.ENABLE_AV_CAPTURE is set,
+        of audio, video and object tags, in the frames summarized by get_page_summary.
+        Object tag urls are relative to the object tag's codebase attribute, if it exists.
     """
-    urls = []
-    for el in dom_tree('img[srcset], source[srcset]'):
-        for src in el.attrib.get('srcset', '').split(','):
-            src = src.strip().split()[0]
-            if src:
-                urls.append(src)
-    return urls
-
-def get_audio_video_urls(dom_tree):
-    """
-       Return urls listed in video/audio/embed/source tag src attributes.
-    """
-    urls = []
-    for el in dom_tree('video, audio, embed, source'):
-        src = el.attrib.get('src', '').strip()
-        if src:
-            urls.append(src)
-    return urls
-
-def get_object_urls(dom_tree):
-    """
-        Return urls in object tag data/archive attributes, as well as object -> param[name="movie"] tag value attributes.
-        Urls will be relative to the object tag codebase attribute if it exists.
-    """
-    urls = []
-    for el in dom_tree('object'):
-        codebase_url = el.attrib.get('codebase')
-        el_urls = [el.attrib.get('data', '')] + \
-                  el.attrib.get('archive', '').split() + \
-                  [param.attrib.get('value', '') for param in PyQuery(el)('param[name="movie"]')]
-        for url in el_urls:
-            url = url.strip()
-            if url:
-                if codebase_url:
-                    url = urllib.parse.urljoin(codebase_url, url)
-                urls.append(url)
+    urls = set()
+    for frame in frames:
+        new_urls = frame['srcset_urls'] + frame['av_urls']
+        new_urls += [urllib.parse.urljoin(codebase_url, url) if codebase_url else url for codebase_url, url in frame['object_urls']]
+        urls |= set(make_absolute_urls(frame['url'], new_urls))
     return urls
 
 # screenshot
 
+def hide_scrollbars(browser):
+    # workaround for failure of --hide-scrollbars flag in Chrome:
+    browser.execute_script("""
+        ['body', 'html', 'frameset'].forEach(function(elType){
+            try {
+                document.getElementsByTagName(elType)[0].style.overflow = 'hidden';
+            } catch(e) {}
+        });
+    """)
+
 def get_screenshot(link, browser):
     page_size = get_page_size(browser)
     if page_pixels_in_allowed_range(page_size):
 
         if settings.CAPTURE_BROWSER == 'Chrome':
-            # workaround for failure of --hide-scrollbars flag in Chrome:
-            browser.execute_script("""
-                ['body', 'html', 'frameset'].forEach(function(elType){
-                    try {
-                        document.getElementsByTagName(elType)[0].style.overflow = 'hidden';
-                    } catch(e) {}
-                });
-            """)
+            hide_scrollbars(browser)
 
             # set window size to page size in Chrome, so we get a full-page screenshot:
             browser.set_window_size(max(page_size['width'], BROWSER_SIZE[0]), max(page_size['height'], BROWSER_SIZE[1]))
@@ -750,6 +1352,53 @@ def get_screenshot(link, browser):
         print("Not taking screenshot! %s" % ("Page size is %s." % (page_size,)))
         safe_save_fields(link.screenshot_capture, status='failed')
 
+def get_screenshot_tiles(link, browser):
+    """
+        Screenshot the page one window-height at a time, scrolling down it, rather than resizing the window to fit
+        the whole page. (See settings.CAPTURE_DEFERRED_SCREENSHOT.) Pages wider than the window are cut off at its right edge.
+
+        Returns a list of (scroll offset, png) pairs, the page height, and the window height, for stitch_screenshot,
+        or None if the page is too big, or has nothing, to screenshot.
+    """
+    page_size = get_page_size(browser)
+    if not page_pixels_in_allowed_range(page_size):
+        print("Not taking screenshot! %s" % ("Page size is %s." % (page_size,)))
+        safe_save_fields(link.screenshot_capture, status='failed')
+        return None
+
+    hide_scrollbars(browser)
+    viewport_height = browser.execute_script("return window.innerHeight;")
+    if not viewport_height or viewport_height <= 0:
+        print("Not taking screenshot! Window height is %s." % (viewport_height,))
+        safe_save_fields(link.screenshot_capture, status='failed')
+        return None
+    tiles = []
+    for top in range(0, page_size['height'], viewport_height):
+        browser.execute_script("window.scrollTo(0, arguments[0]);", top)
+        # the last tile is usually scrolled less than asked, and overlaps the one before
+        offset = browser.execute_script("return window.pageYOffset;")
+        tiles.append((offset, browser.get_screenshot_as_png()))
+        if offset < top:
+            break
+    browser.execute_script("window.scrollTo(0, 0);")
+    if not tiles:
+        print("Not taking screenshot! Page size is %s." % (page_size,))
+        safe_save_fields(link.screenshot_capture, status='failed')
+        return None
+    return tiles, page_size['height'], viewport_height
+
+def defer_screenshot(link, tiles, page_height, viewport_height):
+    """
+        Put screenshot tiles from get_screenshot_tiles() in storage, and hand them to stitch_screenshot.
+    """
+    tile_paths = []
+    for i, (offset, png) in enumerate(tiles):
+        path = os.path.join(SCREENSHOT_TILE_DIR, link.guid, '%d.png' % i)
+        with default_storage.stream_to_file(path, send_signal=False) as tile_file:
+            tile_file.write(png)
+        tile_paths.append((offset, path))
+    run_task(stitch_screenshot.s(link.guid, tile_paths, page_height, viewport_height))
+
 def get_page_size(browser):
     try:
         root_element = browser.find_element_by_tag_name('html')
@@ -773,39 +1422,18 @@ def page_pixels_in_allowed_range(page_size):
 
 ### CAPTURE COMPLETION
 
-def teardown(link, thread_list, browser, display, warcprox_controller, warcprox_thread):
+def teardown(link, thread_list, resources, reusable=True):
     print("Shutting down browser and proxies.")
     for thread in thread_list:
-        # wait until threads are done (have to do this before closing phantomjs)
         if hasattr(thread, 'stop'):
             thread.stop.set()
+    for thread in thread_list:
+        # wait until threads are done (have to do this before closing phantomjs)
         thread.join()
-    if browser:
-        if not browser_still_running(browser):
+    if resources:
+        if not browser_still_running(resources.browser):
             link.tags.add('browser-crashed')
-        browser.quit()  # shut down phantomjs
-    if display:
-        display.stop()  # shut down virtual display
-    if warcprox_controller:
-        warcprox_controller.stop.set() # send signals to shut down warc threads
-        warcprox_controller.proxy.pool.shutdown(wait=False) # non-blocking
-    if warcprox_thread:
-        warcprox_thread.join()  # wait until warcprox thread is done
-
-    # wait for stray MitmProxyHandler threads
-    shutdown_time = time.time()
-    while True:
-        if time.time() - shutdown_time > SHUTDOWN_GRACE_PERIOD:
-            break
-        threads = threading.enumerate()
-        print("{} active threads.".format(len(threads)))
-        if not any('MitmProxyHandler' in thread.name for thread in threads):
-            break
-        print("Waiting for MitmProxyHandler")
-        time.sleep(1)
-
-    if warcprox_controller:
-        warcprox_controller.warc_writer_processor.writer_pool.close_writers()  # blocking
+        capture_pool.checkin(resources, reusable)
 
 
 def process_metadata(metadata, link):
@@ -826,21 +1454,22 @@ def process_metadata(metadata, link):
     safe_save_fields(link, submitted_title=metadata['title'])
 
 
-def save_warc(warcprox_controller, capture_job, link, content_type, screenshot, successful_favicon_urls):
+def save_warc(recorded_warc, capture_job, link, content_type, screenshot, successful_favicon_urls):
     # save a single warc, comprising all recorded recorded content and the screenshot
-    recorded_warc_path = os.path.join(
-        os.getcwd(),
-        warcprox_controller.options.directory,
-        "{}.warc.gz".format(warcprox_controller.options.warc_filename)
-    )
-    warc_size = []  # pass a mutable container to the context manager, so that it can populate it with the size of the finished warc
-    with open(recorded_warc_path, 'rb') as recorded_warc_records, \
-         preserve_perma_warc(link.guid, link.creation_timestamp, link.warc_storage_file(), warc_size) as perma_warc:
-        # screenshot first, per Perma custom
+    if isinstance(recorded_warc, StorageWarcWriter):
+        # recorded content is already in the perma warc; the screenshot goes last
         if screenshot:
-            write_resource_record_from_asset(screenshot, link.screenshot_capture.url, link.screenshot_capture.content_type, perma_warc)
-        # then recorded content
-        write_warc_records_recorded_from_web(recorded_warc_records, perma_warc)
+            write_resource_record_from_asset(screenshot, link.screenshot_capture.url, link.screenshot_capture.content_type, recorded_warc.perma_warc)
+        warc_size = [recorded_warc.finish()]
+    else:
+        warc_size = []  # pass a mutable container to the context manager, so that it can populate it with the size of the finished warc
+        with open(recorded_warc, 'rb') as recorded_warc_records, \
+             preserve_perma_warc(link.guid, link.creation_timestamp, link.warc_storage_file(), warc_size) as perma_warc:
+            # screenshot first, per Perma custom
+            if screenshot:
+                write_resource_record_from_asset(screenshot, link.screenshot_capture.url, link.screenshot_capture.content_type, perma_warc)
+            # then recorded content
+            write_warc_records_recorded_from_web(recorded_warc_records, perma_warc)
 
     # update the db to indicate we succeeded
     safe_save_fields(
@@ -873,6 +1502,13 @@ def save_favicons(link, successful_favicon_urls):
         ).save()
         print("Saved favicons %s" % successful_favicon_urls)
 
+def prewarm_replay(link):
+    """
+        Have a newly captured public link loaded for playback in the background. (See settings.WR_WARM_PUBLIC_REPLAY.)
+    """
+    if settings.WR_WARM_PUBLIC_REPLAY and not link.is_private:
+        run_task(warm_replay.s(link.guid))
+
 def clean_up_failed_captures():
     """
         Clean up any existing jobs that are marked in_progress but must have timed out by now, based on our hard timeout
@@ -914,14 +1550,63 @@ def browser_running(browser, onfailure=None):
 @tempdir.run_in_tempdir()
 def run_next_capture():
     """
-        Grab and run the next CaptureJob. This will keep calling itself until there are no jobs left.
+        Grab and run the next CaptureJob -- or, if settings.CAPTURE_CONCURRENCY is greater than one,
+        several at once. This will keep calling itself until there are no jobs left.
+
+        Dead jobs are cleared out of the queue separately, by clean_up_capture_jobs.
     """
-    clean_up_failed_captures()
+    if settings.CAPTURE_CONCURRENCY > 1:
+        if not run_concurrent_captures(settings.CAPTURE_CONCURRENCY):
+            return  # no jobs waiting
+    else:
+        # get job to work on
+        capture_job = CaptureJob.get_next_job(reserve=True)
+        if not capture_job:
+            return  # no jobs waiting
+        run_capture(capture_job, threading.Event())
+    run_task(run_next_capture.s())
+
+
+def run_concurrent_captures(slots):
+    """
+        Keep up to `slots` captures in flight, each in its own thread, with its own browser and proxy.
+        Each slot claims another job when its capture is done, until the queue is empty or there's no
+        longer time to finish a capture before this task's soft time limit.
+        Returns the number of captures run.
+    """
+    task_start_time = time.time()
+    halt = threading.Event()
+    captures_run = []
+
+    def run_slot():
+        try:
+            while not halt.is_set() and time.time() - task_start_time < settings.CELERY_TASK_SOFT_TIME_LIMIT - CAPTURE_RUNWAY:
+                capture_job = CaptureJob.get_next_job(reserve=True)
+                if not capture_job:
+                    break  # no jobs waiting
+                captures_run.append(capture_job.pk)
+                run_capture(capture_job, halt)
+        finally:
+            connection.close()
+
+    slot_threads = [threading.Thread(target=run_slot, name="capture_slot_%s" % i) for i in range(slots)]
+    for thread in slot_threads:
+        thread.start()
+    try:
+        for thread in slot_threads:
+            thread.join()
+    except SoftTimeLimitExceeded:
+        # only this thread gets the exception; pass it on to the captures
+        halt.set()
+        for thread in slot_threads:
+            thread.join()
+    return len(captures_run)
 
-    # get job to work on
-    capture_job = CaptureJob.get_next_job(reserve=True)
-    if not capture_job:
-        return  # no jobs waiting
+
+def run_capture(capture_job, halt):
+    """
+        Capture a reserved CaptureJob. Setting `halt` stops the capture as though it had hit the soft time limit.
+    """
     try:
         # Start warcprox process. Warcprox is a MITM proxy server and needs to be running
         # before, during and after the headless browser.
@@ -935,13 +1620,13 @@ def run_next_capture():
         start_time = time.time()
         link = capture_job.link
         target_url = link.ascii_safe_url
-        browser = warcprox_controller = warcprox_thread = display = screenshot = content_type = None
-        have_content = have_html = False
+        browser = recorded_warc = resources = page_load_thread = screenshot = screenshot_tiles = content_type = content_status = None
+        have_content = have_html = screenshot_deferred = False
+        scroll_end_time = 0
+        phase_timings = {}  # seconds taken by each phase of the capture, for perma.metrics
         thread_list = []
         page_metadata = {}
         successful_favicon_urls = []
-        requested_urls = set()  # all URLs we have requested -- used to avoid duplicate requests
-        stop = False
 
         capture_user_agent = settings.CAPTURE_USER_AGENT
         if any(domain in link.url_details.netloc for domain in settings.DOMAINS_REQUIRING_UNIQUE_USER_AGENT):
@@ -963,231 +1648,42 @@ def run_next_capture():
         capture_job.attempt += 1
         capture_job.save()
 
-        # BEGIN WARCPROX SETUP
-
-        # Create a request handler class that tracks requests and responses
-        # via in-scope, shared mutable containers. (Patch inside capture function
-        # so the containers are initialized empty for every new capture.)
-        proxied_responses = {
-            "any": False,
-            "size": 0,
-            "limit_reached": False
-        }
-        proxied_pairs = []
-        tracker_lock = threading.Lock()
-
-        # Patch Warcprox's inner proxy function to be interruptible,
-        # to prevent thread leak and permit the partial capture of streamed content.
-        # See https://github.com/harvard-lil/perma/issues/2019
-        def stoppable_proxy_request(self, extra_response_headers={}):
-            '''
-            Sends the request to the remote server, then uses a ProxyingRecorder to
-            read the response and send it to the proxy client, while recording the
-            bytes in transit. Returns a tuple (request, response) where request is
-            the raw request bytes, and response is a ProxyingRecorder.
-            :param extra_response_headers: generated on warcprox._proxy_request.
-            It may contain extra HTTP headers such as ``Warcprox-Meta`` which
-            are written in the WARC record for this request.
-            '''
-            # Build request
-            req_str = '{} {} {}\r\n'.format(
-                    self.command, self.path, self.request_version)
-
-            # Swallow headers that don't make sense to forward on, i.e. most
-            # hop-by-hop headers. http://tools.ietf.org/html/rfc2616#section-13.5.
-            # self.headers is an email.message.Message, which is case-insensitive
-            # and doesn't throw KeyError in __delitem__
-            for key in (
-                    'Connection', 'Proxy-Connection', 'Keep-Alive',
-                    'Proxy-Authenticate', 'Proxy-Authorization', 'Upgrade'):
-                del self.headers[key]
-
-            self.headers['Via'] = warcprox.mitmproxy.via_header_value(
-                    self.headers.get('Via'),
-                    self.request_version.replace('HTTP/', ''))
-
-            # Add headers to the request
-            # XXX in at least python3.3 str(self.headers) uses \n not \r\n :(
-            req_str += '\r\n'.join(
-                    '{}: {}'.format(k,v) for (k,v) in self.headers.items())
-
-            req = req_str.encode('latin1') + b'\r\n\r\n'
-
-            # Append message body if present to the request
-            if 'Content-Length' in self.headers:
-                req += self.rfile.read(int(self.headers['Content-Length']))
-
-            prox_rec_res = None
-            start = time.time()
-            try:
-                self.logger.debug('sending to remote server req=%r' % req)
-
-                # Send it down the pipe!
-                self._remote_server_conn.sock.sendall(req)
-
-                prox_rec_res = ProxyingRecordingHTTPResponse(
-                        self._remote_server_conn.sock, proxy_client=self.connection,
-                        digest_algorithm=self.server.digest_algorithm,
-                        url=self.url, method=self.command,
-                        tmp_file_max_memory_size=self._tmp_file_max_memory_size)
-                prox_rec_res.begin(extra_response_headers=extra_response_headers)
-
-                buf = None
-                while buf != b'':
-                    try:
-                        buf = prox_rec_res.read(65536)
-                    except http_client.IncompleteRead as e:
-                        self.logger.warn('%s from %s' %(e, self.url))
-                        buf = e.partial
-
-                    if (self._max_resource_size and
-                            prox_rec_res.recorder.len > self._max_resource_size):
-                        prox_rec_res.truncated = b'length'
-                        self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
-                        self._remote_server_conn.sock.close()
-                        self.logger.info(
-                                'truncating response because max resource size %d '
-                                'bytes exceeded for URL %s' %
-                                (self._max_resource_size, self.url))
-                        break
-                    elif ('content-length' not in self.headers and
-                           time.time() - start > 3 * 60 * 60):
-                        prox_rec_res.truncated = b'time'
-                        self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
-                        self._remote_server_conn.sock.close()
-                        self.logger.info(
-                                'reached hard timeout of 3 hours fetching url '
-                                'without content-length: %s' % self.url)
-                        break
-
-                    # begin Perma changes #
-                    if stop:
-                        prox_rec_res.truncated = b'length'
-                        self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
-                        self._remote_server_conn.sock.close()
-                        self.logger.info(
-                                'truncating response because stop signal received '
-                                'while recording %s' %
-                                self.url)
-                        break
-                    # end Perma changes #
-
-                self.log_request(prox_rec_res.status, prox_rec_res.recorder.len)
-                # Let's close off the remote end. If remote connection is fine,
-                # put it back in the pool to reuse it later.
-                if not is_connection_dropped(self._remote_server_conn):
-                    self._conn_pool._put_conn(self._remote_server_conn)
-
-            except Exception as e:
-                # A common error is to connect to the remote server successfully
-                # but raise a `RemoteDisconnected` exception when trying to begin
-                # downloading. Its caused by prox_rec_res.begin(...) which calls
-                # http_client._read_status(). The connection fails there.
-                # https://github.com/python/cpython/blob/3.7/Lib/http/client.py#L275
-                # Another case is when the connection is fine but the response
-                # status is problematic, raising `BadStatusLine`.
-                # https://github.com/python/cpython/blob/3.7/Lib/http/client.py#L296
-                # In both cases, the host is bad and we must add it to
-                # `bad_hostnames_ports` cache.
-                if isinstance(e, (http_client.RemoteDisconnected,
-                                  http_client.BadStatusLine)):
-                    host_port = self._hostname_port_cache_key()
-                    with self.server.bad_hostnames_ports_lock:
-                        self.server.bad_hostnames_ports[host_port] = 502
-                    self.logger.info('bad_hostnames_ports cache size: %d' %
-                                     len(self.server.bad_hostnames_ports))
-
-                # Close the connection only if its still open. If its already
-                # closed, an `OSError` "([Errno 107] Transport endpoint is not
-                # connected)" would be raised.
-                if not is_connection_dropped(self._remote_server_conn):
-                    self._remote_server_conn.sock.shutdown(socket.SHUT_RDWR)
-                    self._remote_server_conn.sock.close()
-                raise
-            finally:
-                if prox_rec_res:
-                    prox_rec_res.close()
-
-            return req, prox_rec_res
-
-        warcprox.mitmproxy.MitmProxyHandler._inner_proxy_request = stoppable_proxy_request
-
-
-        def _proxy_request(self):
-
-            # make sure we don't capture anything in a banned IP range
-            if not url_in_allowed_ip_range(self.url):
+        # If the API accepted this link without checking that its url can be captured, check now
+        if settings.DEFER_URL_VALIDATION:
+            url_error = link.get_url_error()
+            if url_error:
+                print("%s: %s" % (link.guid, url_error))
+                capture_job.mark_failed(url_error)
                 return
 
-            # skip request if downloaded size exceeds MAX_ARCHIVE_FILE_SIZE.
-            if proxied_responses["limit_reached"]:
-                return
-
-            with tracker_lock:
-                proxied_pair = [self.url, None]
-                requested_urls.add(proxied_pair[0])
-                proxied_pairs.append(proxied_pair)
-            try:
-                response = _real_proxy_request(self)
-            except Exception as e:
-                # If warcprox can't handle a request/response for some reason,
-                # remove the proxied pair so that it doesn't keep trying and
-                # the capture process can proceed
-                proxied_pairs.remove(proxied_pair)
-                print("WarcProx exception: %s proxying %s" % (e.__class__.__name__, proxied_pair[0]))
-                return  # swallow exception
-            with tracker_lock:
-                if response:
-                    proxied_responses["any"] = True
-                    if response.size:
-                        proxied_responses["size"] += response.size
-                    proxied_pair[1] = response
-                else:
-                    # in some cases (502? others?) warcprox is not returning a response
-                    proxied_pairs.remove(proxied_pair)
-
-        WarcProxyHandler._proxy_request = _proxy_request
-
-        # connect warcprox to an open port
-        warcprox_port = 27500
-        for i in range(500):
-            try:
-                options = warcprox.Options(
-                    address="127.0.0.1",
-                    port=warcprox_port,
-                    max_threads=settings.MAX_PROXY_THREADS,
-                    queue_size=settings.MAX_PROXY_QUEUE_SIZE,
-                    gzip=True,
-                    stats_db_file="",
-                    dedup_db_file="",
-                    directory="./warcs", # default, included so we can retrieve from options object
-                    warc_filename=link.guid
-                )
-                warcprox_controller = WarcproxController(options)
-                break
-            except socket_error as e:
-                if e.errno != errno.EADDRINUSE:
-                    raise
-            warcprox_port += 1
-        else:
-            raise Exception("WarcProx couldn't find an open port.")
-        proxy_address = "127.0.0.1:%s" % warcprox_port
+        # BEGIN WARCPROX SETUP
 
-        # start warcprox in the background
-        warcprox_thread = threading.Thread(target=warcprox_controller.run_until_shutdown, name="warcprox", args=())
-        warcprox_thread.start()
-        print("WarcProx opened.")
+        # Track requests and responses via a CaptureTracker, which our patched
+        # warcprox request handlers find attached to the warcprox server.
+        tracker = CaptureTracker()
+        proxied_responses = tracker.proxied_responses
+        proxied_pairs = tracker.proxied_pairs
+        requested_urls = tracker.requested_urls
+
+        # Get a running warcprox and browser -- warm from a previous capture, if possible
+        resources = capture_pool.checkout(capture_user_agent)
+        phase_timings.update(resources.startup_timings)
+        resources.startup_timings = {'proxy_start': 0, 'browser_start': 0}
+        recorded_warc = resources.start_capture(link, tracker)
+        browser = resources.browser
+        proxy_address = resources.proxy_address
         # END WARCPROX SETUP
 
-        browser, display = get_browser(capture_user_agent, proxy_address, warcprox_controller.proxy.ca.ca_file)
         browser.set_window_size(*BROWSER_SIZE)
 
-        print("Tracking capture size...")
-        add_thread(thread_list, CaptureCurrentSizeThread(thread_list, proxied_responses))
+        # fetch robots.txt, favicons and media outside the browser, through warcprox
+        fetcher = ProxiedFetcher(proxy_address, requested_urls, proxied_responses, capture_user_agent)
+        thread_list.append(fetcher)
 
         # fetch page in the background
         inc_progress(capture_job, 1, "Fetching target URL")
         page_load_thread = threading.Thread(target=browser.get, name="page_load", args=(target_url,))  # returns after onload
+        page_load_start_time = time.time()
         page_load_thread.start()
 
         # before proceeding further, wait until warcprox records a response that isn't a forward
@@ -1208,6 +1704,7 @@ def run_next_capture():
                             continue
 
                         have_content = True
+                        content_status = response.status
                         content_url = str(response.url, 'utf-8')
                         content_type = getattr(response, 'content_type', None)
                         content_type = content_type.lower() if content_type else 'text/html; charset=utf-8'
@@ -1218,6 +1715,7 @@ def run_next_capture():
                 if have_content:
                     # we have something that's worth showing to the user;
                     # break out of "while" before running sleep code below
+                    phase_timings['first_response'] = time.time() - page_load_start_time
                     break
 
                 wait_time = time.time() - start_time
@@ -1225,18 +1723,14 @@ def run_next_capture():
                     raise HaltCaptureException
 
                 inc_progress(capture_job, wait_time/RESOURCE_LOAD_TIMEOUT, "Fetching target URL")
-                time.sleep(1)
+                sleep_unless_halted(1, halt)
 
         print("Fetching robots.txt ...")
         add_thread(thread_list, robots_txt_thread, args=(
             link,
             target_url,
             content_url,
-            thread_list,
-            proxy_address,
-            requested_urls,
-            proxied_responses,
-            capture_user_agent
+            fetcher
         ))
 
         inc_progress(capture_job, 1, "Checking x-robots-tag directives.")
@@ -1249,28 +1743,29 @@ def run_next_capture():
             # Get a copy of the page's metadata immediately, without
             # waiting for the page's onload event (which can take a
             # long time, and might even crash the browser)
-            print("Retrieving DOM (pre-onload)")
-            dom_tree = get_dom_tree(browser)
-            get_metadata(page_metadata, dom_tree)
+            print("Retrieving page summary (pre-onload)")
+            page_summary = empty_page_summary()
+            with warn_on_exception("Error retrieving page summary (pre-onload)", WebDriverException):
+                page_summary = get_page_summary(browser, include_frames=False)
+            get_metadata(page_metadata, page_summary)
 
             # get favicon urls (saved as favicon_capture_url later)
             with browser_running(browser):
                 print("Fetching favicons ...")
                 add_thread(thread_list, favicon_thread, args=(
                     successful_favicon_urls,
-                    dom_tree,
+                    page_summary['favicon_hrefs'],
                     content_url,
-                    thread_list,
-                    proxy_address,
-                    requested_urls,
-                    proxied_responses,
-                    capture_user_agent
+                    fetcher
                 ))
 
             print("Waiting for onload event before proceeding.")
             page_load_thread.join(max(0, ONLOAD_EVENT_TIMEOUT - (time.time() - start_time)))
+            sleep_unless_halted(0, halt)
             if page_load_thread.is_alive():
                 print("Onload timed out")
+            else:
+                phase_timings['onload'] = time.time() - page_load_start_time
             with browser_running(browser):
                 try:
                     post_load_function = get_post_load_function(browser.current_url)
@@ -1280,56 +1775,63 @@ def run_next_capture():
                     print("Running domain's post-load function")
                     post_load_function(browser)
 
-            # Get a fresh copy of the page's metadata, if possible.
-            print("Retrieving DOM (post-onload)")
-            dom_tree = get_dom_tree(browser)
-            get_metadata(page_metadata, dom_tree)
-
             with browser_running(browser):
                 inc_progress(capture_job, 0.5, "Checking for scroll-loaded assets")
-                repeat_while_exception(scroll_browser, arglist=[browser], raise_after_timeout=False)
+                scroll_end_time = time.time() + (repeat_while_exception(scroll_browser, arglist=[browser], raise_after_timeout=False) or 0)
 
             inc_progress(capture_job, 1, "Fetching media")
             with warn_on_exception("Error fetching media"):
-                dom_trees = get_all_dom_trees(browser)
-                media_urls = get_media_tags(dom_trees)
-                # grab all media urls that aren't already being grabbed,
-                # each in its own background thread
+                # Get a fresh copy of the page's metadata, and media urls from the page and its frames
+                print("Retrieving page summary (post-onload)")
+                page_summary = get_page_summary(browser)
+                get_metadata(page_metadata, page_summary)
+                media_urls = get_media_urls(page_summary['frames'])
+                # grab all media urls that aren't already being grabbed
                 for media_url in media_urls - requested_urls:
-                    add_thread(thread_list, ProxiedRequestThread(proxy_address, media_url, requested_urls, proxied_responses, capture_user_agent))
+                    fetcher.fetch(media_url)
 
-        # Wait AFTER_LOAD_TIMEOUT seconds for any requests to finish that are started within the next .5 seconds.
+        # Wait for the network to settle, with nothing left in flight but requests that never finish. If requests stall,
+        # give up after a timeout learned from this site's earlier captures; otherwise, after AFTER_LOAD_TIMEOUT seconds.
         inc_progress(capture_job, 1, "Waiting for post-load requests")
-        unfinished_proxied_pairs = [pair for pair in proxied_pairs if not pair[1]]
         load_time = time.time()
+        after_load_timeout = get_after_load_timeout(capture_job.host)
         with browser_running(browser):
-            while unfinished_proxied_pairs and browser_still_running(browser):
+            while browser_still_running(browser):
 
                 if proxied_responses["limit_reached"]:
-                    stop = True
+                    tracker.stop = True
                     print("Size limit reached: not waiting for additional pending requests.")
                     break
 
-                print("Waiting for %s pending requests" % len(unfinished_proxied_pairs))
-                # give up after AFTER_LOAD_TIMEOUT seconds
                 wait_time = time.time() - load_time
-                if wait_time > AFTER_LOAD_TIMEOUT:
-                    stop = True
-                    print("Waited %s seconds to finish post-load requests -- giving up." % AFTER_LOAD_TIMEOUT)
+                if tracker.network_idle(since=scroll_end_time):
+                    print("Network idle after %.1f seconds." % wait_time)
+                    learn_after_load_time(capture_job.host, wait_time)
+                    break
+
+                if wait_time > AFTER_LOAD_TIMEOUT or (wait_time > after_load_timeout and time.time() - tracker.last_activity > AFTER_LOAD_STALL_TIME):
+                    tracker.stop = True
+                    print("Waited %.1f seconds to finish post-load requests -- giving up." % wait_time)
+                    learn_after_load_time(capture_job.host, wait_time)
                     break
 
                 # Show progress to user
                 inc_progress(capture_job, wait_time/AFTER_LOAD_TIMEOUT, "Waiting for post-load requests")
 
-                # Sleep and update our list
-                time.sleep(.5)
-                unfinished_proxied_pairs = [pair for pair in unfinished_proxied_pairs if not pair[1]]
+                # Sleep and check again
+                sleep_unless_halted(.25, halt)
+        phase_timings['post_load_wait'] = time.time() - load_time
 
         # screenshot capture of html pages (not pdf, etc.)
         # (after all requests have loaded for best quality)
         if have_html and browser_still_running(browser):
             inc_progress(capture_job, 1, "Taking screenshot")
-            screenshot = get_screenshot(link, browser)
+            screenshot_start_time = time.time()
+            if settings.CAPTURE_DEFERRED_SCREENSHOT and settings.CAPTURE_BROWSER == 'Chrome':
+                screenshot_tiles = get_screenshot_tiles(link, browser)
+            else:
+                screenshot = get_screenshot(link, browser)
+            phase_timings['screenshot'] = time.time() - screenshot_start_time
         else:
             safe_save_fields(link.screenshot_capture, status='failed')
 
@@ -1341,7 +1843,8 @@ def run_next_capture():
         logger.exception(f"Exception while capturing job {capture_job.link_id}:")
     finally:
         try:
-            teardown(link, thread_list, browser, display, warcprox_controller, warcprox_thread)
+            # a browser still busy loading the page shouldn't be handed to the next capture
+            teardown(link, thread_list, resources, reusable=not (page_load_thread and page_load_thread.is_alive()))
 
             # save page metadata
             if have_html:
@@ -1352,8 +1855,17 @@ def run_next_capture():
 
             if have_content:
                 inc_progress(capture_job, 1, "Saving web archive file")
-                save_warc(warcprox_controller, capture_job, link, content_type, screenshot, successful_favicon_urls)
+                save_start_time = time.time()
+                save_warc(recorded_warc, capture_job, link, content_type, screenshot, successful_favicon_urls)
+                phase_timings['save'] = time.time() - save_start_time
                 print("%s capture succeeded." % link.guid)
+                if screenshot_tiles:
+                    # the capture is playable now; the screenshot is added to the warc when it's ready
+                    defer_screenshot(link, *screenshot_tiles)
+                    screenshot_deferred = True
+                else:
+                    run_task(write_warc_index.s(link.guid))
+                    prewarm_replay(link)
             else:
                 print("%s capture failed." % link.guid)
 
@@ -1361,10 +1873,111 @@ def run_next_capture():
         except:  # noqa
             logger.exception(f"Exception while finishing job {capture_job.link_id}:")
         finally:
-            capture_job.link.captures.filter(status='pending').update(status='failed')
+            if isinstance(recorded_warc, StorageWarcWriter):
+                recorded_warc.discard()
+            pending_captures = capture_job.link.captures.filter(status='pending')
+            if screenshot_deferred:
+                pending_captures = pending_captures.exclude(role='screenshot')
+            pending_captures.update(status='failed')
             if capture_job.status == 'in_progress':
                 capture_job.mark_failed('Failed during capture.')
-    run_task(run_next_capture.s())
+            if page_load_thread:
+                # back off from hosts that didn't answer, or asked us to slow down
+                CaptureJob.record_host_result(capture_job.host, have_content and content_status not in HOST_BUSY_STATUSES)
+            # count every claimed job, including those that ended before contacting the host
+            phase_timings['total'] = time.time() - start_time
+            if capture_job.capture_start_time:
+                phase_timings['queue_wait'] = (capture_job.capture_start_time - link.creation_timestamp).total_seconds()
+            with warn_on_exception("Error recording capture metrics"):
+                record_capture(phase_timings, capture_job.status)
+
+
+@shared_task()
+def clean_up_capture_jobs():
+    """
+        Clear dead jobs out of the capture queue: pending jobs whose links have been deleted,
+        and jobs still marked in_progress that must have timed out.
+    """
+    CaptureJob.clean_up_deleted()
+    clean_up_failed_captures()
+
+
+@shared_task(acks_late=True)
+def stitch_screenshot(link_guid, tile_paths, page_height, viewport_height):
+    """
+        Stitch the screenshot tiles saved by defer_screenshot() into a full-page screenshot,
+        and add it to the end of the link's warc. (See settings.CAPTURE_DEFERRED_SCREENSHOT.)
+
+        The link may have been played back from the warc without the screenshot in the meantime,
+        so its public replay state is reset afterwards, and the next playback loads the new warc.
+    """
+    link = Link.objects.all_with_deleted().get(guid=link_guid)
+    try:
+        if link.user_deleted:
+            safe_save_fields(link.screenshot_capture, status='failed')
+            return
+        tiles = []
+        for offset, path in tile_paths:
+            with default_storage.open(path) as tile_file:
+                tile = Image.open(tile_file)
+                tile.load()
+            tiles.append((offset, tile))
+
+        # tiles are in device pixels, offsets in CSS pixels
+        scale = tiles[0][1].height / viewport_height
+        screenshot = Image.new(tiles[0][1].mode, (tiles[0][1].width, int(page_height * scale)), 'white')
+        for offset, tile in tiles:
+            screenshot.paste(tile, (0, int(offset * scale)))
+        png = io.BytesIO()
+        screenshot.save(png, 'PNG')
+
+        warc_size = []
+        with append_to_perma_warc(link.warc_storage_file(), warc_size) as perma_warc:
+            write_resource_record_from_asset(png.getvalue(), link.screenshot_capture.url, link.screenshot_capture.content_type, perma_warc)
+        safe_save_fields(link, warc_size=warc_size[0])
+        safe_save_fields(link.screenshot_capture, status='success')
+        with warn_on_exception("Error resetting replay state"):
+            link.reset_public_replay()
+    except:  # noqa
+        logger.exception(f"Exception while stitching screenshot for {link_guid}:")
+        safe_save_fields(link.screenshot_capture, status='failed')
+    finally:
+        for offset, path in tile_paths:
+            with warn_on_exception("Error deleting screenshot tile"):
+                default_storage.delete(path)
+        if not link.user_deleted:
+            with warn_on_exception("Error scheduling warc index"):
+                run_task(write_warc_index.s(link.guid))
+            with warn_on_exception("Error scheduling replay warm-up"):
+                prewarm_replay(link)
+
+
+@shared_task(acks_late=True)
+def write_warc_index(link_guid):
+    """
+        Write the CDXJ index and page list for a link's finished warc. (See Link.write_warc_index.)
+        This reads the whole warc back from storage, so it's kept off the capture and upload paths.
+    """
+    link = Link.objects.all_with_deleted().get(guid=link_guid)
+    if link.user_deleted:
+        return
+    link.write_warc_index()
+
+
+@shared_task(acks_late=True)
+def warm_replay(link_guid):
+    """
+        Load a public link's warc into the shared Webrecorder collection, so that its first playback
+        doesn't have to wait for the upload.
+    """
+    link = Link.objects.get(guid=link_guid)
+    if link.is_private or not link.can_play_back():
+        return
+    try:
+        link.warm_replay()
+    except WebrecorderException:
+        # not fatal: the upload happens when the link is first played back instead
+        logger.exception(f"Couldn't warm up replay of {link_guid}:")
 
 
 @shared_task()
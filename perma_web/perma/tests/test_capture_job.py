@@ -1,23 +1,31 @@
 from datetime import timedelta
 import json
 from multiprocessing.pool import ThreadPool
+import threading
+import time
+from unittest import skipUnless
+
+from mock import patch
 
 from django.conf import settings
-from django.test import TransactionTestCase
+from django.core.cache import cache as django_cache
+from django.db import connection, transaction
+from django.test import TransactionTestCase, override_settings
 from django.utils import timezone
 from rest_framework.settings import api_settings
 
-from perma.models import CaptureJob, Link, LinkUser
-from perma.tasks import clean_up_failed_captures
+from perma.metrics import load_capture_metrics
+from perma.models import Capture, CaptureJob, Link, LinkUser
+from perma.tasks import clean_up_capture_jobs, clean_up_failed_captures, run_capture, run_concurrent_captures
 
 # TODO:
 # - check retry behavior
 
 # lives outside CaptureJobTestCase so it can be used by other tests
-def create_capture_job(user, human=True):
-    link = Link(created_by=user, submitted_url="http://example.com")
+def create_capture_job(user, human=True, url="http://example.com", lane=''):
+    link = Link(created_by=user, submitted_url=url)
     link.save()
-    capture_job = CaptureJob(created_by=user, link=link, human=human, status='pending')
+    capture_job = CaptureJob(created_by=user, link=link, human=human, status='pending', lane=lane)
     capture_job.save()
     return capture_job
 
@@ -37,10 +45,14 @@ class CaptureJobTestCase(TransactionTestCase):
 
         self.maxDiff = None  # let assertListEqual compare large lists
 
+        # start every test with the lanes' scheduling credits even, and no hosts backed off
+        django_cache.delete(CaptureJob.LANE_CREDITS_CACHE_KEY)
+        django_cache.delete(CaptureJob.HOST_BACKOFF_CACHE_KEY)
+
     ### TESTS ###
 
     def test_job_queue_order(self):
-        """ Jobs should be processed round-robin, one per user. """
+        """ Jobs should be processed round-robin, one per user, in each lane, with the interactive lane first. """
 
         jobs = [
             create_capture_job(self.user_one),
@@ -57,10 +69,10 @@ class CaptureJobTestCase(TransactionTestCase):
         ]
 
         expected_order = [
-            0, 3,  # u1, u2
+            0, 3,  # interactive lane: u1, u2
             1, 8,  # u1, u2
             2, 5, 6, 7,  # remaining u1 jobs
-            4  # robots queue
+            4,  # api lane, once the interactive lane is empty
         ]
 
         # test CaptureJob.queue_position
@@ -74,6 +86,162 @@ class CaptureJobTestCase(TransactionTestCase):
         next_jobs = [CaptureJob.get_next_job(reserve=True) for i in range(len(jobs))]
         self.assertListEqual(next_jobs, expected_next_jobs)
 
+    def test_job_placement_query_count(self):
+        """ Placing a new job shouldn't take more queries as the queue grows. """
+        for i in range(20):
+            create_capture_job(self.user_one if i % 2 else self.user_two)
+
+        # user with pending jobs: their last pending job, then the insert
+        with self.assertNumQueries(2):
+            CaptureJob(created_by=self.user_one, human=True, status='pending').save()
+
+        # user without pending jobs: their last pending job, the current round, then the insert
+        with self.assertNumQueries(3):
+            CaptureJob(created_by=LinkUser.objects.get(pk=3), human=True, status='pending').save()
+
+    @override_settings(CAPTURE_QUEUE_INDEX_REBUILD_INTERVAL=60)
+    def test_queue_positions_from_index(self):
+        """ Queue positions should be looked up in the queue index, without counting the queue each time. """
+        self.addCleanup(CaptureJob.invalidate_queue_index)
+        CaptureJob.invalidate_queue_index()
+        jobs = [create_capture_job(self.user_one) for _ in range(3)] + [create_capture_job(self.user_two, human=False)]
+
+        # building the index
+        with self.assertNumQueries(1):
+            self.assertEqual([job.queue_position() for job in jobs], [1, 2, 3, 4])
+        with self.assertNumQueries(0):
+            self.assertEqual([job.queue_position() for job in jobs], [1, 2, 3, 4])
+
+        # new jobs are indexed as they're placed, and finished jobs are removed
+        new_job = create_capture_job(self.user_two)
+        with self.assertNumQueries(0):
+            self.assertEqual(new_job.queue_position(), 2)
+            self.assertEqual(jobs[3].queue_position(), 5)
+        jobs[0].mark_completed('deleted')
+        with self.assertNumQueries(0):
+            self.assertEqual(new_job.queue_position(), 1)
+
+    def test_queue_positions_without_index(self):
+        jobs = [create_capture_job(self.user_one) for _ in range(3)] + [create_capture_job(self.user_two, human=False)]
+        with patch.object(CaptureJob, 'queue_index', return_value=None):
+            self.assertEqual([job.queue_position() for job in jobs], [1, 2, 3, 4])
+
+    @override_settings(CAPTURE_QUEUE_LANE_WEIGHTS={'api': 2, 'batch': 1})
+    def test_lanes_share_by_weight(self):
+        """ A full lane shouldn't hold up the others: each weighted lane with jobs waiting gets turns in proportion to its weight. """
+        for _ in range(6):
+            create_capture_job(self.user_one, human=False)
+            create_capture_job(self.user_two, human=False, lane='batch')
+        lanes = [CaptureJob.get_next_job(reserve=True).lane for _ in range(6)]
+        self.assertEqual(lanes[:3].count('api'), 2)
+        self.assertEqual(lanes[3:6].count('api'), 2)
+        self.assertEqual(lanes.count('batch'), 2)
+
+        # but interactive jobs don't wait for their turn
+        create_capture_job(self.user_one)
+        self.assertEqual(CaptureJob.get_next_job(reserve=True).lane, 'interactive')
+
+    @skipUnless(connection.features.has_select_for_update_skip_locked, "requires SELECT ... FOR UPDATE SKIP LOCKED")
+    def test_locked_lane_falls_back(self):
+        """ If other workers have locked the jobs in the lane whose turn it is, a job from the next lane should be claimed instead. """
+        api_job = create_capture_job(self.user_one, human=False)
+        batch_job = create_capture_job(self.user_two, human=False, lane='batch')
+        locked = threading.Event()
+        release = threading.Event()
+
+        def lock_api_job():
+            with transaction.atomic():
+                list(CaptureJob.objects.filter(pk=api_job.pk).select_for_update())
+                locked.set()
+                release.wait(10)
+            connection.close()
+
+        thread = threading.Thread(target=lock_api_job)
+        thread.start()
+        try:
+            self.assertTrue(locked.wait(10))
+            self.assertEqual(CaptureJob.get_next_job(reserve=True), batch_job)
+            # only the lane that was served is charged for the turn
+            self.assertEqual(django_cache.get(CaptureJob.LANE_CREDITS_CACHE_KEY), {'api': 4, 'batch': -4})
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual(CaptureJob.get_next_job(reserve=True), api_job)
+
+    @override_settings(CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_USER=1)
+    def test_in_flight_cap(self):
+        """ A user's jobs should wait while they have as many in progress as the cap allows. """
+        create_capture_job(self.user_one)
+        create_capture_job(self.user_one)
+        user_two_job = create_capture_job(self.user_two)
+        first_job = CaptureJob.get_next_job(reserve=True)
+        self.assertEqual(first_job.created_by, self.user_one)
+        self.assertEqual(CaptureJob.get_next_job(reserve=True), user_two_job)
+        self.assertIsNone(CaptureJob.get_next_job(reserve=True))
+
+        first_job.mark_failed('Test capture.')
+        self.assertEqual(CaptureJob.get_next_job(reserve=True).created_by, self.user_one)
+
+    @override_settings(CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_REGISTRAR=1)
+    def test_registrar_cap(self):
+        """ Jobs for a registrar should wait while it has as many in progress as the cap allows. """
+        registrar_users = LinkUser.objects.filter(registrar_id=2)[:2]
+        for user in registrar_users:
+            create_capture_job(user)
+        other_registrar_job = create_capture_job(self.user_two)
+        self.assertEqual(other_registrar_job.registrar_id, 1)
+        first_job = CaptureJob.get_next_job(reserve=True)
+        self.assertEqual(first_job.registrar_id, 2)
+        self.assertEqual(CaptureJob.get_next_job(reserve=True), other_registrar_job)
+        self.assertIsNone(CaptureJob.get_next_job(reserve=True))
+
+    @override_settings(CAPTURE_QUEUE_MAX_IN_FLIGHT_PER_HOST=1)
+    def test_host_cap(self):
+        """ Jobs for a host should wait while it has as many captures in progress as the cap allows. """
+        create_capture_job(self.user_one)
+        create_capture_job(self.user_two)
+        other_host_job = create_capture_job(self.user_one, url="http://example.org")
+        self.assertEqual(CaptureJob.get_next_job(reserve=True).host, 'example.com')
+        self.assertEqual(CaptureJob.get_next_job(reserve=True), other_host_job)
+        self.assertIsNone(CaptureJob.get_next_job(reserve=True))
+
+    @override_settings(CAPTURE_HOST_BACKOFF=30)
+    def test_host_backoff(self):
+        """ Jobs for a host should be held back after a capture from it fails, until one succeeds. """
+        job = create_capture_job(self.user_one)
+        CaptureJob.record_host_result('example.com', False)
+        self.assertEqual(CaptureJob.hosts_backing_off(), ['example.com'])
+        self.assertIsNone(CaptureJob.get_next_job())
+        CaptureJob.record_host_result('example.com', True)
+        self.assertEqual(CaptureJob.get_next_job(), job)
+
+    def test_batch_interleaved_by_host(self):
+        """ A user's new jobs should be queued round robin by host. """
+        urls = ["http://a.example.com/1", "http://a.example.com/2", "http://a.example.com/3", "http://b.example.com/"]
+        CaptureJob.bulk_create_in_queue([CaptureJob(created_by=self.user_one, status='pending', submitted_url=url) for url in urls])
+        hosts = CaptureJob.objects.filter(status='pending').order_by('order').values_list('host', flat=True)
+        self.assertEqual(list(hosts), ['a.example.com', 'b.example.com', 'a.example.com', 'a.example.com'])
+
+    def test_claim_job_in_one_round_trip(self):
+        """ Reserving a job should take one query to see which lanes have jobs waiting, one to find the next, and one to claim it. """
+        job = create_capture_job(self.user_one)
+        with self.assertNumQueries(3):
+            next_job = CaptureJob.get_next_job(reserve=True)
+        self.assertEqual(next_job, job)
+        self.assertEqual(next_job.status, 'in_progress')
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'in_progress')
+        self.assertEqual(job.capture_start_time, next_job.capture_start_time)
+
+    def test_clean_up_deleted_jobs(self):
+        """ Pending jobs for deleted links should be cleared out of the queue by the periodic cleanup task. """
+        job = create_capture_job(self.user_one)
+        job.link.safe_delete()
+        job.link.save()
+        clean_up_capture_jobs()
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'deleted')
+
     def test_race_condition_prevented(self):
         """ Fetch two jobs at the same time in threads and make sure same job isn't returned to both. """
         jobs = [
@@ -122,3 +290,91 @@ class CaptureJobTestCase(TransactionTestCase):
 
         # failed jobs will have a message indicating failure reason
         self.assertEqual(json.loads(job.message)[api_settings.NON_FIELD_ERRORS_KEY][0], "Timed out.")
+
+    def test_concurrent_captures(self):
+        """ Each slot should claim jobs from the queue until it's empty, with captures overlapping. """
+        jobs = [create_capture_job(self.user_one) for _ in range(5)]
+        in_flight = []
+        max_in_flight = []
+        lock = threading.Lock()
+
+        def fake_capture(capture_job, halt):
+            with lock:
+                in_flight.append(capture_job.pk)
+                max_in_flight.append(len(in_flight))
+            time.sleep(.2)
+            with lock:
+                in_flight.remove(capture_job.pk)
+            capture_job.mark_failed('Test capture.')
+
+        with patch('perma.tasks.run_capture', side_effect=fake_capture) as mocked_run_capture:
+            self.assertEqual(run_concurrent_captures(2), len(jobs))
+
+        self.assertCountEqual([call[0][0].pk for call in mocked_run_capture.call_args_list], [job.pk for job in jobs])
+        self.assertEqual(max(max_in_flight), 2)
+        for job in jobs:
+            job.refresh_from_db()
+            self.assertEqual(job.status, 'failed')
+
+    def test_metrics_recorded_for_deleted_job(self):
+        """ A claimed job whose link was deleted should still be counted, without affecting its host's backoff. """
+        create_capture_job(self.user_one)
+        job = CaptureJob.get_next_job(reserve=True)
+        job.link.user_deleted = True
+        job.link.save()
+        before = load_capture_metrics()
+        with patch.object(CaptureJob, 'record_host_result') as mocked_record_host_result:
+            run_capture(job, threading.Event())
+        after = load_capture_metrics()
+
+        self.assertEqual(job.status, 'deleted')
+        self.assertEqual(after['statuses']['deleted'], before['statuses']['deleted'] + 1)
+        self.assertEqual(after['phases']['total']['count'], before['phases']['total']['count'] + 1)
+        mocked_record_host_result.assert_not_called()
+
+    def test_metrics_recorded_for_startup_failure(self):
+        """ A job that fails before its browser starts should be counted as failed, without affecting its host's backoff. """
+        create_capture_job(self.user_one)
+        job = CaptureJob.get_next_job(reserve=True)
+        Capture(link=job.link, role='primary', status='pending', record_type='response', url=job.link.submitted_url).save()
+        before = load_capture_metrics()
+        with patch('perma.tasks.capture_pool.checkout', side_effect=Exception("browser failed to start")), \
+                patch.object(CaptureJob, 'record_host_result') as mocked_record_host_result:
+            run_capture(job, threading.Event())
+        after = load_capture_metrics()
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(after['statuses']['failed'], before['statuses']['failed'] + 1)
+        self.assertEqual(after['phases']['total']['count'], before['phases']['total']['count'] + 1)
+        mocked_record_host_result.assert_not_called()
+
+    def test_progress_cached_between_steps(self):
+        """ Progress within a step should be reported from the cache, and only saved to the database at new steps. """
+        create_capture_job(self.user_one)
+        job = CaptureJob.get_next_job(reserve=True)
+
+        job.inc_progress(1, "Fetching target URL")
+        job.inc_progress(0.5, "Fetching target URL")
+        saved_job = CaptureJob.objects.get(pk=job.pk)
+        self.assertEqual((saved_job.step_count, saved_job.step_description), (1, "Fetching target URL"))
+        CaptureJob.load_cached_progress([saved_job])
+        self.assertEqual((saved_job.step_count, saved_job.step_description), (1.5, "Fetching target URL"))
+
+        job.inc_progress(1, "Waiting for post-load requests")
+        saved_job = CaptureJob.objects.get(pk=job.pk)
+        self.assertEqual((saved_job.step_count, saved_job.step_description), (2, "Waiting for post-load requests"))
+
+        job.inc_progress(0.25, "Waiting for post-load requests")
+        job.mark_failed('Test capture.')
+        saved_job = CaptureJob.objects.get(pk=job.pk)
+        self.assertEqual(saved_job.step_count, 2.25)
+
+    def test_progress_saved_when_cache_not_shared(self):
+        create_capture_job(self.user_one)
+        job = CaptureJob.get_next_job(reserve=True)
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}):
+            job.inc_progress(1, "Fetching target URL")
+            job.inc_progress(0.5, "Fetching target URL")
+        saved_job = CaptureJob.objects.get(pk=job.pk)
+        self.assertEqual(saved_job.step_count, 1.5)
@@ -0,0 +1,52 @@
+from django.core.cache import cache as django_cache
+from django.test import override_settings
+from django.urls import reverse
+
+from perma.metrics import format_percentiles, histogram_percentile, load_capture_metrics, load_daily_capture_metrics, record_capture
+
+from .utils import PermaTestCase
+
+
+class MetricsTestCase(PermaTestCase):
+
+    fixtures = ['fixtures/users.json']
+
+    def setUp(self):
+        django_cache.clear()
+
+    def test_record_capture(self):
+        record_capture({'total': 4, 'screenshot': .3}, 'completed')
+        record_capture({'total': 20}, 'failed')
+        for metrics in [load_capture_metrics(), load_daily_capture_metrics(0)]:
+            self.assertEqual(metrics['statuses'], {'completed': 1, 'failed': 1, 'deleted': 0})
+            self.assertEqual(metrics['phases']['total']['count'], 2)
+            self.assertEqual(metrics['phases']['total']['sum'], 24)
+            self.assertEqual(metrics['phases']['screenshot']['count'], 1)
+            self.assertEqual(metrics['phases']['onload']['count'], 0)
+        self.assertEqual(load_daily_capture_metrics(1)['phases']['total']['count'], 0)
+
+        buckets = load_capture_metrics()['phases']['total']['buckets']
+        self.assertEqual(histogram_percentile(buckets, .5), 5)
+        self.assertEqual(histogram_percentile(buckets, .95), 30)
+        self.assertEqual(format_percentiles(buckets), "0:00:05 / 0:00:05 / 0:00:30")
+        self.assertEqual(format_percentiles(load_capture_metrics()['phases']['onload']['buckets']), "-")
+
+    @override_settings(CAPTURE_METRICS_TOKEN='secret')
+    def test_capture_metrics_view(self):
+        record_capture({'total': 4}, 'completed')
+        url = reverse('service_capture_metrics')
+
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('perma_capture_phase_seconds_bucket{phase="total",le="2.5"} 0\n', body)
+        self.assertIn('perma_capture_phase_seconds_bucket{phase="total",le="5"} 1\n', body)
+        self.assertIn('perma_capture_phase_seconds_bucket{phase="total",le="+Inf"} 1\n', body)
+        self.assertIn('perma_captures_total{status="completed"} 1\n', body)
+        self.assertIn('perma_capture_queue_depth{lane="interactive"} 0\n', body)
+
+        self.log_in_user('test_admin_user@example.com')
+        self.assertEqual(self.client.get(url).status_code, 200)
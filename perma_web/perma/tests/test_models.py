@@ -3,10 +3,11 @@ from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
 from django.conf import settings
+from django.core.cache import cache as django_cache
 from django.test import override_settings
 from django.utils import timezone
 
-from mock import patch, sentinel
+from mock import Mock, patch, sentinel
 
 from perma.exceptions import PermaPaymentsCommunicationException, InvalidTransmissionException
 from perma.models import (
@@ -17,7 +18,7 @@ from perma.models import (
     most_active_org_in_time_period,
     subscription_is_active
 )
-from perma.utils import pp_date_from_post, tz_datetime, first_day_of_next_month, today_next_year
+from perma.utils import pp_date_from_post, tz_datetime, first_day_of_next_month, today_next_year, WR_PUBLIC_SESSION_CACHE_KEY
 
 from .utils import PermaTestCase
 
@@ -1447,3 +1448,55 @@ class ModelsTestCase(PermaTestCase):
                 self.assertEqual(folder.name, registrar.name)
             else:
                 self.assertNotEqual(folder.name, registrar.name)
+
+    # Playback
+
+    @override_settings(WR_PUBLIC_REPLAY_READY_TIMEOUT=60)
+    @patch('perma.models.query_wr_api', autospec=True)
+    def test_public_replay_state_cached(self, query_wr_api):
+        link = Link(submitted_url='https://example.com')
+        link.save()
+        request = Mock()
+        django_cache.delete(WR_PUBLIC_SESSION_CACHE_KEY)
+        self.addCleanup(django_cache.delete, WR_PUBLIC_SESSION_CACHE_KEY)
+        query_wr_api.side_effect = [
+            (Mock(cookies={'__wr_sesh': 'shared-cookie'}), {'username': settings.WR_PERMA_USER, 'coll_empty': True}),
+            (Mock(cookies={}), {'upload_id': 'upload'}),
+        ]
+        with patch('perma.models.default_storage.open'):
+            # the upload is started, and not waited for
+            self.assertIsNone(link.init_replay_for_user(request))
+        self.assertEqual(django_cache.get(WR_PUBLIC_SESSION_CACHE_KEY), 'shared-cookie')
+
+        query_wr_api.side_effect = [
+            (Mock(cookies={}), {'username': settings.WR_PERMA_USER, 'coll_empty': False}),
+            (Mock(cookies={}), {'done': 1}),
+        ]
+        self.assertEqual(link.init_replay_for_user(request), settings.WR_PERMA_USER)
+        # the shared session was reused
+        self.assertEqual(query_wr_api.call_args_list[2][1]['cookie'], 'shared-cookie')
+
+        # once the collection is loaded, playback doesn't need to ask WR
+        query_wr_api.reset_mock()
+        self.assertEqual(link.init_replay_for_user(request), settings.WR_PERMA_USER)
+        query_wr_api.assert_not_called()
+
+    @patch('perma.models.query_wr_api', autospec=True)
+    def test_public_upload_claimed_once(self, query_wr_api):
+        link = Link(submitted_url='https://example.com')
+        link.save()
+        self.addCleanup(django_cache.delete, link.wr_pending_upload_cache_key)
+        query_wr_api.return_value = (Mock(cookies={}), {'username': settings.WR_PERMA_USER, 'coll_empty': True})
+
+        # another process claims the upload between this one's check and its claim
+        self.assertTrue(link.claim_pending_wr_upload())
+        with patch.object(link, 'get_pending_wr_upload', return_value=None), \
+                patch.object(link, 'start_wr_upload') as start_wr_upload:
+            self.assertIsNone(link.init_replay_for_user(Mock()))
+            link.warm_replay()
+        start_wr_upload.assert_not_called()
+        self.assertFalse(link.claim_pending_wr_upload())
+
+        # without a cache, the upload goes ahead
+        with patch('perma.models.django_cache.add', return_value=None):
+            self.assertTrue(link.claim_pending_wr_upload())
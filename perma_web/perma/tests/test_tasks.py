@@ -1,11 +1,20 @@
+import io
 from mock import patch
 import requests
+import time
+
+from PIL import Image
 
 from django.core import mail
+from django.core.cache import cache as django_cache
+from django.core.files.storage import default_storage
 
 from django.test import TestCase, override_settings
 from perma.tasks import update_stats, upload_all_to_internet_archive, upload_to_internet_archive, delete_from_internet_archive, send_js_errors, verify_webrecorder_api_available
-from perma.models import Link, UncaughtError
+from perma.tasks import AFTER_LOAD_TIMEOUT, MIN_AFTER_LOAD_TIMEOUT, CaptureTracker, get_after_load_timeout, learn_after_load_time, learned_after_load_cache_key
+from perma.tasks import stitch_screenshot
+from perma.models import Capture, Link, UncaughtError
+from perma.utils import preserve_perma_warc
 
 @override_settings(CELERY_ALWAYS_EAGER=True, UPLOAD_TO_INTERNET_ARCHIVE=True)
 class TaskTestCase(TestCase):
@@ -65,3 +74,57 @@ class TaskTestCase(TestCase):
             mocked_get.return_value = response
             with self.assertRaises(requests.exceptions.RequestException):
                 self.assertFalse(verify_webrecorder_api_available.delay())
+
+    @override_settings(CAPTURE_NETWORK_IDLE_TIME=0)
+    def test_network_idle(self):
+        tracker = CaptureTracker()
+        self.assertTrue(tracker.network_idle())
+        tracker.proxied_pairs.append(['https://example.com/app.js', None])
+        self.assertFalse(tracker.network_idle())
+        tracker.proxied_pairs[0][1] = 'response'
+        tracker.proxied_pairs.append(['https://www.google-analytics.com/collect?v=1', None])
+        self.assertTrue(tracker.network_idle())
+        # not idle until after scrolling is done
+        self.assertFalse(tracker.network_idle(since=time.time() + 1))
+
+    def test_after_load_timeout_learned(self):
+        host = 'learned.example.com'
+        django_cache.delete(learned_after_load_cache_key(host))
+        self.assertEqual(get_after_load_timeout(host), AFTER_LOAD_TIMEOUT)
+        learn_after_load_time(host, 1)
+        self.assertEqual(get_after_load_timeout(host), MIN_AFTER_LOAD_TIMEOUT)
+        for _ in range(20):
+            learn_after_load_time(host, 8)
+        self.assertAlmostEqual(get_after_load_timeout(host), 16, delta=.1)
+
+    def test_stitch_screenshot(self):
+        link = Link(submitted_url='https://example.com')
+        link.save()
+        Capture(link=link, role='screenshot', status='pending', record_type='resource', url="file:///%s/cap.png" % link.guid, content_type='image/png').save()
+        with preserve_perma_warc(link.guid, link.creation_timestamp, link.warc_storage_file(), []):
+            pass
+        # a 100px window on a 250px page: the last tile is scrolled to 150, overlapping the one before
+        tile_paths = []
+        for i, (offset, color) in enumerate([(0, 'red'), (100, 'green'), (150, 'blue')]):
+            path = 'screenshot_tiles/%s/%d.png' % (link.guid, i)
+            png = io.BytesIO()
+            Image.new('RGB', (80, 100), color).save(png, 'PNG')
+            with default_storage.stream_to_file(path) as tile_file:
+                tile_file.write(png.getvalue())
+            tile_paths.append((offset, path))
+
+        # a playback in the meantime loaded the warc without the screenshot
+        django_cache.set(link.wr_replay_ready_cache_key, True)
+
+        try:
+            with patch.object(Link, 'delete_from_wr') as delete_from_wr:
+                stitch_screenshot.delay(link.guid, tile_paths, 250, 100)
+            link.refresh_from_db()
+            self.assertEqual(link.screenshot_capture.status, 'success')
+            self.assertEqual(link.warc_size, default_storage.size(link.warc_storage_file()))
+            self.assertFalse(any(default_storage.exists(path) for offset, path in tile_paths))
+            # the next playback loads the new warc
+            self.assertFalse(link.public_replay_ready())
+            delete_from_wr.assert_called_once()
+        finally:
+            default_storage.delete(link.warc_storage_file())
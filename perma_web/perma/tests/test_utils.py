@@ -1,25 +1,41 @@
 from datetime import datetime, timedelta
 import decimal
-from mock import patch, sentinel
+import json
+import os
+from mock import Mock, patch, sentinel
+import requests
 
 from django.conf import settings
+from django.core.files.storage import default_storage
 from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
 
 from hypothesis import given
 from hypothesis.extra.django import TestCase
 from hypothesis.strategies import characters, text, integers, booleans, datetimes, dates, decimals, uuids, binary, dictionaries
 from perma.utils import (
     InvalidTransmissionException,
+    cache_url_check,
     decrypt_from_perma_payments,
     encrypt_for_perma_payments,
     get_client_ip, prep_for_perma_payments,
+    index_warc,
     is_valid_timestamp,
+    append_to_perma_warc,
+    preserve_perma_warc,
+    parse_range_header,
     process_perma_payments_transmission,
+    query_wr_api,
     retrieve_fields,
+    serve_stored_file,
     stringify_data,
     unstringify_data
 )
 
+from perma.exceptions import WebrecorderException
+from perma.metrics import load_wr_api_metrics
+
 from .utils import SentinelException
 
 # Fixtures
@@ -196,3 +212,142 @@ class UtilsTestCase(TestCase):
         ci = encrypt_for_perma_payments(b)
         assert decrypt_from_perma_payments(ci) == b
 
+    def test_preserve_perma_warc_streams_to_storage(self):
+        path = 'warcs/test/streamed.warc.gz'
+        warc_size = []
+        with preserve_perma_warc('TEST-GUID', timezone.now(), path, warc_size) as warc:
+            warc.write(b'recorded records')
+        try:
+            self.assertEqual(warc_size[0], default_storage.size(path))
+            with default_storage.open(path) as stored_warc:
+                self.assertTrue(stored_warc.read().endswith(b'recorded records'))
+        finally:
+            default_storage.delete(path)
+
+    def test_preserve_perma_warc_saves_nothing_on_failure(self):
+        path = 'warcs/test/failed.warc.gz'
+        with self.assertRaises(SentinelException):
+            with preserve_perma_warc('TEST-GUID', timezone.now(), path, []) as warc:
+                warc.write(b'recorded records')
+                raise SentinelException
+        self.assertFalse(default_storage.exists(path))
+
+    def test_append_to_perma_warc(self):
+        path = 'warcs/test/appended.warc.gz'
+        with preserve_perma_warc('TEST-GUID', timezone.now(), path, []) as warc:
+            warc.write(b'recorded records')
+        warc_size = []
+        with append_to_perma_warc(path, warc_size) as warc:
+            warc.write(b'screenshot')
+        try:
+            self.assertEqual(warc_size[0], default_storage.size(path))
+            with default_storage.open(path) as stored_warc:
+                self.assertTrue(stored_warc.read().endswith(b'recorded recordsscreenshot'))
+        finally:
+            default_storage.delete(path)
+
+    def test_index_warc(self):
+        with open(os.path.join(settings.PROJECT_ROOT, 'perma/tests/assets/new_style_archive/archive.warc.gz'), 'rb') as warc_file:
+            index, pages = index_warc(warc_file, 'archive.warc.gz')
+        self.assertEqual([line.split(' ')[0] for line in index], ['com,example)/', 'com,example)/robots.txt'])
+        self.assertEqual(json.loads(index[0].split(' ', 2)[2])['filename'], 'archive.warc.gz')
+        # robots.txt isn't a page
+        self.assertEqual([page['url'] for page in pages], ['http://example.com/'])
+
+    def test_parse_range_header(self):
+        self.assertEqual(parse_range_header('bytes=0-99', 1000), (0, 99))
+        self.assertEqual(parse_range_header('bytes=900-', 1000), (900, 999))
+        self.assertEqual(parse_range_header('bytes=-100', 1000), (900, 999))
+        self.assertEqual(parse_range_header('bytes=500-2000', 1000), (500, 999))
+        # ignored: send the whole thing
+        for header in [None, 'bytes=0-99,200-299', 'bytes=99-0', 'bytes=abc', 'items=0-99']:
+            self.assertIsNone(parse_range_header(header, 1000))
+        for header in ['bytes=1000-', 'bytes=-0']:
+            with self.assertRaises(ValueError):
+                parse_range_header(header, 1000)
+
+    def test_serve_stored_file(self):
+        path = 'warcs/test/served.warc.gz'
+        with default_storage.stream_to_file(path, send_signal=False) as stored_file:
+            stored_file.write(b'0123456789')
+        try:
+            response = serve_stored_file(self.factory.get('/'), path, 'served.warc.gz', prefix=b'abc')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), b'abc0123456789')
+            self.assertEqual(response['Content-Length'], '13')
+            self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+            # ranges can span the prefix and the file
+            response = serve_stored_file(self.factory.get('/', HTTP_RANGE='bytes=1-5'), path, 'served.warc.gz', prefix=b'abc')
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(b''.join(response.streaming_content), b'bc012')
+            self.assertEqual(response['Content-Range'], 'bytes 1-5/13')
+            self.assertEqual(response['Content-Length'], '5')
+
+            # resuming works only if the content hasn't changed
+            etag = response['ETag']
+            response = serve_stored_file(self.factory.get('/', HTTP_RANGE='bytes=10-', HTTP_IF_RANGE=etag), path, 'served.warc.gz', prefix=b'abc')
+            self.assertEqual(b''.join(response.streaming_content), b'789')
+            response = serve_stored_file(self.factory.get('/', HTTP_RANGE='bytes=10-', HTTP_IF_RANGE=etag), path, 'served.warc.gz', prefix=b'abcd')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(b''.join(response.streaming_content), b'abcd0123456789')
+
+            response = serve_stored_file(self.factory.get('/', HTTP_RANGE='bytes=20-'), path, 'served.warc.gz')
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response['Content-Range'], 'bytes */10')
+
+            # offloaded to the web server
+            with override_settings(WARC_DOWNLOAD_OFFLOAD=True, WARC_DOWNLOAD_SENDFILE_HEADER='X-Accel-Redirect', WARC_DOWNLOAD_ACCEL_PREFIX='/protected-media/'):
+                response = serve_stored_file(self.factory.get('/'), path, 'served.warc.gz')
+                self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + path)
+                self.assertEqual(response.content, b'')
+                # but not if there's something to prepend
+                response = serve_stored_file(self.factory.get('/'), path, 'served.warc.gz', prefix=b'abc')
+                self.assertNotIn('X-Accel-Redirect', response)
+        finally:
+            default_storage.delete(path)
+
+    @override_settings(URL_VALIDATION_CACHE_TIMEOUT=60, URL_VALIDATION_NEGATIVE_CACHE_TIMEOUT=60)
+    def test_cache_url_check(self):
+        check = Mock(return_value='1.2.3.4')
+        self.assertEqual(cache_url_check('ip-cached.example.com', check), '1.2.3.4')
+        self.assertEqual(cache_url_check('ip-cached.example.com', check), '1.2.3.4')
+        check.assert_called_once()
+
+        # failures are remembered too
+        check = Mock(return_value=False)
+        self.assertFalse(cache_url_check('ip-failed.example.com', check))
+        self.assertFalse(cache_url_check('ip-failed.example.com', check))
+        check.assert_called_once()
+
+        # unless they shouldn't be
+        with override_settings(URL_VALIDATION_NEGATIVE_CACHE_TIMEOUT=0):
+            check = Mock(return_value=False)
+            cache_url_check('ip-uncached.example.com', check)
+            cache_url_check('ip-uncached.example.com', check)
+            self.assertEqual(check.call_count, 2)
+
+    @override_settings(WR_API_RETRIES=2, WR_API_RETRY_BACKOFF=0)
+    @patch('perma.utils.get_wr_api_session', autospec=True)
+    def test_query_wr_api_retries(self, get_session):
+        before = load_wr_api_metrics()['DELETE /user']
+        ok = Mock(status_code=200)
+        ok.json.return_value = {'deleted_user': 'x'}
+
+        # WR unreachable, then a gateway error, then an answer
+        get_session.return_value.request.side_effect = [requests.exceptions.ConnectionError(), Mock(status_code=502), ok]
+        response, data = query_wr_api('delete', '/user/x', 'cookie', lambda code, data: code == 200)
+        self.assertEqual(data, {'deleted_user': 'x'})
+        self.assertEqual(get_session.return_value.request.call_count, 3)
+
+        # uploads aren't retried
+        get_session.return_value.request.reset_mock(side_effect=True)
+        get_session.return_value.request.side_effect = requests.exceptions.ConnectionError()
+        with self.assertRaises(WebrecorderException):
+            query_wr_api('put', '/upload?filename=x', 'cookie', lambda code, data: code == 200, data=b'warc')
+        get_session.return_value.request.assert_called_once()
+
+        after = load_wr_api_metrics()['DELETE /user']
+        self.assertEqual(after['outcomes']['ok'] - before['outcomes']['ok'], 1)
+        self.assertEqual(after['retries'] - before['retries'], 2)
+        self.assertEqual(after['count'] - before['count'], 1)
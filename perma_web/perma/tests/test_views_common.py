@@ -127,6 +127,21 @@ class CommonViewsTestCase(PermaTestCase):
                 self.assertNotIn('memento-datetime', response._headers)
                 self.assertNotIn('link', response._headers)
 
+    def test_replay_status(self):
+        link = Link.objects.get(guid='3SLN-JHX9')
+        response = self.get('single_permalink', reverse_kwargs={'kwargs': {'guid': link.guid}})
+        self.assertIn(reverse('replay_status', args=[link.guid]).encode(), response.content)
+
+        with patch.object(Link, 'init_replay_for_user', return_value=None):
+            response = self.get('replay_status', reverse_kwargs={'args': [link.guid]})
+            self.assertEqual(response.json(), {'ready': False})
+        with patch.object(Link, 'init_replay_for_user', return_value='public'):
+            response = self.get('replay_status', reverse_kwargs={'args': [link.guid]})
+            self.assertEqual(response.json(), {'ready': True, 'wr_prefix': link.wr_iframe_prefix('public')})
+
+        # private links are only ready for those who can see them
+        self.get('replay_status', reverse_kwargs={'args': ['ABCD-0001']}, require_status_code=404)
+
     def test_redirect_to_download(self):
         with patch('perma.models.default_storage.open', lambda path, mode: open(os.path.join(settings.PROJECT_ROOT, 'perma/tests/assets/new_style_archive/archive.warc.gz'), 'rb')):
             # Give user option to download to view pdf if on mobile
@@ -2463,6 +2463,7 @@ class UserManagementViewsTestCase(PermaTestCase):
     def test_admin_stats(self):
         self.log_in_user(self.admin_user)
         self.get('user_management_stats', reverse_kwargs={'args':['days']})
+        self.get('user_management_stats', reverse_kwargs={'args':['capture_phases']})
         self.get('user_management_stats', reverse_kwargs={'args':['celery']})
         self.get('user_management_stats', reverse_kwargs={'args':['random']})
         self.get('user_management_stats', reverse_kwargs={'args':['emails']})
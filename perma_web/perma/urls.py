@@ -41,6 +41,7 @@ urlpatterns = [
     #Services
     url(r'^service/stats/sums/?$', service.stats_sums, name='service_stats_sums'),
     url(r'^service/stats/now/?$', service.stats_now, name='service_stats_now'),
+    url(r'^service/metrics/?$', service.capture_metrics, name='service_capture_metrics'),
     url(r'^service/bookmarklet-create/?$', service.bookmarklet_create, name='service_bookmarklet_create'),
     url(r'^service/get-coordinates/?$', service.coordinates_from_address, name='service_coordinates_from_address'),
     #url(r'^service/thumbnail/%s/thumbnail.png$' % guid_pattern, service.get_thumbnail, name='service_get_thumbnail'),
@@ -140,6 +141,8 @@ urlpatterns = [
     # WR playback-related
     # pass webrecorder session cookie to iframe
     url(r'^_set_session/?$', common.set_iframe_session_cookie, name='set_iframe_session_cookie'),
+    # tell a Perma Link's page when playback is ready
+    url(r'^replay-status/%s/?$' % guid_pattern, common.replay_status, name='replay_status'),
     # display custom template when WR reports a replay error
     url(r'^archive-error/?$', common.archive_error, name='archive_error'),
 
@@ -2,10 +2,10 @@ from contextlib import contextmanager
 from collections import OrderedDict
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
-from functools import wraps, reduce
+from functools import lru_cache, wraps, reduce
 import hashlib
+from http.cookiejar import CookiePolicy
 from hanzo import warctools
-import itertools
 import json
 import logging
 from nacl import encoding
@@ -13,25 +13,29 @@ from nacl.public import Box, PrivateKey, PublicKey
 from netaddr import IPAddress, IPNetwork
 import operator
 import os
+import random
 import requests
 import socket
 import string
 import surt
 import tempdir
-import tempfile
+import time
 from ua_parser import user_agent_parser
 import unicodedata
+import uuid
 from urllib.parse import urlparse
+from warcio.archiveiterator import ArchiveIterator
+from warcio.timeutils import datetime_to_iso_date, iso_date_to_timestamp
 from warcio.warcwriter import BufferWARCWriter
-from wsgiref.util import FileWrapper
 
 from django.core.paginator import Paginator, EmptyPage
 from django.db.models import Q
 from django.conf import settings
+from django.core.cache import cache as django_cache
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.urls import reverse
 from django.core.serializers.json import DjangoJSONEncoder
-from django.http import HttpResponseForbidden, Http404, StreamingHttpResponse
+from django.http import HttpResponse, HttpResponseForbidden, Http404, StreamingHttpResponse
 from django.utils.decorators import available_attrs
 from django.contrib.auth.decorators import login_required
 from django.core.files.storage import default_storage
@@ -39,6 +43,7 @@ from django.utils import timezone
 from django.views.decorators.debug import sensitive_variables
 
 from .exceptions import InvalidTransmissionException, WebrecorderException
+from .metrics import record_wr_api_call, wr_api_call_name
 
 logger = logging.getLogger(__name__)
 warn = logger.warn
@@ -245,6 +250,27 @@ def url_in_allowed_ip_range(url):
         return False
     return ip_in_allowed_ip_range(ip)
 
+def cache_is_shared():
+    """ Whether every process sees the same default cache: not so for per-process LocMemCache, or DummyCache. """
+    return settings.CACHES['default']['BACKEND'] not in (
+        'django.core.cache.backends.locmem.LocMemCache',
+        'django.core.cache.backends.dummy.DummyCache',
+    )
+
+def cache_url_check(key, check):
+    """
+        Return check(), remembering the result for settings.URL_VALIDATION_CACHE_TIMEOUT seconds,
+        or, if it's falsy, for settings.URL_VALIDATION_NEGATIVE_CACHE_TIMEOUT seconds.
+    """
+    key = 'url-check-{}'.format(hashlib.sha256(key.encode('utf-8')).hexdigest())
+    result = django_cache.get(key)
+    if result is None:
+        result = check()
+        timeout = settings.URL_VALIDATION_CACHE_TIMEOUT if result else settings.URL_VALIDATION_NEGATIVE_CACHE_TIMEOUT
+        if timeout:
+            django_cache.set(key, result, timeout)
+    return result
+
 def get_client_ip(request):
     return request.META[settings.CLIENT_IP_HEADER]
 
@@ -498,19 +524,45 @@ def decrypt_from_perma_payments(ciphertext, encoder=encoding.Base64Encoder):
 def preserve_perma_warc(guid, timestamp, destination, warc_size):
     """
     Context manager for opening a perma warc, ready to receive warc records.
-    Safely closes and saves the file to storage when context is exited.
+    Records are streamed to storage as they are written, and the file is saved
+    when the context is exited.
     """
-    # mode set to 'ab+' as a workaround for https://bugs.python.org/issue25341
-    out = tempfile.TemporaryFile('ab+')
-    write_perma_warc_header(out, guid, timestamp)
-    try:
+    with default_storage.stream_to_file(destination) as out:
+        out = CountingWriter(out)
+        write_perma_warc_header(out, guid, timestamp)
         yield out
-    finally:
-        out.flush()
-        warc_size.append(out.tell())
-        out.seek(0)
-        default_storage.store_file(out, destination, overwrite=True)
-        out.close()
+    warc_size.append(out.size)
+
+@contextmanager
+def append_to_perma_warc(destination, warc_size):
+    """
+    Context manager for adding warc records to the end of an existing perma warc.
+    The warc is copied to a new file in storage, followed by the new records, which
+    replaces the old one when the context is exited.
+    """
+    with default_storage.open(destination) as existing, default_storage.stream_to_file(destination) as out:
+        out = CountingWriter(out)
+        copy_file_data(existing, out)
+        yield out
+    warc_size.append(out.size)
+
+class CountingWriter:
+    """
+    Wraps a writable file object, counting the bytes written through it.
+    """
+    def __init__(self, out):
+        self.out = out
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return self.out.write(data)
+
+    def flush(self):
+        return self.out.flush()
+
+    def tell(self):
+        return self.size
 
 def write_perma_warc_header(out_file, guid, timestamp):
     # build warcinfo header
@@ -529,11 +581,14 @@ def write_perma_warc_header(out_file, guid, timestamp):
     warcinfo_record.write_to(out_file, gzip=True)
 
 
-def make_detailed_warcinfo(filename, guid, coll_title, coll_desc, rec_title, pages):
+def make_detailed_warcinfo(filename, guid, coll_title, coll_desc, rec_title, pages, warc_date=None):
     # #
     # Thank you! Rhizome/Webrecorder.io/Ilya Kreymer
     # #
 
+    # If warc_date is given, the records are dated then, and their IDs are derived from their contents,
+    # so that the same metadata always makes the same bytes (which lets interrupted downloads resume).
+
     coll_metadata = {'type': 'collection',
                      'title': coll_title,
                      'desc': coll_desc}
@@ -549,14 +604,20 @@ def make_detailed_warcinfo(filename, guid, coll_title, coll_desc, rec_title, pag
                           ('format', 'WARC File Format 1.0'),
                           ('json-metadata', json.dumps(coll_metadata))])
 
-    record = writer.create_warcinfo_record(filename, params)
-    writer.write_record(record)
+    def write_warcinfo_record():
+        record = writer.create_warcinfo_record(filename, params)
+        if warc_date:
+            record.rec_headers.replace_header('WARC-Date', datetime_to_iso_date(warc_date))
+            record.rec_headers.replace_header('WARC-Record-ID', '<urn:uuid:{}>'.format(
+                uuid.uuid5(uuid.NAMESPACE_URL, 'perma-download:{}:{}'.format(filename, json.dumps(params)))))
+        writer.write_record(record)
+
+    write_warcinfo_record()
 
     # Rec Info
     params['json-metadata'] = json.dumps(rec_metadata)
 
-    record = writer.create_warcinfo_record(filename, params)
-    writer.write_record(record)
+    write_warcinfo_record()
 
     return writer.get_contents()
 
@@ -586,9 +647,69 @@ def write_resource_record_from_asset(data, url, content_type, out_file, extra_he
     record = warctools.WarcRecord(headers=headers, content=(bytes(content_type, 'utf-8'), data))
     record.write_to(out_file, gzip=True)
 
-def get_warc_stream(link):
+EMPTY_DIGEST = '3I42H3S6NNFQ2MSVX7XZKYAYSCX5QBYJ'  # sha1 of an empty payload
+
+def index_warc(warc_file, filename):
+    """
+    Index a warc, as Webrecorder does when one is uploaded for playback.
+    Returns its sorted CDXJ index lines, and the pages Webrecorder would detect in it,
+    as a list of dicts with url, title and timestamp.
+    """
+    index = []
+    pages = []
+    records = ArchiveIterator(warc_file)
+    for record in records:
+        if record.rec_type not in ('response', 'resource', 'revisit'):
+            records.read_to_end(record)
+            continue
+        url = record.rec_headers.get_header('WARC-Target-URI')
+        timestamp = iso_date_to_timestamp(record.rec_headers.get_header('WARC-Date'))
+        fields = OrderedDict([('url', url)])
+        if record.rec_type == 'revisit':
+            fields['mime'] = 'warc/revisit'
+        elif record.http_headers:
+            fields['mime'] = (record.http_headers.get_header('Content-Type') or 'unk').split(';')[0].strip().lower()
+        else:
+            fields['mime'] = record.rec_headers.get_header('Content-Type')
+        if record.http_headers:
+            fields['status'] = record.http_headers.get_statuscode()
+        digest = record.rec_headers.get_header('WARC-Payload-Digest') or record.rec_headers.get_header('WARC-Block-Digest')
+        fields['digest'] = digest.split(':', 1)[-1] if digest else '-'
+        records.read_to_end(record)
+        offset, length = records.member_info
+        fields['length'] = str(length)
+        fields['offset'] = str(offset)
+        fields['filename'] = filename
+        index.append('{} {} {}'.format(surt.surt(url), timestamp, json.dumps(fields)))
+        if warc_record_is_page(fields):
+            pages.append({'url': url, 'title': url, 'timestamp': timestamp})
+    index.sort()
+    return index, pages
+
+def warc_record_is_page(fields):
+    """
+    Given the CDXJ fields for a warc record, guess whether it's a page, by Webrecorder's rules
+    (see services/docker/webrecorder/importer.py).
+    """
+    url = fields['url']
+    if url.endswith('/robots.txt') or not url.startswith(('http://', 'https://')):
+        return False
+    status = fields.get('status', '-')
+    if fields['mime'] not in ('text/html', 'text/plain') or status not in ('200', '-') or fields['digest'] == EMPTY_DIGEST:
+        return False
+    if status == '200':
+        # a query longer than the rest of the url is probably not a page
+        parts = url.split('?', 1)
+        if len(parts) == 2 and len(parts[1]) > len(parts[0]):
+            return False
+    return True
+
+def get_warc_stream(link, request=None):
     filename = "%s.warc.gz" % link.guid
 
+    if not settings.WARC_DOWNLOAD_INCLUDE_WARCINFO:
+        return serve_stored_file(request, link.warc_storage_file(), filename)
+
     timestamp = link.creation_timestamp.strftime('%Y%m%d%H%M%S')
 
     warcinfo = make_detailed_warcinfo(
@@ -601,28 +722,103 @@ def get_warc_stream(link):
             'title': link.submitted_title,
             'url': link.submitted_url,
             'timestamp': timestamp
-        }]
+        }],
+        warc_date = link.creation_timestamp
     )
 
-    warc_stream = FileWrapper(default_storage.open(link.warc_storage_file()))
-    warc_stream = itertools.chain([warcinfo], warc_stream)
-    response = StreamingHttpResponse(warc_stream, content_type="application/gzip")
+    return serve_stored_file(request, link.warc_storage_file(), filename, prefix=warcinfo)
+
+
+def parse_range_header(header, size):
+    """
+    Given a Range header and the size of the content it applies to, return the (first, last) byte
+    of the range requested. Return None if the whole content should be sent instead: when there's no
+    header, or it isn't one we handle (multiple ranges are allowed to be ignored).
+    Raise ValueError if the range can't be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, sep, last = header[len('bytes='):].strip().partition('-')
+    if not sep or not (first + last).isdigit():
+        return None
+    if not first:
+        # the last `last` bytes
+        if int(last) == 0 or size == 0:
+            raise ValueError("Unsatisfiable range")
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise ValueError("Unsatisfiable range")
+    return first, min(int(last), size - 1) if last else size - 1
+
+def read_stored_file_range(file_path, prefix, first, last, chunk_size=1024 * 1024):
+    """ Yield bytes `first` to `last` (inclusive) of `prefix` followed by the stored file at file_path. """
+    if first < len(prefix):
+        yield prefix[first:last + 1]
+    remaining = last + 1 - max(first, len(prefix))
+    if remaining <= 0:
+        return
+    with default_storage.open(file_path) as file:
+        file.seek(max(first - len(prefix), 0))
+        while remaining > 0:
+            chunk = file.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+def serve_stored_file(request, file_path, filename, prefix=b''):
+    """
+    Respond with the stored file at file_path, as an attachment named `filename`, preceded by `prefix`.
+
+    With nothing to prepend, and settings.WARC_DOWNLOAD_OFFLOAD on, the storage backend hands the
+    download to something else (see BaseMediaStorage.offloaded_download_response).
+    Otherwise we stream it ourselves, honoring Range and If-Range so that downloads can resume.
+    """
+    if not prefix and settings.WARC_DOWNLOAD_OFFLOAD:
+        response = default_storage.offloaded_download_response(file_path, filename)
+        if response is not None:
+            return response
+
+    size = len(prefix) + default_storage.size(file_path)
+    etag = '"{}"'.format(hashlib.sha256(prefix + '{}:{}'.format(file_path, size).encode()).hexdigest()[:32])
+
+    byte_range = None
+    range_header = request.META.get('HTTP_RANGE') if request else None
+    if_range = request.META.get('HTTP_IF_RANGE') if request else None
+    if range_header and (not if_range or if_range == etag):
+        try:
+            byte_range = parse_range_header(range_header, size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */{}'.format(size)
+            return response
+
+    first, last = byte_range or (0, size - 1)
+    response = StreamingHttpResponse(read_stored_file_range(file_path, prefix, first, last), content_type="application/gzip")
+    if byte_range:
+        response.status_code = 206
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(first, last, size)
+    response['Content-Length'] = last - first + 1
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
     response['Content-Disposition'] = 'attachment; filename="%s"' % filename
-
     return response
 
-def stream_warc(link):
+def stream_warc(link, request=None):
     # `link.user_deleted` is checked here for dev convenience:
     # it's easy to forget that deleted links/warcs aren't truly deleted,
     # and easy to accidentally permit the downloading of "deleted" warcs.
     # Users of stream_warc shouldn't have to worry about / remember this.
     if link.user_deleted or not link.can_play_back():
         raise Http404
-    return get_warc_stream(link)
+    return get_warc_stream(link, request)
 
-def stream_warc_if_permissible(link, user):
+def stream_warc_if_permissible(link, user, request=None):
     if user.can_view(link):
-        return stream_warc(link)
+        return stream_warc(link, request)
     return HttpResponseForbidden('Private archive.')
 
 
@@ -637,6 +833,7 @@ def clear_wr_session(request, error_if_wr_user_not_found=False):
     wr_temp_username = request.session.pop('wr_temp_username', '')
     wr_private_session_cookie = request.session.pop('wr_private_session_cookie', '')
     request.session.pop('wr_public_session_cookie', '')
+    request.session.pop('wr_pending_uploads', None)
     request.session.save()
 
     if not wr_temp_username or not wr_private_session_cookie:
@@ -662,34 +859,98 @@ def clear_wr_session(request, error_if_wr_user_not_found=False):
         logger.log(log_level, 'Attempt to delete {} from WR failed: already expired?'.format(wr_temp_username))
 
 
+class BlockAllCookies(CookiePolicy):
+    """
+    A cookie policy that neither accepts nor returns cookies, for sessions
+    that must not carry cookies from one request to the next.
+    """
+    netscape = True
+    rfc2965 = hide_cookie2 = False
+
+    def set_ok(self, cookie, request):
+        return False
+
+    def return_ok(self, cookie, request):
+        return False
+
+    def domain_return_ok(self, domain, request):
+        return False
+
+    def path_return_ok(self, path, request):
+        return False
+
+@lru_cache()
+def wr_api_session_for_process(pid):
+    session = requests.Session()
+    # Calls pass the WR session cookie they mean to use; the session itself must not remember any.
+    session.cookies.set_policy(BlockAllCookies())
+    session.mount(settings.WR_API, requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=settings.WR_API_POOL_SIZE))
+    return session
+
+def get_wr_api_session():
+    """
+    The session for calls to the WR API, which keeps a pool of keep-alive connections
+    for all threads in this process. (Forked processes get their own, rather than sharing sockets.)
+    """
+    return wr_api_session_for_process(os.getpid())
+
+WR_API_RETRY_STATUSES = {502, 503, 504}
+
 def query_wr_api(method, path, cookie, valid_if, json=None, data=None):
-    # Make the request
-    try:
-        response = requests.request(
-            method,
-            settings.WR_API + path,
-            json=json,
-            data=data,
-            cookies={'__wr_sesh': cookie} if cookie else None,
-            timeout=10,
-            allow_redirects=False
-        )
-    except requests.exceptions.RequestException as e:
-        raise WebrecorderException() from e
+    call = wr_api_call_name(method, path)
+    start_time = time.time()
+
+    # Make the request, retrying if WR can't be reached -- unless we're sending it a file,
+    # which we can't rewind to send again
+    attempts = 1 if data is not None else settings.WR_API_RETRIES + 1
+    for attempt in range(attempts):
+        if attempt:
+            # back off, with jitter, so that retries from many visitors don't all arrive together
+            time.sleep(random.uniform(0, settings.WR_API_RETRY_BACKOFF * 2 ** (attempt - 1)))
+        try:
+            response = get_wr_api_session().request(
+                method,
+                settings.WR_API + path,
+                json=json,
+                data=data,
+                cookies={'__wr_sesh': cookie} if cookie else None,
+                timeout=settings.WR_API_TIMEOUT,
+                allow_redirects=False
+            )
+        except requests.exceptions.RequestException as e:
+            if attempt == attempts - 1:
+                record_wr_api_call_safely(call, time.time() - start_time, 'unreachable', attempt)
+                raise WebrecorderException() from e
+            continue
+        if response.status_code not in WR_API_RETRY_STATUSES:
+            break
 
     # Validate the response
     try:
         data = safe_get_response_json(response)
         assert valid_if(response.status_code, data)
     except AssertionError:
+        record_wr_api_call_safely(call, time.time() - start_time, 'invalid', attempt)
         raise WebrecorderException("{code}: {message}".format(
             code=response.status_code,
             message=str(data)
         ))
 
+    record_wr_api_call_safely(call, time.time() - start_time, 'ok', attempt)
     return response, data
 
 
+def record_wr_api_call_safely(*args):
+    # metrics are nice to have: don't let them get in the way of playback
+    try:
+        record_wr_api_call(*args)
+    except Exception:
+        logger.exception("Error recording WR API metrics")
+
+
+# The WR session shared by playbacks of public links, which all belong to WR_PERMA_USER
+WR_PUBLIC_SESSION_CACHE_KEY = 'wr-public-session-cookie'
+
 def get_wr_session_cookie(request, session_key):
     cookie = request.session.get(session_key)
     timestamp = request.session.get(session_key + '_timestamp')
@@ -4,7 +4,6 @@ from dateutil.tz import tzutc
 from io import StringIO
 from link_header import Link as Rel, LinkHeader
 from urllib.parse import urlencode
-import time
 from timegate.utils import closest
 from warcio.timeutils import datetime_to_http_date
 from werkzeug.http import parse_date
@@ -12,14 +11,14 @@ from werkzeug.http import parse_date
 from django.forms import widgets
 from django.shortcuts import render, get_object_or_404, redirect
 from django.http import (HttpResponse, HttpResponseRedirect, HttpResponsePermanentRedirect,
-    JsonResponse, HttpResponseNotFound, HttpResponseBadRequest)
+    JsonResponse, HttpResponseNotFound, HttpResponseBadRequest, Http404)
 from django.urls import reverse, NoReverseMatch
 from django.conf import settings
 from django.core.files.storage import default_storage
 from django.utils import timezone
 from django.views.generic import TemplateView
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.cache import cache_control
+from django.views.decorators.cache import cache_control, never_cache
 
 from django.utils.six.moves.http_client import responses
 
@@ -145,7 +144,7 @@ def single_permalink(request, guid):
 
     # serve raw WARC
     if serve_type == 'warc_download':
-        return stream_warc_if_permissible(link, request.user)
+        return stream_warc_if_permissible(link, request.user, request)
 
     # handle requested capture type
     if serve_type == 'image':
@@ -202,35 +201,21 @@ def single_permalink(request, guid):
     }
 
     if context['can_view'] and link.can_play_back():
-        if new_record:
-            logger.info(f"Ensuring warc for {link.guid} has finished uploading.")
-            start_time = time.time()
-            while not default_storage.exists(link.warc_storage_file()):
-                wait_time = time.time() - start_time
-                if wait_time > settings.WARC_AVAILABLE_TIMEOUT:
-                    logger.error(f"Waited {wait_time} for {link.guid}'s warc; still not available.")
-                    return render(request, 'archive/playback-delayed.html', context,  status=500)
-                time.sleep(1)
-        try:
-            logger.info(f"Initializing play back of {link.guid}")
-            wr_username = link.init_replay_for_user(request)
-        except Exception:  # noqa
-            # We are experiencing many varieties of transient flakiness in playback:
-            # second attempts, triggered by refreshing the page, almost always seem to work.
-            # While we debug... let's give playback a second try here, and see if this
-            # noticeably improves user experience.
-            logger.exception(f"First attempt to init replay of {link.guid} failed. (Retrying: observe whether this error recurs.)")
-            time.sleep(settings.WR_PLAYBACK_RETRY_AFTER)
-            logger.info(f"Initializing play back of {link.guid} (2nd try)")
-            wr_username = link.init_replay_for_user(request)
-
         logger.info(f"Updating context with WR playback information for {link.guid}")
         context.update({
             'wr_host': settings.PLAYBACK_HOST,
-            'wr_prefix': link.wr_iframe_prefix(wr_username),
             'wr_url': capture.url,
             'wr_timestamp': link.creation_timestamp.strftime('%Y%m%d%H%M%S'),
         })
+        if link.public_replay_ready():
+            context['wr_prefix'] = link.wr_iframe_prefix(settings.WR_PERMA_USER)
+        else:
+            # don't hold up the page: it polls replay_status until playback is ready
+            context.update({
+                'replay_status_url': reverse('replay_status', args=[link.guid]),
+                'replay_wait': settings.WARC_AVAILABLE_TIMEOUT + settings.WR_REPLAY_UPLOAD_TIMEOUT,
+                'replay_retry_after': settings.WR_PLAYBACK_RETRY_AFTER,
+            })
 
     logger.info(f"Rendering template for {link.guid}")
     response = render(request, 'archive/single-link.html', context)
@@ -264,6 +249,41 @@ def single_permalink(request, guid):
     return response
 
 
+@never_cache
+@ratelimit(rate=settings.MINUTE_LIMIT, block=True, key=ratelimit_ip_key)
+@ratelimit(rate=settings.HOUR_LIMIT, block=True, key=ratelimit_ip_key)
+@ratelimit(rate=settings.DAY_LIMIT, block=True, key=ratelimit_ip_key)
+def replay_status(request, guid):
+    """
+    Report whether a Perma Link is ready to play back, setting up its Webrecorder
+    collection if need be. Polled by single_permalink's page, which is rendered
+    without waiting for playback to be ready.
+    """
+    link = get_object_or_404(Link, guid=guid)
+    if not request.user.can_view(link) or not link.can_play_back():
+        raise Http404
+
+    not_ready = JsonResponse({'ready': False})
+
+    # warcs aren't always available from storage immediately after they're saved
+    if link.creation_timestamp > timezone.now() - timedelta(seconds=300) and not default_storage.exists(link.warc_storage_file()):
+        logger.info(f"Warc for {link.guid} isn't available yet.")
+        return not_ready
+
+    try:
+        logger.info(f"Initializing play back of {link.guid}")
+        wr_username = link.init_replay_for_user(request)
+    except Exception:  # noqa
+        # We are experiencing many varieties of transient flakiness in playback;
+        # second attempts almost always seem to work, and the page will make one.
+        logger.exception(f"Attempt to init replay of {link.guid} failed. (Retrying: observe whether this error recurs.)")
+        return not_ready
+    if not wr_username:
+        return not_ready
+
+    return JsonResponse({'ready': True, 'wr_prefix': link.wr_iframe_prefix(wr_username)})
+
+
 def set_iframe_session_cookie(request):
     """
     The <iframe> used for Perma Link playback serves content from Webrecorder.
@@ -1,12 +1,17 @@
+import hmac
 import pytz
 from datetime import timedelta, datetime
 
+from django.conf import settings
 from django.core import serializers
+from django.core.exceptions import PermissionDenied
+from django.db.models import Count
 from django.urls import reverse
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.shortcuts import redirect
 from django.utils import timezone
-from perma.models import WeekStats, MinuteStats
+from perma.metrics import load_capture_metrics, load_wr_api_metrics, prometheus_text, wr_api_prometheus_text
+from perma.models import WeekStats, MinuteStats, CaptureJob
 from perma.utils import get_lat_long, user_passes_test_or_403
 
 def stats_sums(request):
@@ -74,6 +79,24 @@ def stats_now(request):
     return JsonResponse({'links': links, 'users': users, 'organizations': organizations, 'registrars': registrars})
 
 
+def capture_metrics(request):
+    """
+    Capture timings and outcomes, the depth of the capture queue, and Webrecorder API timings, in the Prometheus text format.
+    Available to staff, or to a scraper sending settings.CAPTURE_METRICS_TOKEN as a bearer token.
+    """
+    token = settings.CAPTURE_METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    if not request.user.is_staff and not (token and hmac.compare_digest(authorization.encode(), ('Bearer ' + token).encode())):
+        raise PermissionDenied
+
+    queue_depths = dict(CaptureJob.objects.filter(status='pending').order_by().values_list('lane').annotate(Count('id')))
+    return HttpResponse(
+        prometheus_text(load_capture_metrics(), {lane: queue_depths.get(lane, 0) for lane in CaptureJob.lanes()})
+        + wr_api_prometheus_text(load_wr_api_metrics()),
+        content_type='text/plain; version=0.0.4'
+    )
+
+
 def bookmarklet_create(request):
     '''Handle incoming requests from the bookmarklet.
 
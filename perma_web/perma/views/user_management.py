@@ -1,6 +1,7 @@
 import logging
 import itertools
 
+from collections import Counter
 from datetime import timedelta
 
 from celery.task.control import inspect as celery_inspect
@@ -50,6 +51,7 @@ from perma.forms import (
 from perma.models import Registrar, LinkUser, Organization, Link, Capture, CaptureJob, ApiKey, Sponsorship, Folder
 from perma.utils import apply_search_query, apply_pagination, apply_sort_order, get_form_data, ratelimit_ip_key, get_lat_long, user_passes_test_or_403, prep_for_perma_payments, clear_wr_session
 from perma.email import send_admin_email, send_user_email
+from perma.metrics import CAPTURE_PHASES, day_slot, format_percentiles, load_capture_metrics, load_daily_capture_metrics
 from perma.exceptions import PermaPaymentsCommunicationException
 
 logger = logging.getLogger(__name__)
@@ -107,23 +109,33 @@ def stats(request, stat_type=None):
                 'wait_time_dist': '-',
             }
 
-            # calculate 5%/50%/95% capture and wait timings
-            capture_time_fields = CaptureJob.objects.filter(
-                link__creation_timestamp__gt=start_date, link__creation_timestamp__lt=end_date
-            ).values(
-                'capture_start_time', 'link__creation_timestamp', 'capture_end_time'
-            ).exclude(capture_start_time=None).exclude(capture_end_time=None)
-            if capture_time_fields:
-                ctf_len = len(capture_time_fields)
-                capture_times = sorted(c['capture_end_time']-c['capture_start_time'] for c in capture_time_fields)
-                wait_times = sorted(c['capture_start_time']-c['link__creation_timestamp'] for c in capture_time_fields)
-                day['capture_time_dist'] = " / ".join(str(i) for i in [capture_times[int(ctf_len*.05)], capture_times[int(ctf_len*.5)], capture_times[int(ctf_len*.95)]])
-                day['wait_time_dist'] = " / ".join(str(i) for i in [wait_times[int(ctf_len*.05)], wait_times[int(ctf_len*.5)], wait_times[int(ctf_len*.95)]])
+            # 5%/50%/95% capture and wait timings, from the histograms recorded as captures finish
+            capture_metrics = load_daily_capture_metrics(days_ago)
+            day['capture_time_dist'] = format_percentiles(capture_metrics['phases']['total']['buckets'])
+            day['wait_time_dist'] = format_percentiles(capture_metrics['phases']['queue_wait']['buckets'])
 
             day['statuses'] = dict((x['status'], x['count']) for x in day['statuses'])
             day['link_count'] = sum(day['statuses'].values())
             out['days'].append(day)
 
+    elif stat_type == "capture_phases":
+        # how long each phase of a capture has taken, today and over the past week
+        metrics = {
+            'today': load_daily_capture_metrics(0),
+            'week': load_capture_metrics([day_slot((timezone.now() - timedelta(days=days_ago)).date()) for days_ago in range(7)]),
+        }
+        out = {
+            'phases': [{
+                'phase': phase,
+                'today': format_percentiles(metrics['today']['phases'][phase]['buckets']),
+                'today_count': metrics['today']['phases'][phase]['count'],
+                'week': format_percentiles(metrics['week']['phases'][phase]['buckets']),
+                'week_count': metrics['week']['phases'][phase]['count'],
+            } for phase in CAPTURE_PHASES],
+            'statuses_today': metrics['today']['statuses'],
+            'statuses_week': metrics['week']['statuses'],
+        }
+
     elif stat_type == "emails":
         # get users by email top-level domain
         out = {
@@ -206,8 +218,18 @@ def stats(request, stat_type=None):
         job_queues = dict(itertools.groupby(job_queues, lambda x: 'human' if x.human else 'robot'))
         for queue_key, queue in job_queues.items():
             job_queues[queue_key] = [{'email':email, 'count':len(list(jobs))} for email, jobs in itertools.groupby(queue, lambda x: x.link.created_by.email)]
+        active_jobs = list(CaptureJob.objects.filter(status='in_progress').select_related('link', 'link__created_by'))
+        CaptureJob.load_cached_progress(active_jobs)
+        lane_depths = dict(CaptureJob.objects.filter(status='pending').order_by().values_list('lane').annotate(Count('id')))
+        lanes_in_progress = Counter(j.lane for j in active_jobs)
         out = {
             'job_queues': job_queues,
+            'lanes': [{
+                'lane': lane,
+                'weight': CaptureJob.lane_weights().get(lane),
+                'pending': lane_depths.get(lane, 0),
+                'in_progress': lanes_in_progress[lane],
+            } for lane in CaptureJob.lanes()],
             'active_jobs': [{
                 'link_id': j.link_id,
                 'email': j.link.created_by.email,
@@ -215,7 +237,7 @@ def stats(request, stat_type=None):
                 'step_count': round(j.step_count, 2),
                 'step_description': j.step_description,
                 'capture_start_time': j.capture_start_time
-            } for j in CaptureJob.objects.filter(status='in_progress').select_related('link', 'link__created_by')]
+            } for j in active_jobs]
         }
 
     if out:
@@ -14,6 +14,7 @@ function addSection(name){
 
 var chain = $.when(addSection("random")());
 chain = chain.then(addSection("days"));
+chain = chain.then(addSection("capture_phases"));
 chain = chain.then(addSection("emails"));
 chain = chain.then(addSection("job_queue"));
 chain = chain.then(addSection("celery_queues"));